@@ -0,0 +1,154 @@
+import re
+import threading
+import datetime as dt
+from log_message import message
+from config import configValue, TO_TZONE
+from TilePyramid import MIN_RANGE
+
+"""
+Keeps the dashboard's common ranges hot in the shared DataCache. A daemon
+thread of the server process requests each configured range on a schedule, so
+sessions opening the default views are served from memory. Ranges are given
+as "today" (local midnight to now), "<N>h" (the last N hours, "6h" is the
+default view) or "<N>d" (local midnight N days ago to now), matching what the
+date selector requests. Ranges longer than TilePyramid.MIN_RANGE are read
+from the tile pyramid instead, as StreamPlot does, so their tiles are built
+here rather than in a session's request. Both are read from config.txt, e.g.
+
+    warm_ranges: 6h today 7d 30d 365d
+    warm_interval: 5
+"""
+DEFAULT_RANGES = ['6h', 'today', '7d', '30d', '365d']
+DEFAULT_INTERVAL = dt.timedelta(minutes=5)
+# Bucket budget of tile reads, the dashboard's default number of samples
+TILE_SAMPLES = 720
+
+
+def warmerConfig():
+    """
+    Returns the warmer's ranges and interval from config.txt, interval given
+    in minutes, falling back to DEFAULT_RANGES and DEFAULT_INTERVAL.
+    """
+    ranges = configValue('warm_ranges') or DEFAULT_RANGES
+    interval = configValue('warm_interval')
+    if interval:
+        interval = dt.timedelta(minutes=float(interval[0]))
+    else:
+        interval = DEFAULT_INTERVAL
+    return {'ranges': ranges, 'interval': interval}
+
+
+def roundMinute(time):
+    """
+    Returns time rounded to the nearest minute, as the date selector and the
+    warmer round range ends, so both ask for the same ranges.
+    """
+    time = time.replace(microsecond=0)
+    if time.second > 29:
+        time = time + dt.timedelta(minutes=1)
+    return time.replace(second=0)
+
+
+def rangeFromSpec(spec,
+                  now):
+    """
+    Returns the [start, end] timerange a range spec stands for at now, a tz
+    aware datetime. Like the date selector, days are those of now and the
+    end is now rounded with roundMinute.
+    """
+    end = roundMinute(now)
+    midnight = now.tzinfo.localize(
+        dt.datetime.combine(now.date(), dt.datetime.min.time()))
+    if spec == 'today':
+        return [midnight, end]
+    match = re.fullmatch(r"(\d+)([hd])", spec)
+    if match is None:
+        raise Exception(F"Unrecognized warm range: {spec}")
+    count = int(match.group(1))
+    if match.group(2) == 'h':
+        return [end - dt.timedelta(hours=count), end]
+    start = dt.datetime.combine(now.date() - dt.timedelta(days=count),
+                                dt.datetime.min.time())
+    return [now.tzinfo.localize(start), end]
+
+
+class CacheWarmer:
+    """
+    Background thread requesting ranges from a DataCache every interval.
+    Requests are flagged as warming so they don't count towards the cache's
+    session hit ratio. Longest ranges are requested first, so shorter ones
+    are then served from the same frame.
+
+    cache : the DataCache to keep warm.
+    optional ranges : list of range specs, see rangeFromSpec.
+    optional interval : timedelta between warming runs.
+    optional series : data source to warm.
+    optional pyramid : TilePyramid of series, which reads ranges longer than
+                       MIN_RANGE. Without one they are requested from cache.
+    """
+    _cache = None
+    _pyramid = None
+    _ranges = None
+    _interval = None
+    _series = None
+    _thread = None
+    _stop = None
+    _to_tzone = TO_TZONE
+    runs = 0
+    last_run = None
+
+    def __init__(self,
+                 cache,
+                 ranges=DEFAULT_RANGES,
+                 interval=DEFAULT_INTERVAL,
+                 series='Pi',
+                 pyramid=None):
+        now = dt.datetime.now(self._to_tzone)
+        for spec in ranges:
+            rangeFromSpec(spec, now)
+        self._cache = cache
+        self._pyramid = pyramid
+        self._ranges = ranges
+        self._interval = interval
+        self._series = series
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name='CacheWarmer',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            self.warm()
+            if self._stop.wait(self._interval.total_seconds()):
+                return
+
+    def warm(self):
+        now = dt.datetime.now(self._to_tzone)
+        timeranges = sorted((rangeFromSpec(spec, now)
+                             for spec in self._ranges),
+                            key=lambda timerange: timerange[0])
+        for timerange in timeranges:
+            try:
+                if (self._pyramid is not None
+                        and timerange[1] - timerange[0] > MIN_RANGE):
+                    self._pyramid.read(timerange, TILE_SAMPLES)
+                else:
+                    self._cache.get(timerange, self._series, warming=True)
+            except Exception as e:
+                message([F"{'Cache warm failed:': <20}", F"{e}"],
+                        mssgType='WARNING')
+        self.runs += 1
+        self.last_run = now
+        message([F"{'Cache warmed:': <20}",
+                 F"{len(timeranges)} ranges, "
+                 F"{self._cache.residentBytes() / 2**20:.1f} MB, "
+                 F"session hit ratio {self._cache.hitRatio():.0%}"],
+                mssgType='ADMIN')
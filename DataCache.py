@@ -0,0 +1,262 @@
+import datetime as dt
+import threading
+import pandas as pd
+from log_message import message
+
+
+class _CacheEntry:
+    dat = None
+    series = None
+    columns = None
+    nbytes = 0
+    last_used = None
+    expires = None
+    requests = None
+    lock = None
+
+    def __init__(self,
+                 dat,
+                 series,
+                 columns,
+                 now):
+        self.dat = dat
+        self.series = series
+        self.columns = columns
+        self.last_used = now
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def covers(self,
+               series,
+               columns):
+        return (self.series == series
+                and (self.columns is None
+                     or (columns is not None
+                         and set(columns) <= set(self.columns))))
+
+
+class DataCache:
+    """
+    Range aware cache of loaded WELData frames, shared by every session of
+    the server process. A request is served from the cached frame of the same
+    series it overlaps most cheaply, extended with only the missing head or
+    tail, so an auto refreshing "today" view costs one small delta query.
+    Requests which overlap nothing are loaded in full. Callers get a read only
+    view of their range; frames keep what was requested in the last
+    keep_requests and drop older data.
+
+    Frames are byte accounted and the least recently used are evicted above
+    max_bytes. Frames reaching up to "now" expire live_ttl after they were
+    last used.
+
+    Fetches are single flight: while a request is loading, identical requests,
+    by series, columns and range rounded to flight_bucket, wait for it and are
+    then served from the cache. Different requests load concurrently, and
+    each frame is only extended by one request at a time.
+
+    loader : function taking (timerange, series, columns) and returning a
+             WELData.
+    optional max_bytes : memory budget for all frames.
+    optional live_ttl : lifetime of frames which include "now".
+    optional keep_requests : how long a request keeps its start loaded.
+    optional flight_bucket : rounding of request ranges for single flight.
+
+    Requests made while warming are counted in warm_stats, so stats and
+    hitRatio reflect what sessions saw.
+    """
+    _loader = None
+    _max_bytes = None
+    _live_ttl = None
+    _keep_requests = None
+    _flight_bucket = None
+    _entries = None
+    _flights = None
+    _lock = None
+    stats = None
+    warm_stats = None
+
+    def __init__(self,
+                 loader,
+                 max_bytes=512 * 2**20,
+                 live_ttl=dt.timedelta(minutes=10),
+                 keep_requests=dt.timedelta(hours=1),
+                 flight_bucket=dt.timedelta(minutes=1)):
+        self._loader = loader
+        self._max_bytes = max_bytes
+        self._live_ttl = live_ttl
+        self._keep_requests = keep_requests
+        self._flight_bucket = flight_bucket
+        self._entries = []
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'deltas': 0, 'misses': 0, 'waits': 0,
+                      'evictions': 0, 'expirations': 0}
+        self.warm_stats = {'hits': 0, 'deltas': 0, 'misses': 0, 'waits': 0}
+
+    def _count(self,
+               stat,
+               warming=False):
+        with self._lock:
+            (self.warm_stats if warming else self.stats)[stat] += 1
+
+    def _pick(self,
+              timerange,
+              series,
+              columns):
+        # Prefer the entry needing the least fetching, then the shortest
+        best = None
+        best_cost = None
+        for entry in self._entries:
+            start, end = entry.dat.timerange
+            if (not entry.covers(series, columns)
+                    or timerange[0] > end or timerange[1] < start):
+                continue
+            missing = (max(start - timerange[0], dt.timedelta(0))
+                       + max(timerange[1] - end, dt.timedelta(0)))
+            cost = (missing, end - start)
+            if best_cost is None or cost < best_cost:
+                best = entry
+                best_cost = cost
+        return best
+
+    def _trim(self,
+              entry,
+              start,
+              now):
+        entry.requests = [(when, req_start)
+                          for when, req_start in entry.requests
+                          if now - when < self._keep_requests]
+        entry.requests.append((now, start))
+        entry.dat.trimRange(min(req_start
+                                for when, req_start in entry.requests))
+
+    def _evict(self,
+               now):
+        # Called with the lock held
+        for entry in self._entries:
+            entry.nbytes = entry.dat.memoryUsage()
+        for entry in [entry for entry in self._entries
+                      if entry.expires is not None and entry.expires < now]:
+            self._entries.remove(entry)
+            self.stats['expirations'] += 1
+        while (len(self._entries) > 1
+               and self.residentBytes() > self._max_bytes):
+            entry = min(self._entries, key=lambda entry: entry.last_used)
+            self._entries.remove(entry)
+            self.stats['evictions'] += 1
+            message([F"{'Cache evicted:': <20}",
+                     F"{entry.nbytes / 2**20:.1f} MB"], mssgType='ADMIN')
+
+    def _flightKey(self,
+                   timerange,
+                   series,
+                   columns):
+        bucket = self._flight_bucket.total_seconds()
+        return (series,
+                None if columns is None else tuple(sorted(columns)),
+                int(timerange[0].timestamp() // bucket),
+                int(timerange[1].timestamp() // bucket))
+
+    def _takeOff(self,
+                 key,
+                 warming):
+        # Wait until no identical request is in flight, then fly this one
+        waited = False
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    self._flights[key] = threading.Event()
+                    stats = self.warm_stats if warming else self.stats
+                    stats['waits'] += waited
+                    return
+            flight.wait()
+            waited = True
+
+    def _land(self,
+              key):
+        with self._lock:
+            self._flights.pop(key).set()
+
+    def residentBytes(self):
+        return sum(entry.nbytes for entry in self._entries)
+
+    def hitRatio(self):
+        """
+        Returns the fraction of session requests served without a query, NaN
+        before the first request.
+        """
+        requests = (self.stats['hits'] + self.stats['deltas']
+                    + self.stats['misses'])
+        if requests == 0:
+            return float('nan')
+        return self.stats['hits'] / requests
+
+    def get(self,
+            timerange,
+            series='Pi',
+            columns=None,
+            warming=False):
+        key = self._flightKey(timerange, series, columns)
+        self._takeOff(key, warming)
+        try:
+            return self._get(timerange, series, columns, warming)
+        finally:
+            self._land(key)
+
+    def _get(self,
+             timerange,
+             series,
+             columns,
+             warming):
+        now = dt.datetime.now(timerange[1].tzinfo)
+        with self._lock:
+            self._evict(now)
+            entry = self._pick(timerange, series, columns)
+        if entry is None:
+            # Loaded outside the lock so other requests aren't held up
+            entry = _CacheEntry(self._loader(timerange, series, columns),
+                                series, columns, now)
+            with self._lock:
+                self._entries.append(entry)
+            self._count('misses', warming)
+            message([F"{'Cache load:': <20}", F"{len(entry.dat.data)} rows"],
+                    mssgType='ADMIN')
+        elif (timerange[0] >= entry.dat.timerange[0]
+              and timerange[1] <= entry.dat.timerange[1]):
+            self._count('hits', warming)
+        with entry.lock:
+            if (timerange[0] < entry.dat.timerange[0]
+                    or timerange[1] > entry.dat.timerange[1]):
+                fetched = entry.dat.extendRange(timerange)
+                self._count('deltas', warming)
+                message([F"{'Cache delta:': <20}", F"{fetched} rows"],
+                        mssgType='ADMIN')
+            self._trim(entry, timerange[0], now)
+            entry.last_used = now
+            entry.expires = None
+            if entry.dat.timerange[1] >= now - dt.timedelta(minutes=1):
+                entry.expires = now + self._live_ttl
+            view = entry.dat.subset(timerange)
+        with self._lock:
+            self._evict(now)
+        return view
+
+    def info(self):
+        """
+        Returns a dataframe describing the resident frames, most recently used
+        first.
+        """
+        with self._lock:
+            entries = sorted(self._entries, key=lambda entry: entry.last_used,
+                             reverse=True)
+        return pd.DataFrame([{'series': entry.series,
+                              'columns': (None if entry.columns is None
+                                          else len(entry.columns)),
+                              'start': entry.dat.timerange[0],
+                              'end': entry.dat.timerange[1],
+                              'rows': len(entry.dat.data),
+                              'MB': entry.nbytes / 2**20,
+                              'last used': entry.last_used,
+                              'expires': entry.expires}
+                             for entry in entries])
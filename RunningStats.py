@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+"""
+Exact sidebar statistics from prefix sums over full resolution samples. The
+sums are built once per frame and extended with only the new samples as data
+are appended, so the duty cycle, time weighted mean powers and latest valve
+state of any range inside the frame cost two binary searches. Bucket means,
+e.g. of tiles, weigh by their sample counts, which keeps the stats exact up
+to gaps within buckets.
+"""
+INPUTS = ['heat_1_b', 'heat_2_b', 'house_w', 'power_tot', 'rev_valve_b']
+SAMPLE_PERIOD = 30          # seconds, assumed for the last sample
+MAX_GAP = 300               # seconds, longer gaps don't count as time
+HEAT_1_POWER = 0.8          # heat 1 is ~80% of full power
+
+
+def _values(frame,
+            name,
+            start):
+    if name not in frame:
+        return np.full(len(frame) - start, np.nan)
+    return frame[name].to_numpy(dtype=np.float64, na_value=np.nan)[start:]
+
+
+class RunningStats:
+    """
+    Prefix sums of one frame. Instances are not modified, update returns a
+    new one sharing what it can, so readers of an older one are unaffected.
+    """
+    _times = None
+    _sums = None
+    _latest_valve = None
+
+    def __init__(self,
+                 times,
+                 sums,
+                 latest_valve):
+        self._times = times
+        self._sums = sums
+        self._latest_valve = latest_valve
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64),
+                   {name: np.zeros(1) for name in ['heat_n', 'heat_1',
+                                                   'heat_2', 'house_e',
+                                                   'house_t', 'geo_e',
+                                                   'geo_t']},
+                   np.empty(0))
+
+    def _slice(self,
+               start):
+        # Drop samples before position start, prefix sums stay valid as
+        # only their differences are used
+        return RunningStats(self._times[start:],
+                            {name: sums[start:]
+                             for name, sums in self._sums.items()},
+                            self._latest_valve[start:])
+
+    def _resumeAt(self,
+                  times):
+        # Position in times from which the sums must be calculated, with self
+        # sliced to match. The last sample is always redone, since its
+        # duration and power shift depend on the sample after it.
+        if len(self._times) == 0 or len(times) == 0:
+            return RunningStats.empty(), 0
+        start = int(np.searchsorted(self._times, times[0]))
+        if start == len(self._times) or self._times[start] != times[0]:
+            return RunningStats.empty(), 0
+        old = self._slice(start)
+        keep = len(old._times) - 1
+        if (keep < 0 or keep >= len(times)
+                or times[keep] != old._times[keep]):
+            return RunningStats.empty(), 0
+        return old, keep
+
+    def update(self,
+               frame,
+               counts=None,
+               width=None):
+        """
+        Returns the stats of frame, reusing the sums of the samples it shares
+        with the frame of self.
+
+        frame : dataframe with INPUTS columns indexed by sample time, missing
+                columns count as empty.
+        optional counts : when the rows of frame are bucket means, e.g. from
+                          tiles, a dataframe of the number of samples behind
+                          each of them. Rows then weigh as many samples, each
+                          standing for SAMPLE_PERIOD seconds.
+        optional width : bucket length in seconds, with counts.
+        """
+        times = frame.index.asi8
+        old, keep = self._resumeAt(times)
+        new_times = times[keep:]
+        heat_1 = _values(frame, 'heat_1_b', keep)
+        heat_2 = _values(frame, 'heat_2_b', keep)
+        house = _values(frame, 'house_w', keep)
+        geo = _values(frame, 'power_tot', keep)
+        if counts is None:
+            # Seconds each sample stands for, up to the next sample
+            seconds = np.diff(new_times, append=new_times[-1:]) / 1e9
+            if len(seconds):
+                seconds[-1] = SAMPLE_PERIOD
+            seconds = np.minimum(seconds, MAX_GAP)
+            weights = {name: 1 for name in ['heat_1_b', 'heat_2_b']}
+            seconds = {name: seconds for name in ['house_w', 'power_tot']}
+        else:
+            weights = {name: np.nan_to_num(_values(counts, name, keep))
+                       for name in ['heat_1_b', 'heat_2_b']}
+            seconds = {name: np.minimum(np.nan_to_num(_values(counts, name,
+                                                              keep))
+                                        * SAMPLE_PERIOD, width)
+                       for name in ['house_w', 'power_tot']}
+
+        increments = {'heat_n': np.where(np.isnan(heat_1), 0,
+                                         weights['heat_1_b']),
+                      'heat_1': np.nan_to_num(heat_1 % 2
+                                              * weights['heat_1_b']),
+                      'heat_2': np.nan_to_num(heat_2 % 2
+                                              * weights['heat_2_b']),
+                      'house_e': np.nan_to_num(house * seconds['house_w']),
+                      'house_t': np.where(np.isnan(house), 0,
+                                          seconds['house_w']),
+                      'geo_e': np.nan_to_num(geo * seconds['power_tot']),
+                      'geo_t': np.where(np.isnan(geo), 0,
+                                        seconds['power_tot'])}
+        sums = {name: np.concatenate(
+                    (old._sums[name][:keep + 1],
+                     old._sums[name][keep] + np.cumsum(increment)))
+                for name, increment in increments.items()}
+
+        valve = _values(frame, 'rev_valve_b', keep)
+        seed = old._latest_valve[keep - 1] if keep > 0 else np.nan
+        valid = ~np.isnan(valve)
+        last = np.maximum.accumulate(np.where(valid,
+                                              np.arange(len(valve)), -1))
+        latest = np.where(last >= 0, valve[np.maximum(last, 0)], seed)
+        latest_valve = np.concatenate((old._latest_valve[:keep], latest))
+        return RunningStats(np.concatenate((old._times[:keep], new_times)),
+                            sums, latest_valve)
+
+    def query(self,
+              timerange):
+        """
+        Statistics of the samples within timerange.
+
+        returns dict of duty in %, house_w and geo_w mean powers in W, and
+        the last known rev_valve_b state, NaN where there are no samples.
+        """
+        start = np.searchsorted(self._times, pd.Timestamp(timerange[0]).value,
+                                side='left')
+        end = np.searchsorted(self._times, pd.Timestamp(timerange[1]).value,
+                              side='right')
+
+        def total(name):
+            return self._sums[name][end] - self._sums[name][start]
+
+        def ratio(num, den):
+            return num / den if den > 0 else np.nan
+
+        heat_2 = total('heat_2')
+        heat_1 = total('heat_1') - heat_2
+        return {'duty': 100 * ratio(HEAT_1_POWER * heat_1 + heat_2,
+                                    total('heat_n')),
+                'house_w': ratio(total('house_e'), total('house_t')),
+                'geo_w': ratio(total('geo_e'), total('geo_t')),
+                'rev_valve_b': (self._latest_valve[end - 1] if end > 0
+                                else np.nan)}
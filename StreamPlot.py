@@ -1,15 +1,32 @@
-import streamlit as st
 import altair as alt
 import pandas as pd
 import numpy as np
-import time
+import json
+import hashlib
+import functools
+import threading
+from copy import deepcopy
+from collections import OrderedDict
 from WELData import WELData, mongoConnect
+from DataCache import DataCache
+from CacheWarmer import CacheWarmer, warmerConfig
+from TilePyramid import TilePyramid, TileData, MIN_RANGE, bucketWidth
+from downsample import downsample, niceWidth, bucketMeans
+from derived_metrics import calculate, isDerived, materializedNames
 from log_message import message
+import profiler
+
+
+# A plain module level connection rather than st.cache, which expects a
+# script run and so can't be called from the cache warmer's thread
+_mongo_db = None
 
 
-@st.cache(hash_funcs={"pymongo.database.Database": id})
 def _cachedMongoConnect():
-    return mongoConnect()
+    global _mongo_db
+    if _mongo_db is None:
+        _mongo_db = mongoConnect()
+    return _mongo_db
 
 
 # @st.cache()
@@ -18,21 +35,250 @@ def _cachedMongoConnect():
 #     return libmc.Client(['localhost'])
 
 
-@st.cache(allow_output_mutation=True, show_spinner=False)
-def _cachedWELData(date_range,
-                   data_source='Pi'):
+def _loadWELData(date_range,
+                 data_source='Pi',
+                 columns=None):
     return WELData(timerange=date_range,
                    data_source=data_source,
+                   columns=columns,
                    dl_db_path="/home/ubuntu/WEL/log_db/",
-                   mongo_connection=_cachedMongoConnect())
+                   parquet_path="/home/ubuntu/WEL/parquet_db/",
+                   mongo_connection=(_cachedMongoConnect()
+                                     if data_source == 'Pi' else None))
+
+
+# Module level so it is shared by every session of the server, with its own
+# memory bound, expiry and single flight fetches rather than st.cache's
+# unbounded per argument one
+_data_cache = DataCache(_loadWELData)
+
+
+_cache_warmer = None
+_tile_pyramid = None
+
+
+def dataCache():
+    return _data_cache
+
+
+def cacheWarmer():
+    """
+    Returns the process wide CacheWarmer of the data cache and tile pyramid,
+    started on the first call.
+    """
+    global _cache_warmer
+    if _cache_warmer is None:
+        _cache_warmer = CacheWarmer(_data_cache, pyramid=tilePyramid(),
+                                    **warmerConfig())
+        _cache_warmer.start()
+    return _cache_warmer
+
+
+def tilePyramid():
+    global _tile_pyramid
+    if _tile_pyramid is None:
+        _tile_pyramid = TilePyramid(_cachedMongoConnect())
+    return _tile_pyramid
+
+
+def _cachedWELData(date_range,
+                   data_source='Pi'):
+    return _data_cache.get(list(date_range), data_source)
+
+
+# Decimals kept when values are sent to the browser, by column name or unit
+# suffix, at least the one decimal the charts display. Others keep
+# DEFAULT_DECIMALS. Status values are bucket means, an offset plus the
+# fraction of the bucket the channel was on, and keep that fraction.
+DECIMALS = {'weather_station_W': 1,
+            '_T': 2,
+            '_H': 1,
+            '_R': 2,
+            '_w': 1,
+            '_W': 1,
+            '_b': 2}
+DEFAULT_DECIMALS = 2
+
+
+def _decimals(name):
+    return DECIMALS.get(name, DECIMALS.get(name[-2:], DEFAULT_DECIMALS))
 
 
 def _createNearestTime():
+    # Named, so chart templates built in different renders agree on it
     return alt.selection(type='single',
                          nearest=True,
                          on='mouseover',
                          fields=['dateandtime'],
-                         empty='none')
+                         empty='none',
+                         name='nearest_time')
+
+
+# Serialized charts by template key, and finished charts with their datasets
+# and planned data blocks by data key, shared by every session
+TEMPLATES = 256
+CHARTS = 64
+BLOCKS = 16
+_templates = OrderedDict()
+_charts = OrderedDict()
+_blocks = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def _remember(memo,
+              key,
+              value,
+              size):
+    # LRU insert, called with _memo_lock held
+    memo[key] = value
+    memo.move_to_end(key)
+    while len(memo) > size:
+        memo.popitem(last=False)
+
+
+# Datasets by name prefix which get new samples appended in live mode
+LIVE_KINDS = ['lines', 'status', 'power', 'daylight']
+# Seconds between live polls. Polls end on this grid, so every session
+# polling in the same period asks for the same range.
+LIVE_POLL = 30
+
+
+def _liveKind(name):
+    return name.split('_')[0] in LIVE_KINDS
+
+
+def _liveWindow(spec,
+                window):
+    """
+    Trim every view of a live dataset to the last window milliseconds of its
+    data in the browser, and latest value views to the last sample of each
+    label, so appended rows keep a fixed window.
+    """
+    data = spec.get('data')
+    if isinstance(data, dict) and _liveKind(data.get('name', '')):
+        transform = [{'calculate': "time(toDate(datum.dateandtime))",
+                      'as': '_live_time'}]
+        if data['name'].endswith('_latest'):
+            transform += [{'joinaggregate': [{'op': 'max',
+                                              'field': '_live_time',
+                                              'as': '_live_last'}],
+                           'groupby': ['label']},
+                          {'filter': "datum._live_time == datum._live_last"}]
+        else:
+            transform += [{'joinaggregate': [{'op': 'max',
+                                              'field': '_live_time',
+                                              'as': '_live_end'}]},
+                          {'filter': "datum._live_time > datum._live_end"
+                                     F" - {window}"}]
+        spec['transform'] = transform + spec.get('transform', [])
+    for compose in ['layer', 'vconcat', 'hconcat']:
+        for child in spec.get(compose, []):
+            _liveWindow(child, window)
+    return spec
+
+
+def _barWidth(spec,
+              width):
+    """
+    Returns spec with the width of every bar mark set to width, copying the
+    parts it changes, so the shared template is left as is.
+    """
+    mark = spec.get('mark')
+    if isinstance(mark, dict) and mark.get('type') == 'bar':
+        spec = {**spec, 'mark': {**mark, 'width': width}}
+    for compose in ['layer', 'vconcat', 'hconcat']:
+        if compose in spec:
+            spec = {**spec, compose: [_barWidth(child, width)
+                                      for child in spec[compose]]}
+    return spec
+
+
+def _cachedChart(plot):
+    """
+    Decorator reusing a plot method's finished chart and datasets while its
+    arguments and the data they are drawn from don't change.
+    """
+    @functools.wraps(plot)
+    def cached(self, *args, **kwargs):
+        key = (plot.__name__, type(self).__name__, self.resample_method,
+               self.live_window, self._data_key, repr(args),
+               repr(sorted(kwargs.items())))
+        with _memo_lock:
+            hit = _charts.get(key)
+            if hit is not None:
+                _charts.move_to_end(key)
+        if hit is not None:
+            chart, datasets, recipes = hit
+            self._datasets.update(datasets)
+            self._recipes.update(recipes)
+            return chart
+        self._used = set()
+        chart = plot(self, *args, **kwargs)
+        datasets = {name: self._datasets[name] for name in self._used}
+        recipes = {name: self._recipes[name] for name in self._used
+                   if name in self._recipes}
+        with _memo_lock:
+            _remember(_charts, key, (chart, datasets, recipes), CHARTS)
+        return chart
+    return cached
+
+
+class ChartSpec:
+    """
+    A serialized Vega-Lite chart, with the sizing, composition and
+    configuration methods pages use from Altair working on the dictionary,
+    so cached charts are not built and validated again.
+    """
+    spec = None
+
+    def __init__(self,
+                 spec):
+        self.spec = spec
+
+    def properties(self,
+                   **kwargs):
+        return ChartSpec({**self.spec, **kwargs})
+
+    def resolve_scale(self,
+                      **kwargs):
+        resolve = dict(self.spec.get('resolve', {}))
+        resolve['scale'] = {**resolve.get('scale', {}), **kwargs}
+        return ChartSpec({**self.spec, 'resolve': resolve})
+
+    def _configure(self,
+                   section,
+                   kwargs):
+        config = dict(self.spec.get('config', {}))
+        config[section] = {**config.get(section, {}), **kwargs}
+        return ChartSpec({**self.spec, 'config': config})
+
+    def configure_axis(self,
+                       **kwargs):
+        return self._configure('axis', kwargs)
+
+    def configure_legend(self,
+                         **kwargs):
+        return self._configure('legend', kwargs)
+
+    def configure_view(self,
+                       **kwargs):
+        return self._configure('view', kwargs)
+
+    def to_dict(self):
+        # Templates are shared, callers get their own copy
+        return deepcopy(self.spec)
+
+
+def vconcat(*charts,
+            **kwargs):
+    return ChartSpec({'vconcat': [chart.spec for chart in charts],
+                      **kwargs})
+
+
+def hconcat(*charts,
+            **kwargs):
+    return ChartSpec({'hconcat': [chart.spec for chart in charts],
+                      **kwargs})
 
 
 # def _createResize():
@@ -73,47 +319,219 @@ class StreamPlot():
                    'Emp_Kitchen_w', 'Emp_K&T_Back_w', 'Emp_Solar_w',
                    'Emp_TES_w', 'Emp_Barn_w', 'Emp_Tesla_w', 'Emp_Dryer_w',
                    'Emp_Total_w', 'Emp_balance_w']
+    status_list = ['TAH_fan_b', 'heat_1_b', 'heat_2_b', 'zone_1_b',
+                   'zone_2_b']
     resample_N = None
     resample_T = None
+    resample_width = None
+    _bar_width = None
+    resample_method = None
+    compact_encoding = None
+    dat = None
     dat_resample = None
+    _blocks = None
+    _datasets = None
+    _data_key = None
+    _used = None
+    _recipes = None
+    live = None
+    data_source = None
+    live_window = None
+    _live_last = None
     nearestTime = None
     resize = None
-    mssg_tbl = None
 
     def __init__(self,
-                 resample_N=1000):
+                 resample_N=1000,
+                 resample_method='mean',
+                 compact_encoding=True,
+                 live=False,
+                 data_source='Pi'):
         self.nearestTime = _createNearestTime()
         self.resample_N = resample_N
+        self.resample_method = resample_method
+        self.compact_encoding = compact_encoding
+        self.live = live
+        self.data_source = data_source
         # self.resize = _createResize()
 
-    def makeDebugTbl(self):
-        st.sidebar.subheader("Log:")
-        self.mssg_tbl = st.sidebar.table()
-
     def makeWEL(self,
                 date_range,
                 force_refresh=False):
-        tic = time.time()
-        if not force_refresh:
-            dat = _cachedWELData(date_range)
+        with profiler.span('WEL data') as data_span:
+            if force_refresh:
+                dat = _loadWELData(date_range, self.data_source)
+            elif (self.data_source == 'Pi'
+                  and date_range[1] - date_range[0] > MIN_RANGE):
+                # Long ranges are assembled from pre-aggregated tiles
+                dat = tilePyramid().read(date_range, self.resample_N)
+            else:
+                dat = _cachedWELData(date_range, self.data_source)
+            data_span.rows = len(dat.data)
+        self.dat = dat
+        # Buckets come from fixed widths aligned to the epoch, so renders of
+        # different ranges share them. Tile reads already are such buckets.
+        span = (dat.timerange[1] - dat.timerange[0]).total_seconds()
+        if isinstance(dat, TileData):
+            self.resample_width = bucketWidth(dat.level)
         else:
-            dat = WELData(timerange=date_range,
-                          mongo_connection=_cachedMongoConnect())
-        self.resample_T = (dat.timerange[1]
-                           - dat.timerange[0]) / self.resample_N
-        self.dat_resample = dat.data.resample(self.resample_T).mean()
-        message([F"{'WEL Data init:': <20}", F"{time.time() - tic:.2f} s"],
-                tbl=self.mssg_tbl, mssgType='TIMING')
+            self.resample_width = niceWidth(span, self.resample_N)
+        self.resample_T = pd.Timedelta(seconds=self.resample_width)
+        self._bar_width = round(800 * self.resample_width / max(span, 1), 2)
+        self.dat_resample = pd.DataFrame()
+        # Identifies what every chart is drawn from
+        self._data_key = (dat.dataVersion(), tuple(dat.timerange),
+                          self.resample_N, self.compact_encoding)
+        with _memo_lock:
+            self._blocks = _blocks.get(self._data_key)
+            if self._blocks is None:
+                self._blocks = {}
+            _remember(_blocks, self._data_key, self._blocks, BLOCKS)
+        self._datasets = {}
+        self._used = set()
+        self._recipes = {}
+        if self.live:
+            # Charts keep showing a window of the range's length
+            self.live_window = int((dat.timerange[1] - dat.timerange[0])
+                                   .total_seconds() * 1000)
+            self._live_last = (dat.data.index[-1] if len(dat.data)
+                               else pd.Timestamp(dat.timerange[1]))
+
+    def getResampled(self,
+                     vars):
+        # Columns and derived metrics are resampled on first use, so only
+        # what is plotted gets calculated
+        if type(vars) is not list:
+            vars = [vars]
+        missing = [var for var in vars if var not in self.dat_resample]
+        if missing:
+            with profiler.span('Resample') as resample_span:
+                # Means of the compact integer and flag columns are plain
+                # floats for display
+                new_cols = (self.dat.resampled(missing, self.resample_width)
+                            .astype(np.float64))
+                resample_span.rows = len(new_cols)
+            if self.dat_resample.empty:
+                self.dat_resample = new_cols
+            else:
+                self.dat_resample = self.dat_resample.join(new_cols)
+        return self.dat_resample[[var for var in vars
+                                  if var in self.dat_resample]]
+
+    def planData(self,
+                 series):
+        """
+        Build the long format data for every chart of a render in one pass,
+        so charts only select their series from it. Series are melted once
+        per downsampling method and kept as one block per label.
+
+        series : list of (list of column names, downsampling method) pairs.
+        """
+        by_method = {}
+        for vars, method in series:
+            for var in vars:
+                if ((method, var) not in self._blocks
+                        and var not in by_method.setdefault(method, [])):
+                    by_method[method].append(var)
+        for method, vars in by_method.items():
+            if method == 'mean':
+                wide = self.getResampled(vars)
+                present = [var for var in vars if var in wide]
+                if not present:
+                    continue
+                with profiler.span('Melt') as melt_span:
+                    long = wide[present].reset_index().melt(
+                        id_vars='dateandtime', value_vars=present,
+                        var_name='label')
+                    n = len(wide)
+                    for i, var in enumerate(present):
+                        self._blocks[(method, var)] = self._encodeBlock(
+                            long.iloc[i * n:(i + 1) * n], var)
+                    melt_span.rows = len(long)
+            else:
+                # Each series is reduced on its own from full resolution,
+                # so blocks have per series timestamps
+                cols = self.dat.getCols(vars)
+                with profiler.span(F"Downsample {method}") as down_span:
+                    for var in cols:
+                        series = cols[var]
+                        if (method == 'minmax'
+                                and isinstance(self.dat, TileData)):
+                            # Tile means would hide each bucket's extremes
+                            series = self.dat.envelope(var)
+                        series = downsample(series, self.resample_N, method)
+                        self._blocks[(method, var)] = self._encodeBlock(
+                            pd.DataFrame({'dateandtime': series.index,
+                                          'label': var,
+                                          'value': series.to_numpy(
+                                              dtype=np.float64,
+                                              na_value=np.nan)}), var)
+                    down_span.rows = len(cols) * len(cols.columns)
+
+    def _encodeBlock(self,
+                     block,
+                     var):
+        # In compact encoding times are sent as epoch milliseconds and values
+        # rounded to their display precision, instead of ISO strings and full
+        # floats. ISO strings are written in local time.
+        if not self.compact_encoding:
+            return block.assign(dateandtime=pd.DatetimeIndex(
+                block['dateandtime']).tz_convert(WELData._to_tzone))
+        values = block['value'].to_numpy(dtype=np.float64, na_value=np.nan)
+        return pd.DataFrame(
+            {'dateandtime': (pd.DatetimeIndex(block['dateandtime']).asi8
+                             // 1_000_000),
+             'label': var,
+             'value': np.round(values, _decimals(var))})
+
+    def _stripUnits(self,
+                    source):
+        # Display labels drop the two character unit suffix, e.g. '_T'
+        source['label'] = source['label'].str.slice(0, -2)
+        return source
+
+    def _emptySubset(self,
+                     id_vars):
+        # Keeps the long format columns, so charts of series missing from
+        # the data are drawn empty
+        if type(id_vars) is not list:
+            id_vars = [id_vars]
+        empty = {col: pd.Series(dtype=np.float64) for col in id_vars}
+        empty['label'] = pd.Series(dtype=object)
+        empty['value'] = pd.Series(dtype=np.float64)
+        return pd.DataFrame(empty)
 
     def _getDataSubset(self,
                        vars,
                        id_vars='dateandtime',
-                       decimate_factor=1):
+                       decimate_factor=1,
+                       method='mean'):
+        if type(vars) is not list:
+            vars = [vars]
+        if id_vars == 'dateandtime' and decimate_factor == 1:
+            self.planData([(vars, method)])
+            badKeys = [var for var in vars
+                       if (method, var) not in self._blocks]
+            if badKeys:
+                message(["Key(s) not found in db:", F"{badKeys}"],
+                        mssgType='WARNING')
+            if len(badKeys) == len(vars):
+                message("No valid keys selected, returning empty dataframe",
+                        mssgType='ERROR')
+                return self._emptySubset(id_vars)
+            return pd.concat([self._blocks[(method, var)] for var in vars
+                              if (method, var) in self._blocks],
+                             ignore_index=True)
+        if type(id_vars) is not list:
+            self.getResampled(vars)
+        else:
+            self.getResampled(vars + [var for var in id_vars
+                                      if var != 'dateandtime'])
         if decimate_factor == 1:
             source = self.dat_resample
         else:
-            source = self.dat_resample.resample(self.resample_T
-                                                * decimate_factor).mean()
+            source = bucketMeans(self.dat_resample,
+                                 self.resample_width * decimate_factor)
         source = source.reset_index()
         try:
             source = source.melt(id_vars=id_vars,
@@ -128,17 +546,152 @@ class StreamPlot():
                 else:
                     badKeys.append(key)
             message(["Key(s) not found in db:", F"{badKeys}"],
-                    tbl=self.mssg_tbl, mssgType='WARNING')
+                    mssgType='WARNING')
             if not goodKeys:
                 message("No valid keys selected, returning empty dataframe",
                         mssgType='ERROR')
-                return pd.DataFrame()
+                return self._emptySubset(id_vars)
             source = source.melt(id_vars=id_vars,
                                  value_vars=goodKeys,
                                  var_name='label')
 
         return source
 
+    def _namedData(self,
+                   source,
+                   kind,
+                   vars=None,
+                   method='mean'):
+        # Registered once per render as a top level dataset, which every
+        # layer of the chart references by name
+        name = kind
+        if vars is not None:
+            if type(vars) is not list:
+                vars = [vars]
+            name += F"_{method}_" + hashlib.md5(
+                "|".join(vars).encode()).hexdigest()[:8]
+        if name not in self._datasets:
+            self._datasets[name] = alt.to_values(source)['values']
+        self._used.add(name)
+        self._recipes[name] = (kind, vars, method)
+        return alt.NamedData(name=name)
+
+    def _template(self,
+                  key,
+                  build):
+        # Charts only reference their data by dataset name, so a chart built
+        # once serves every later render with the same key. Resample
+        # settings are part of every key, as line interpolation depends on
+        # them. Bar widths follow the range's span, so they are set on each
+        # render's copy instead.
+        key = (type(self).__name__, self.resample_N, self.resample_method,
+               self.live_window) + key
+        with _memo_lock:
+            spec = _templates.get(key)
+            if spec is not None:
+                _templates.move_to_end(key)
+        if spec is None:
+            with profiler.span('Chart template'):
+                spec = build().to_dict()
+                spec.pop('$schema', None)
+                if self.live_window is not None:
+                    spec = _liveWindow(spec, self.live_window)
+            with _memo_lock:
+                _remember(_templates, key, spec, TEMPLATES)
+        return ChartSpec(_barWidth(spec, self._bar_width))
+
+    def _liveBlock(self,
+                   kind,
+                   vars,
+                   cols):
+        # New samples in the format the render gave each dataset kind
+        frame = pd.concat([self._encodeBlock(
+                               pd.DataFrame({'dateandtime': cols.index,
+                                             'label': var,
+                                             'value': cols[var].to_numpy(
+                                                 dtype=np.float64,
+                                                 na_value=np.nan)}),
+                               var)
+                           for var in vars if var in cols],
+                          ignore_index=True)
+        if kind == 'status':
+            frame['value'] = frame['value'] % 2
+        if kind == 'power':
+            frame['value'] = frame['value'] / 1000
+            if self.compact_encoding:
+                frame['value'] = frame['value'].round(3)
+            frame['order'] = frame['label'].map({label: idx for idx, label
+                                                 in enumerate(vars)})
+        if kind != 'daylight':
+            frame = self._stripUnits(frame)
+        return frame
+
+    def liveRows(self):
+        """
+        Fetch the samples logged since the last call, or since the render,
+        and return them as new rows of the render's live datasets. Polls are
+        served from the shared data cache, so sessions polling in the same
+        LIVE_POLL period share one delta query. Only per sample derived
+        metrics are appended, calculated on the new samples alone. The newest
+        sample is held back until the power meter shift of the next one
+        completes it.
+
+        returns dict of dataframes by dataset name, for add_rows.
+        """
+        live = {name: recipe for name, recipe in self._recipes.items()
+                if recipe[0] in LIVE_KINDS}
+        # Metrics which depend on more than their own sample can't be
+        # calculated from the new samples alone
+        vars = [var for var in dict.fromkeys(var for _, (_, names, _)
+                                             in live.items()
+                                             for var in names)
+                if not isDerived(var) or var in materializedNames()]
+        end = pd.Timestamp.now(tz=self._live_last.tz).floor(
+            F"{LIVE_POLL}s")
+        if end <= self._live_last:
+            return {}
+        try:
+            new = _cachedWELData([self._live_last.to_pydatetime(),
+                                  end.to_pydatetime()], self.data_source)
+        except Exception as e:
+            message([F"{'Live poll failed:': <20}", F"{e}"],
+                    mssgType='ERROR')
+            return {}
+        rows = new.data[new.data.index > self._live_last].iloc[:-1]
+        if rows.empty:
+            return {}
+        # From the new rows alone, as reading them through the cached view
+        # would calculate the metrics over its whole frame
+        cols = calculate(rows, vars)
+        self._live_last = cols.index[-1]
+        rows = {name: self._liveBlock(kind, names, cols)
+                for name, (kind, names, _) in live.items()}
+        for name, (kind, base, _) in self._recipes.items():
+            if kind == 'latest' and base in rows:
+                rows[name] = rows[base].groupby('label', sort=False).tail(1)
+        # Serialized like the render's datasets
+        return {name: pd.DataFrame(alt.to_values(frame)['values'])
+                for name, frame in rows.items() if len(frame)}
+
+    def toSpec(self,
+               plot):
+        """
+        Complete a page chart to a Vega-Lite spec with the datasets registered
+        during the render at the top level. The cached chart templates are
+        copied, not validated again.
+
+        returns spec dictionary for st.vega_lite_chart.
+        """
+        with profiler.span('Spec serialization') as spec_span:
+            spec = plot.to_dict()
+            spec['$schema'] = alt.SCHEMA_URL
+            spec['datasets'] = dict(self._datasets)
+            if profiler.current() is not None:
+                spec_span.rows = sum(len(values) for values
+                                     in spec['datasets'].values())
+                spec_span.nbytes = len(json.dumps(spec))
+        return spec
+
     def _createRules(self,
                      source,
                      tooltip=True,
@@ -201,48 +754,53 @@ class StreamPlot():
 
         return selectors + rules
 
+    def _latestData(self,
+                    source,
+                    name):
+        # The last sample of each label is picked here rather than ranking
+        # every row in the browser
+        latest = self._namedData(source.groupby('label', sort=False).tail(1),
+                                 F"{name}_latest")
+        self._recipes[latest.name] = ('latest', name, None)
+        return latest
+
     def _createLatestText(self,
                           lines,
-                          field):
-
+                          field,
+                          latest):
         opacity = 0.7
-        latest_text = lines.mark_text(
+        latest_text = lines.properties(data=latest).mark_text(
             align='left',
             dx=30,
             fontSize=self.mark_text_font_size,
             opacity=opacity
-        ).transform_window(
-            rank='rank()',
-            sort=[alt.SortField('dateandtime', order='descending')]
         ).encode(
-            text=alt.condition(alt.datum.rank == 1,
-                               field,
-                               alt.value(' '),
-                               format='.1f')
+            text=alt.Text(field, format='.1f')
         )
 
-        latest_text_tick = lines.mark_tick(
+        latest_text_tick = lines.properties(data=latest).mark_tick(
             strokeDash=[1, 1],
             xOffset=15,
             size=15,
             thickness=2
-        ).transform_window(
-            rank='rank()',
-            sort=[alt.SortField('dateandtime', order='descending')]
         ).encode(
-            opacity=alt.condition(alt.datum.rank == 1,
-                                  alt.value(opacity),
-                                  alt.value(0))
+            opacity=alt.value(opacity)
         )
 
         return alt.layer(latest_text, latest_text_tick)
 
+    def _daylightData(self):
+        if 'daylight' in self._datasets:
+            self._used.add('daylight')
+        else:
+            self._namedData(self._getDataSubset('daylight'), 'daylight')
+            self._recipes['daylight'] = ('daylight', ['daylight'], 'mean')
+
     def _plotNightAlt(self,
                       height_mod=1):
-        source = self._getDataSubset('daylight')
-        area = alt.Chart(source).mark_bar(
+        area = alt.Chart(alt.NamedData(name='daylight')).mark_bar(
             fill='purple',
-            width=800 / self.resample_N,
+            width=self._bar_width,
             clip=True,
             height=self.def_height * height_mod
         ).encode(
@@ -254,113 +812,126 @@ class StreamPlot():
 
         return area
 
+    @_cachedChart
     def plotMainMonitor(self,
                         vars,
                         axis_label="Temperature / °C",
                         height_mod=1,
                         bottomPlot=False):
-        source = self._getDataSubset(vars)
+        if type(vars) is not list:
+            vars = [vars]
+        frame = self._stripUnits(self._getDataSubset(
+            vars, method=self.resample_method))
+        source = self._namedData(frame, 'lines', vars, self.resample_method)
+        latest = self._latestData(frame, source.name)
+        self._daylightData()
 
-        lines = alt.Chart(source).mark_line(
-            interpolate='basis',
-            clip=True
-        ).encode(
-            x=alt.X('dateandtime:T',
-                    # scale=alt.Scale(domain=self.resize),
-                    axis=alt.Axis(title=None,
-                                  labels=False,
-                                  grid=False,
-                                  ticks=False,
-                                  domainWidth=0)),
-            y=alt.Y('value:Q',
-                    scale=alt.Scale(zero=False),
-                    axis=alt.Axis(title=axis_label,
-                                  orient='right',
-                                  grid=True,
-                                  tickMinStep=1)),
-            color=alt.Color('new_label:N',
-                            legend=alt.Legend(title='Sensors',
-                                              orient='left',
-                                              offset=5))
-        ).transform_calculate(
-            new_label=alt.expr.slice(alt.datum.label, 0, -2)
-        )
+        def build():
+            # Splines don't pass through the kept extremes
+            interpolate = ('basis' if self.resample_method == 'mean'
+                           else 'linear')
+            lines = alt.Chart(source).mark_line(
+                interpolate=interpolate,
+                clip=True
+            ).encode(
+                x=alt.X('dateandtime:T',
+                        # scale=alt.Scale(domain=self.resize),
+                        axis=alt.Axis(title=None,
+                                      labels=False,
+                                      grid=False,
+                                      ticks=False,
+                                      domainWidth=0)),
+                y=alt.Y('value:Q',
+                        scale=alt.Scale(zero=False),
+                        axis=alt.Axis(title=axis_label,
+                                      orient='right',
+                                      grid=True,
+                                      tickMinStep=1)),
+                color=alt.Color('label:N',
+                                legend=alt.Legend(title='Sensors',
+                                                  orient='left',
+                                                  offset=5))
+            )
 
-        rule = self._createRules(lines, timetext=bottomPlot,
-                                 timetextheightmod=height_mod)
+            rule = self._createRules(lines, timetext=bottomPlot,
+                                     timetextheightmod=height_mod)
 
-        latest_text = self._createLatestText(lines, 'value:Q')
+            latest_text = self._createLatestText(lines, 'value:Q', latest)
 
-        plot = alt.layer(
-            self._plotNightAlt(), lines, rule, latest_text
-        )
+            return alt.layer(
+                self._plotNightAlt(), lines, rule, latest_text
+            )
 
-        return plot
+        return self._template(('main', tuple(vars), axis_label, height_mod,
+                               bottomPlot), build)
 
+    @_cachedChart
     def plotStatus(self):
-        status_list = ['TAH_fan_b', 'heat_1_b', 'heat_2_b', 'zone_1_b',
-                       'zone_2_b']
+        status_list = self.status_list
         source = self._getDataSubset(status_list)
         source.value = source.value % 2
+        source = self._namedData(self._stripUnits(source), 'status')
+        self._recipes[source.name] = ('status', status_list, 'mean')
+        out_source = self._namedData(
+            self._stripUnits(self._getDataSubset(
+                ['outside_T'], method=self.resample_method)),
+            'lines', ['outside_T'], self.resample_method)
+        self._daylightData()
 
-        chunks = alt.Chart(source).mark_bar(
-            width=800 / self.resample_N,
-            clip=True
-        ).encode(
-            x=alt.X('dateandtime:T',
-                    # scale=alt.Scale(domain=self.resize),
-                    axis=alt.Axis(title=None,
-                                  labels=False,
-                                  grid=False,
-                                  ticks=False,
-                                  orient='top',
-                                  offset=16)),
-            y=alt.Y('new_label:N',
-                    title=None,
-                    axis=alt.Axis(orient='right',
-                                  grid=False),
-                    sort=status_list),
-            opacity=alt.condition(alt.datum.value > 0,
-                                  alt.value(1),
-                                  alt.value(0)),
-            color=alt.Color('new_label:N', legend=None)
-        ).transform_calculate(
-            new_label=alt.expr.slice(alt.datum.label, 0, -2)
-        )
+        def build():
+            chunks = alt.Chart(source).mark_bar(
+                width=self._bar_width,
+                clip=True
+            ).encode(
+                x=alt.X('dateandtime:T',
+                        # scale=alt.Scale(domain=self.resize),
+                        axis=alt.Axis(title=None,
+                                      labels=False,
+                                      grid=False,
+                                      ticks=False,
+                                      orient='top',
+                                      offset=16)),
+                y=alt.Y('label:N',
+                        title=None,
+                        axis=alt.Axis(orient='right',
+                                      grid=False),
+                        sort=[label[:-2] for label in status_list]),
+                opacity=alt.condition(alt.datum.value > 0,
+                                      alt.value(1),
+                                      alt.value(0)),
+                color=alt.Color('label:N', legend=None)
+            )
 
-        out_source = self._getDataSubset(['outside_T'])
-        outside = alt.Chart(out_source).mark_line(
-            interpolate='basis',
-            # opacity=0.6,
-            strokeDash=[5, 2]
-        ).encode(
-            x='dateandtime:T',
-            y=alt.Y('value:Q', title='Outside / °C',
-                    axis=alt.Axis(orient='left', grid=False),
-                    scale=alt.Scale(zero=False)),
-            color=alt.value('grey')
-        )
+            outside = alt.Chart(out_source).mark_line(
+                interpolate=('basis' if self.resample_method == 'mean'
+                             else 'linear'),
+                # opacity=0.6,
+                strokeDash=[5, 2]
+            ).encode(
+                x='dateandtime:T',
+                y=alt.Y('value:Q', title='Outside / °C',
+                        axis=alt.Axis(orient='left', grid=False),
+                        scale=alt.Scale(zero=False)),
+                color=alt.value('grey')
+            )
 
-        rule = self._createRules(outside, timetext=True, timetexttop=True,
-                                 timetextheightmod=self.stat_height_mod)
+            rule = self._createRules(outside, timetext=True,
+                                     timetexttop=True,
+                                     timetextheightmod=self.stat_height_mod)
 
-        plot = alt.layer(
-            self._plotNightAlt(), chunks, outside, rule
-        ).resolve_scale(y='independent')
+            return alt.layer(
+                self._plotNightAlt(), chunks, outside, rule
+            ).resolve_scale(y='independent')
 
-        return plot
+        return self._template(('status', tuple(status_list)), build)
 
+    @_cachedChart
     def plotRollMean(self,
                      vars,
                      axis_label="COP Rolling Mean",
                      height_mod=1,
                      disp_raw=True,
                      bottomPlot=False):
-        if "COP" in vars:
-            scale = alt.Scale(zero=False, domain=[1, 4])
-        else:
-            scale = alt.Scale(zero=False)
-
         source = self._getDataSubset(vars)
 
         # number of hours desired in rolling * samples/hour
@@ -373,72 +944,89 @@ class StreamPlot():
                                            .iloc[-rolling_frame]}, index=[0])
         except IndexError:
             message(["Rolling frame IndexError:", F"{-rolling_frame}"],
-                    tbl=self.mssg_tbl, mssgType='WARNING')
+                    mssgType='WARNING')
             rolling_source = pd.DataFrame({'rolling_limit': source.dateandtime
-                                           .iloc[-1]}, index=[0])
-        lines = alt.Chart(source).transform_window(
-            rollmean='mean(value)',
-            frame=[-rolling_frame, 0]
-        ).mark_line(
-            interpolate='basis',
-            strokeWidth=2
-        ).encode(
-            x=alt.X('dateandtime:T',
-                    # scale=alt.Scale(domain=self.resize),
-                    axis=alt.Axis(grid=False,
-                                  labels=False,
-                                  ticks=False),
-                    title=None),
-            y=alt.Y('rollmean:Q',
-                    scale=scale,
-                    axis=alt.Axis(orient='right',
-                                  grid=True),
-                    title=axis_label),
-            color=alt.Color('label', legend=alt.Legend(title='Efficiencies',
-                                                       orient='left',
-                                                       offset=5))
-        )
-
-        window_line = alt.Chart(rolling_source).mark_rule(
-            strokeDash=[5, 5],
-        ).encode(
-            x='rolling_limit:T',
-            color=alt.ColorValue('gold')
-        )
+                                           .iloc[-1:]}).reset_index(drop=True)
+        # Trailing mean over the window, per label
+        rollmean = [pd.Series(dtype=np.float64)]
+        for label, values in source.groupby('label', sort=False)['value']:
+            values = values.rolling(rolling_frame + 1, min_periods=1).mean()
+            if self.compact_encoding:
+                values = values.round(_decimals(label))
+            rollmean.append(values)
+        source['rollmean'] = pd.concat(rollmean)
+        data = self._namedData(source, 'roll', vars)
+        limit = self._namedData(rolling_source, 'roll_limit', vars)
+        latest = self._latestData(source, data.name)
+        self._daylightData()
 
-        rule = self._createRules(lines, field='rollmean:Q',
-                                 timetext=bottomPlot,
-                                 timetextheightmod=height_mod)
-
-        latest_text = self._createLatestText(lines, 'rollmean:Q')
+        def build():
+            if "COP" in vars:
+                scale = alt.Scale(zero=False, domain=[1, 4])
+            else:
+                scale = alt.Scale(zero=False)
 
-        if disp_raw:
-            raw_lines = alt.Chart(source).mark_line(
+            lines = alt.Chart(data).mark_line(
                 interpolate='basis',
-                strokeWidth=2,
-                strokeDash=[1, 2],
-                opacity=0.8,
-                clip=True
+                strokeWidth=2
             ).encode(
-                x=alt.X('dateandtime:T'),
-                y=alt.Y('value:Q'),
-                color='label'
+                x=alt.X('dateandtime:T',
+                        # scale=alt.Scale(domain=self.resize),
+                        axis=alt.Axis(grid=False,
+                                      labels=False,
+                                      ticks=False),
+                        title=None),
+                y=alt.Y('rollmean:Q',
+                        scale=scale,
+                        axis=alt.Axis(orient='right',
+                                      grid=True),
+                        title=axis_label),
+                color=alt.Color('label:N',
+                                legend=alt.Legend(title='Efficiencies',
+                                                  orient='left',
+                                                  offset=5))
             )
 
-            plot = alt.layer(
-                self._plotNightAlt(), lines, raw_lines, rule, latest_text,
-                window_line
+            window_line = alt.Chart(limit).mark_rule(
+                strokeDash=[5, 5],
+            ).encode(
+                x='rolling_limit:T',
+                color=alt.ColorValue('gold')
             )
 
-            return plot
+            rule = self._createRules(lines, field='rollmean:Q',
+                                     timetext=bottomPlot,
+                                     timetextheightmod=height_mod)
 
-        plot = alt.layer(
-            self._plotNightAlt(), lines, rule, latest_text,
-            window_line
-        )
+            latest_text = self._createLatestText(lines, 'rollmean:Q', latest)
+
+            if disp_raw:
+                raw_lines = alt.Chart(data).mark_line(
+                    interpolate='basis',
+                    strokeWidth=2,
+                    strokeDash=[1, 2],
+                    opacity=0.8,
+                    clip=True
+                ).encode(
+                    x=alt.X('dateandtime:T'),
+                    y=alt.Y('value:Q'),
+                    color='label:N'
+                )
+
+                return alt.layer(
+                    self._plotNightAlt(), lines, raw_lines, rule,
+                    latest_text, window_line
+                )
+
+            return alt.layer(
+                self._plotNightAlt(), lines, rule, latest_text,
+                window_line
+            )
 
-        return plot
+        return self._template(('roll', tuple(vars), axis_label, height_mod,
+                               disp_raw, bottomPlot), build)
 
+    @_cachedChart
     def plotPowerStack(self,
                        vars,
                        axis_label="Power / kW",
@@ -453,48 +1041,55 @@ class StreamPlot():
         #                                                       'value']
         # except KeyError:
         #     pass
-        order = (str({label: idx for label, idx in enumerate(vars)})
-                 + "[datum.label]")
-        area = alt.Chart(source).mark_area(
-            interpolate='basis',
-            clip=True,
-            opacity=0.9
-        ).encode(
-            x=alt.X('dateandtime:T',
-                    # scale=alt.Scale(domain=self.resize),
-                    axis=alt.Axis(title=None,
-                                  labels=False,
-                                  grid=False,
-                                  ticks=False,
-                                  domainWidth=0)),
-            y=alt.Y('value:Q',
-                    scale=alt.Scale(zero=False),
-                    axis=alt.Axis(title=axis_label,
-                                  orient='right',
-                                  grid=True)),
-            order="order:O",
-            color=alt.Color('new_label:N',
-                            legend=alt.Legend(title='Sensors',
-                                              orient='left',
-                                              offset=5),
-                            sort=vars)
-        ).transform_calculate(
-            new_label=alt.expr.slice(alt.datum.label, 0, -2)
-        ).transform_calculate(
-            order=order
-        )
+        if self.compact_encoding:
+            source['value'] = source['value'].round(3)
+        source['order'] = source['label'].map({label: idx for idx, label
+                                               in enumerate(vars)})
+        frame = self._stripUnits(source)
+        source = self._namedData(frame, 'power', vars)
+        latest = self._latestData(frame, source.name)
+        self._daylightData()
 
-        rule = self._createRules(area, tooltip=False, timetext=bottomPlot,
-                                 timetextheightmod=height_mod)
+        def build():
+            area = alt.Chart(source).mark_area(
+                interpolate='basis',
+                clip=True,
+                opacity=0.9
+            ).encode(
+                x=alt.X('dateandtime:T',
+                        # scale=alt.Scale(domain=self.resize),
+                        axis=alt.Axis(title=None,
+                                      labels=False,
+                                      grid=False,
+                                      ticks=False,
+                                      domainWidth=0)),
+                y=alt.Y('value:Q',
+                        scale=alt.Scale(zero=False),
+                        axis=alt.Axis(title=axis_label,
+                                      orient='right',
+                                      grid=True)),
+                order="order:O",
+                color=alt.Color('label:N',
+                                legend=alt.Legend(title='Sensors',
+                                                  orient='left',
+                                                  offset=5),
+                                sort=[label[:-2] for label in vars])
+            )
 
-        latest_text = self._createLatestText(area, 'value:Q')
+            rule = self._createRules(area, tooltip=False,
+                                     timetext=bottomPlot,
+                                     timetextheightmod=height_mod)
 
-        plot = alt.layer(
-            self._plotNightAlt(), area, rule, latest_text
-        )
+            latest_text = self._createLatestText(area, 'value:Q', latest)
 
-        return plot
+            return alt.layer(
+                self._plotNightAlt(), area, rule, latest_text
+            )
+
+        return self._template(('power', tuple(vars), axis_label, height_mod,
+                               bottomPlot), build)
 
+    @_cachedChart
     def plotNonTime(self,
                     id_var,
                     vars):
@@ -506,37 +1101,33 @@ class StreamPlot():
         source['heat'] = source['heat'].astype('str')
         source = source.dropna()
 
-        rolling_frame = (1 * self.resample_N
-                         / (self.resample_N * self.resample_T).total_seconds()
-                         / 3600)
-        rolling_frame = int(np.clip(rolling_frame, self.resample_N / 15,
-                                    self.resample_N / 2))
+        source = self._namedData(source, F"nontime_{id_var}", vars)
 
-        points = alt.Chart(source).transform_window(
-            rollmean='mean(value)',
-            frame=[-rolling_frame, 0]
-        ).mark_point().encode(
-            x=alt.X(F"{id_var}:Q", scale=alt.Scale(zero=False)),
-            y=alt.Y("value:Q", axis=alt.Axis(title=vars)),
-            color='heat:N'
-        )
+        def build():
+            points = alt.Chart(source).mark_point().encode(
+                x=alt.X(F"{id_var}:Q", scale=alt.Scale(zero=False)),
+                y=alt.Y("value:Q", axis=alt.Axis(title=vars)),
+                color='heat:N'
+            )
+
+            # reg = points.transform_regression(
+            #     F"{id_var}",
+            #     "value",
+            #     method='exp',
+            # ).mark_line().encode(color=alt.ColorValue('black'))
+
+            # reg_params = points.transform_regression(
+            #     F"{id_var}",
+            #     "value",
+            #     method='exp',
+            #     params=True
+            # ).mark_text(align='left').encode(
+            #     x=alt.value(20),  # pixels from left
+            #     y=alt.value(20),  # pixels from top
+            #     text=alt.Text('rSquared:N', format='.4f'),
+            #     color=alt.ColorValue('black')
+            # )
+
+            return points
 
-        # reg = points.transform_regression(
-        #     F"{id_var}",
-        #     "value",
-        #     method='exp',
-        # ).mark_line().encode(color=alt.ColorValue('black'))
-
-        # reg_params = points.transform_regression(
-        #     F"{id_var}",
-        #     "value",
-        #     method='exp',
-        #     params=True
-        # ).mark_text(align='left').encode(
-        #     x=alt.value(20),  # pixels from left
-        #     y=alt.value(20),  # pixels from top
-        #     text=alt.Text('rSquared:N', format='.4f'),
-        #     color=alt.ColorValue('black')
-        # )
-
-        return points
+        return self._template(('nontime', id_var, str(vars)), build)
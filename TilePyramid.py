@@ -0,0 +1,510 @@
+import argparse
+import threading
+import warnings
+from collections import OrderedDict
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pytz import timezone
+from log_message import message
+from config import TO_TZONE
+import profiler
+from WELData import WELData, mongoConnect, nextDataVersion
+from derived_metrics import (METRICS_VERSION, MetricFrame, isDerived,
+                             materializedNames, metricNames, rawInputs)
+from RunningStats import RunningStats, INPUTS as STATS_INPUTS
+
+"""
+Pyramid of pre-aggregated time tiles for long range views, stored in the
+tiles collection. Level L has buckets of BASE_WIDTH * 2**L aligned to the
+epoch, and each tile holds TILE_BUCKETS of them with the min, mean, max and
+sample count of every raw column and per sample derived metric. A range is
+read at the coarsest level still giving n_out buckets, from a handful of
+tiles, instead of pulling every raw sample. StreamPlot reads ranges longer
+than MIN_RANGE from tiles.
+
+Tiles up to RAW_LEVEL are aggregated from the raw data, coarser ones by
+merging their two children, so no build holds more than RAW_LEVEL's span of
+samples. Tiles which ended before SETTLE ago are immutable, until
+METRICS_VERSION changes. The current tiles are rebuilt when older than
+REFRESH. Run as a script to build the history ahead of the first views:
+
+python3 TilePyramid.py --build [--start 2020-03-21] [--level 10]
+"""
+BASE_WIDTH = 30             # seconds
+TILE_BUCKETS = 256
+RAW_LEVEL = 5               # tiles of ~2.8 days
+MAX_LEVEL = 12              # tiles of ~1 year
+STATS = ['min', 'mean', 'max', 'count']
+SETTLE = dt.timedelta(minutes=5)
+REFRESH = dt.timedelta(minutes=5)
+MEMO_TILES = 64
+MIN_RANGE = dt.timedelta(days=31)
+DB_TZONE = timezone('UTC')
+FIRST_DAY = dt.datetime(2020, 3, 21, tzinfo=DB_TZONE)
+
+
+def bucketWidth(level):
+    return BASE_WIDTH * 2**level
+
+
+def tileSpan(level):
+    return bucketWidth(level) * TILE_BUCKETS
+
+
+def pickLevel(timerange,
+              n_out):
+    """
+    Returns the coarsest level with at least n_out buckets in timerange.
+    """
+    seconds = (timerange[1] - timerange[0]).total_seconds() / max(n_out, 1)
+    level = int(np.floor(np.log2(max(seconds / BASE_WIDTH, 1))))
+    return min(level, MAX_LEVEL)
+
+
+class _Tile:
+    """
+    Stats of one tile as arrays of TILE_BUCKETS rows by field.
+    """
+    level = None
+    index = None
+    fields = None
+    stats = None
+    complete = None
+    built = None
+
+    def __init__(self,
+                 level,
+                 index,
+                 fields,
+                 stats,
+                 complete,
+                 built):
+        self.level = level
+        self.index = index
+        self.fields = fields
+        self.stats = stats
+        self.complete = complete
+        self.built = built
+
+    @property
+    def start(self):
+        return self.index * tileSpan(self.level)
+
+    def toDoc(self):
+        doc = {'_id': F"{self.level}:{self.index}",
+               'level': self.level,
+               'index': self.index,
+               'start': dt.datetime.fromtimestamp(self.start, DB_TZONE),
+               'complete': self.complete,
+               'built': self.built,
+               'calc_version': METRICS_VERSION,
+               'fields': self.fields}
+        for stat in STATS:
+            # Columns per field, with None for empty buckets
+            doc[stat] = [[None if np.isnan(value) else float(value)
+                          for value in column]
+                         for column in self.stats[stat].T]
+        return doc
+
+    @classmethod
+    def fromDoc(cls,
+                doc):
+        stats = {stat: np.array(doc[stat], dtype=np.float64).T
+                 .reshape(TILE_BUCKETS, len(doc['fields']))
+                 for stat in STATS}
+        return cls(doc['level'], doc['index'], doc['fields'], stats,
+                   doc['complete'], doc['built'].replace(tzinfo=DB_TZONE))
+
+    def frames(self):
+        """
+        Returns a dataframe per stat, indexed by bucket start time.
+        """
+        index = pd.to_datetime(self.start
+                               + np.arange(TILE_BUCKETS)
+                               * bucketWidth(self.level),
+                               unit='s', utc=True)
+        return {stat: pd.DataFrame(self.stats[stat], index=index,
+                                   columns=self.fields)
+                for stat in STATS}
+
+
+def _aggregate(frame,
+               level,
+               index):
+    # Bucket a raw frame into the stats arrays of a tile
+    width = bucketWidth(level)
+    frame = frame.select_dtypes(include=['number', 'bool']).drop(
+        columns=['calc_version'], errors='ignore').astype(np.float64)
+    seconds = frame.index.asi8 // 1_000_000_000
+    position = (seconds - index * tileSpan(level)) // width
+    grouped = frame.groupby(position)
+    stats = {}
+    for stat in STATS:
+        agg = grouped.agg(stat).reindex(range(TILE_BUCKETS))
+        if stat == 'count':
+            agg = agg.fillna(0)
+        stats[stat] = agg.to_numpy(dtype=np.float64)
+    return list(frame.columns), stats
+
+
+def _merge(children):
+    # Merge two consecutive tiles of one level into their parent's buckets,
+    # each parent bucket covering two child buckets
+    fields = list(dict.fromkeys(field for child in children
+                                for field in child.fields))
+    stats = {}
+    for stat in STATS:
+        fill = 0 if stat == 'count' else np.nan
+        columns = [pd.DataFrame(child.stats[stat], columns=child.fields)
+                   .reindex(columns=fields, fill_value=fill).to_numpy()
+                   for child in children]
+        stats[stat] = np.concatenate(columns).reshape(TILE_BUCKETS, 2,
+                                                      len(fields))
+    count = stats['count'].sum(axis=1)
+    total = np.nansum(stats['mean'] * stats['count'], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, np.nan)
+    with warnings.catch_warnings():
+        # All NaN buckets are expected and stay NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        low = np.nanmin(stats['min'], axis=1)
+        high = np.nanmax(stats['max'], axis=1)
+    return fields, {'min': low, 'mean': mean, 'max': high, 'count': count}
+
+
+def _bucketNames(names):
+    # Derived metrics which aren't per sample, e.g. daily rain totals, aren't
+    # kept in tiles and are calculated from the bucket means instead
+    return [name for name in names
+            if isDerived(name) and name not in materializedNames()]
+
+
+def _withBucketMetrics(means,
+                       names):
+    metrics = MetricFrame(means)
+    bucketed = _bucketNames(names)
+    return pd.DataFrame({name: metrics[name] for name in names
+                         if name in means.columns
+                         or (name in bucketed and name in metrics)},
+                        index=means.index)
+
+
+def _emptyStats():
+    return {stat: np.full((TILE_BUCKETS, 0), 0 if stat == 'count' else np.nan)
+            for stat in STATS}
+
+
+class TileData:
+    """
+    Read only stand in for a WELData view of a range read from tiles. data are
+    the bucket means, getCols can also return the min, max or sample count.
+    Derived metrics which aren't per sample are calculated from the bucket
+    means.
+
+    stats : dataframe per stat, indexed by bucket start time.
+    timerange : start and end datetimes.
+    level : pyramid level of the buckets.
+    """
+    data = None
+    timerange = None
+    level = None
+    stats = None
+    _data_version = None
+
+    def __init__(self,
+                 stats,
+                 timerange,
+                 level):
+        self.stats = stats
+        self.data = stats['mean']
+        self.timerange = list(timerange)
+        self.level = level
+        # Current tiles may have been rebuilt, so every read is new data
+        self._data_version = nextDataVersion()
+
+    def dataVersion(self):
+        return self._data_version
+
+    def vars(self):
+        return (list(self.data.columns)
+                + [name for name in _bucketNames(metricNames())
+                   if name not in self.data.columns])
+
+    def getCols(self,
+                names,
+                stat='mean'):
+        frame = self.stats[stat]
+        if stat == 'mean':
+            return _withBucketMetrics(frame, names)
+        return frame[[name for name in names if name in frame.columns]]
+
+    def getCol(self,
+               name,
+               stat='mean'):
+        col = self.getCols([name], stat)
+        if name not in col:
+            raise KeyError(name)
+        return col[name]
+
+    def resampled(self,
+                  names,
+                  width):
+        """
+        Returns the bucket means of names in buckets of width seconds, a
+        multiple of the level's bucket width, weighing each bucket by its
+        sample count. The level's own width returns the tiles' buckets as
+        they are.
+        """
+        if width == bucketWidth(self.level):
+            return self.getCols(names)
+        # Bucket metrics are calculated after merging their inputs
+        stored = [name for name in dict.fromkeys(
+                      names + rawInputs(_bucketNames(names)))
+                  if name in self.data.columns]
+        means = self.data[stored]
+        counts = self.stats['count'][stored]
+        seconds = means.index.asi8 // 1_000_000_000 // width * width
+        total = (means * counts).groupby(seconds).sum(min_count=1)
+        count = counts.groupby(seconds).sum()
+        out = total / count.where(count > 0)
+        out.index = pd.to_datetime(out.index, unit='s', utc=True)
+        out.index.name = 'dateandtime'
+        return _withBucketMetrics(out, names)
+
+    def envelope(self,
+                 name):
+        """
+        Returns the bucket minimums at bucket starts and maximums at bucket
+        middles as one series, for min/max downsampling.
+        """
+        low = self.getCol(name, 'min')
+        high = self.getCol(name, 'max')
+        high.index = high.index + dt.timedelta(
+            seconds=bucketWidth(self.level) / 2)
+        return pd.concat((low, high)).sort_index()
+
+    def runningStats(self):
+        """
+        Returns RunningStats over the bucket means, each weighing its sample
+        count.
+        """
+        means = self.getCols(STATS_INPUTS)
+        return RunningStats.empty().update(
+            means, counts=self.getCols(list(means.columns), 'count'),
+            width=bucketWidth(self.level))
+
+    def memoryUsage(self):
+        return int(sum(frame.memory_usage(index=True).sum()
+                       for frame in self.stats.values()))
+
+
+class TilePyramid:
+    """
+    Reads and lazily builds the tiles of a mongo database, keeping the most
+    recently read ones in memory.
+
+    mongo_db : database with the data and tiles collections.
+    """
+    _mongo_db = None
+    _memo = None
+    _flights = None
+    _lock = None
+    _to_tzone = TO_TZONE
+
+    def __init__(self,
+                 mongo_db):
+        self._mongo_db = mongo_db
+        self._memo = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _isComplete(self,
+                    level,
+                    index,
+                    now):
+        end = (index + 1) * tileSpan(level)
+        return end <= (now - SETTLE).timestamp()
+
+    def getTile(self,
+                level,
+                index,
+                now=None):
+        """
+        Returns a tile from memory, the tiles collection, or built, building
+        current tiles again when older than REFRESH or since completed. Single
+        flight: concurrent calls for a tile wait for the first one and share
+        its tile.
+        """
+        if now is None:
+            now = dt.datetime.now(DB_TZONE)
+        key = (level, index)
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    self._flights[key] = threading.Event()
+                    break
+            flight.wait()
+        try:
+            return self._getTile(level, index, now)
+        finally:
+            with self._lock:
+                self._flights.pop(key).set()
+
+    def _getTile(self,
+                 level,
+                 index,
+                 now):
+        key = (level, index)
+        with self._lock:
+            tile = self._memo.get(key)
+        if tile is None:
+            doc = self._mongo_db.tiles.find_one({'_id': F"{level}:{index}"})
+            if doc is not None and doc['calc_version'] == METRICS_VERSION:
+                tile = _Tile.fromDoc(doc)
+        if tile is None or (not tile.complete
+                            and (now - tile.built > REFRESH
+                                 or self._isComplete(level, index, now))):
+            tile = self._build(level, index, now)
+        with self._lock:
+            self._memo[key] = tile
+            self._memo.move_to_end(key)
+            while len(self._memo) > MEMO_TILES:
+                self._memo.popitem(last=False)
+        return tile
+
+    def _build(self,
+               level,
+               index,
+               now):
+        if index * tileSpan(level) > now.timestamp():
+            fields, stats = [], _emptyStats()
+        elif level <= RAW_LEVEL:
+            fields, stats = self._fromRaw(level, index)
+        else:
+            fields, stats = _merge([self.getTile(level - 1, 2 * index + i,
+                                                 now)
+                                    for i in range(2)])
+        tile = _Tile(level, index, fields, stats,
+                     self._isComplete(level, index, now), now)
+        self._mongo_db.tiles.replace_one({'_id': F"{level}:{index}"},
+                                         tile.toDoc(), upsert=True)
+        return tile
+
+    def _fromRaw(self,
+                 level,
+                 index):
+        start = dt.datetime.fromtimestamp(index * tileSpan(level), DB_TZONE)
+        end = start + dt.timedelta(seconds=tileSpan(level))
+        # Only a period without samples is an empty tile, failed loads raise
+        # so the tile is built again on the next read
+        if self._mongo_db.data.find_one({'dateandtime': {'$gte': start,
+                                                         '$lt': end}},
+                                        {'_id': 1}) is None:
+            return [], _emptyStats()
+        # One sample past the end completes the power meter shift of the
+        # last sample
+        dat = WELData(timerange=[start,
+                                 end + dt.timedelta(seconds=BASE_WIDTH)],
+                      mongo_connection=self._mongo_db)
+        names = list(dict.fromkeys(list(dat.data.columns)
+                                   + materializedNames()))
+        frame = dat.getCols(names)
+        frame = frame[frame.index < end]
+        return _aggregate(frame, level, index)
+
+    def read(self,
+             timerange,
+             n_out):
+        """
+        Returns a TileData of timerange with at least n_out buckets, from the
+        coarsest level giving them.
+
+        timerange : start and end datetimes, naive ones are local time.
+        n_out : bucket budget.
+        """
+        timerange = [self._to_tzone.localize(time)
+                     if time.tzinfo is None else time
+                     for time in timerange]
+        level = pickLevel(timerange, n_out)
+        span = tileSpan(level)
+        now = dt.datetime.now(DB_TZONE)
+        with profiler.span('Tile read') as read_span:
+            frames = [self.getTile(level, index, now).frames()
+                      for index in range(int(timerange[0].timestamp()
+                                             // span),
+                                         int(timerange[1].timestamp()
+                                             // span) + 1)]
+            # Keep the bucket containing the start
+            start = timerange[0] - dt.timedelta(seconds=bucketWidth(level))
+            stats = {}
+            for stat in STATS:
+                frame = pd.concat([tile[stat] for tile in frames])
+                if stat == 'count':
+                    frame = frame.fillna(0)
+                frame = frame[(frame.index > start)
+                              & (frame.index <= timerange[1])]
+                frame.index.name = 'dateandtime'
+                stats[stat] = frame
+            read_span.rows = len(stats['mean'])
+        return TileData(stats, timerange, level)
+
+
+def build(mongo_db,
+          level=MAX_LEVEL,
+          start=FIRST_DAY,
+          end=None):
+    """
+    Build the tiles of a level over a range, along with the finer levels down
+    to RAW_LEVEL they are merged from.
+
+    optional level : pyramid level to build.
+    optional start : first day to build. Default first day of data.
+    optional end : last day to build. Default now.
+    """
+    if end is None:
+        end = dt.datetime.now(DB_TZONE)
+    pyramid = TilePyramid(mongo_db)
+    span = tileSpan(level)
+    for index in range(int(start.timestamp() // span),
+                       int(end.timestamp() // span) + 1):
+        tile = pyramid.getTile(level, index)
+        message([F"{'Tile built:': <20}",
+                 F"{level}:{index} from "
+                 F"{dt.datetime.fromtimestamp(tile.start, DB_TZONE):%Y-%m-%d}"
+                 F", {int(tile.stats['count'].sum())} samples"],
+                mssgType='ADMIN')
+    message(F"Tiles of level {level} built", mssgType='SUCCESS')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--build', action='store_true',
+                        help='build the tiles for history.')
+    parser.add_argument('--level', type=int, action='store',
+                        default=MAX_LEVEL,
+                        help='pyramid level to build, with the finer levels '
+                             'it is merged from.')
+    parser.add_argument('--start', type=str, action='store',
+                        help='first day to build as iso string.')
+    parser.add_argument('--end', type=str, action='store',
+                        help='last day to build as iso string.')
+    args = parser.parse_args()
+
+    if args.build:
+        start = FIRST_DAY
+        end = None
+        if args.start:
+            start = (dt.datetime.fromisoformat(args.start)
+                     .replace(tzinfo=DB_TZONE))
+        if args.end:
+            end = (dt.datetime.fromisoformat(args.end)
+                   .replace(tzinfo=DB_TZONE))
+        build(mongoConnect(), level=args.level, start=start, end=end)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
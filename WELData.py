@@ -4,16 +4,35 @@ import numpy as np
 import datetime as dt
 import os
 import platform
-import re
 import argparse
+import itertools
 from dateutil.relativedelta import relativedelta
 from wget import download
 from urllib.error import HTTPError
 from shutil import move
+from copy import copy
 from astral import sun, LocationInfo
 from pymongo import MongoClient
 from pytz import timezone
 from log_message import message
+from config import TO_TZONE
+import profiler
+from derived_metrics import MetricFrame, calculate, metricNames, rawInputs
+from var_expr import compileExpr, evaluateExprs, remOffset
+from RunningStats import RunningStats, INPUTS as STATS_INPUTS
+from downsample import bucketMeans
+from backends import backendFor, readLog, compactFrame
+
+# Data versions are unique across objects, so they also identify the data
+_versions = itertools.count(1)
+
+
+def nextDataVersion():
+    """
+    Returns a new data version, shared with every other holder of loaded
+    data, such as tile reads, so versions never collide between them.
+    """
+    return next(_versions)
 
 
 def mongoConnect():
@@ -44,11 +63,20 @@ class WELData:
                         42.485557, -71.433445)
     _dl_db_path = None
     _db_tzone = timezone('UTC')
-    _to_tzone = timezone('America/New_York')
-    _mongo_db = None
+    _to_tzone = TO_TZONE
+    _backend = None
     _data_source = None
     _now = None
     _calc_cols = None
+    _columns = None
+    _compact = None
+    _data_version = 0
+    _derived_memo = None
+    _derived_memo_version = None
+    _running_stats = None
+    _running_stats_version = None
+    _parent = None
+    _rows = None
     data = None
     timerange = None
 
@@ -56,6 +84,14 @@ class WELData:
     Initialize the Weldata Object.
     If filepath is given, data will be read from the file, otherwise this
     month's log is downloaded and read.
+
+    optional data_source : 'Pi', 'WEL', 'Parquet', 'Synthetic' or a Backend,
+                           see backends. Default 'Pi'.
+    optional parquet_path : directory of the 'Parquet' source's day files.
+    optional columns : only fetch the raw columns needed for these column and
+                       derived metric names. Default fetches everything.
+    optional compact : cast loaded columns to compact dtypes, see
+                       backends.dtypePlan. Default True.
     """
     def __init__(self,
                  data_source='Pi',
@@ -63,8 +99,13 @@ class WELData:
                  WEL_download=False,
                  dl_db_path='../log_db/',
                  mongo_connection=None,
-                 calc_cols=True):
+                 calc_cols=True,
+                 columns=None,
+                 parquet_path='../parquet_db/',
+                 compact=True):
         self._calc_cols = calc_cols
+        self._columns = columns
+        self._compact = compact
         self._data_source = data_source
         self._dl_db_path = dl_db_path
         self._now = dt.datetime.now().astimezone(self._to_tzone)
@@ -74,9 +115,12 @@ class WELData:
             self.timerange = self.time_from_args(timerange)
         else:
             self.timerange = self.timeCondition(timerange)
-        self.timerange = [time.replace(tzinfo=self._to_tzone)
-                          if time.tzinfo is None else time
-                          for time in self.timerange]
+        self.timerange = self._localize(self.timerange)
+
+        if self._data_source == 'Pi' and mongo_connection is None:
+            mongo_connection = mongoConnect()
+        self._backend = backendFor(self._data_source, mongo_connection,
+                                   self._dl_db_path, parquet_path)
 
         if self._data_source == 'WEL':
             self.refresh_db()
@@ -90,17 +134,7 @@ class WELData:
                 downfile = download(dat_url, downfilepath)
                 if os.path.exists(downfilepath):
                     move(downfile, downfilepath)
-
-            self._stitch()
-        elif self._data_source == 'Pi':
-            if mongo_connection is None:
-                self._mongo_db = mongoConnect()
-            else:
-                self._mongo_db = mongo_connection
-            self._stitch()
-        else:
-            message("Valid data sources are 'Pi' or 'WEL'", mssgType='WARNING')
-            quit()
+        self._stitch()
 
     def time_from_args(self,
                        arg_string=None):
@@ -127,124 +161,39 @@ class WELData:
         return self.timeCondition(timerange)
 
     """
-    From a filepath, load that data.
-    Columns with all NaNs are dropped.
+    Returns timerange with naive datetimes taken as local time. pytz zones
+    must localize, replacing tzinfo would give the zone's LMT offset.
+    """
+    def _localize(self,
+                  timerange):
+        return [self._to_tzone.localize(time) if time.tzinfo is None
+                else time for time in timerange]
 
-    ADDED COLUMNS:
-    dateandtime : combined datetime object for each row.
-    power_tot : TAH_W + HP_W
-    T_diff : living_T - outside_T
-    eff_ma : day length rolling average of efficiency
+    """
+    Returns a UTC index in local time, for display.
+    """
+    def _localTime(self,
+                   index):
+        return index.tz_convert(self._to_tzone)
+
+    """
+    From a filepath, load that data, indexed by the combined date and time of
+    each row. See backends.readLog.
 
     filepath : filepath for data file.
-    keepdata : boolean keep downloaded data file. Default False.
     """
     def read_log(self,
                  filepath):
-        try:
-            data = pd.read_excel(filepath)
-        except Exception:
-            data = pd.read_csv(filepath, sep='\t',
-                               index_col=False, na_values=['?'])
-
-        for col in data.columns:
-            if ('Date' not in col) and ('Time' not in col):
-                data[col] = data[col].astype(np.float64)
-
-        data.Date = data.Date.apply(lambda date:
-                                    dt.datetime.strptime(date, "%m/%d/%Y"))
-        data.Time = data.Time.apply(lambda time:
-                                    dt.datetime.strptime(time,
-                                                         "%H:%M:%S").time())
-
-        data['dateandtime'] = [dt.datetime.combine(date, time)
-                               for date, time in zip(data.Date,
-                                                     data.Time)]
-        data.index = data['dateandtime']
-        data = data.tz_localize(timezone('EST'))
-        data = data.tz_convert(self._to_tzone)
-        data.drop(columns=['Date', 'Time'])
-
-        if self._calc_cols:
-            data = pd.concat((data, self._calced_cols(data)), axis=1)
-
-        return data
+        return readLog(filepath)
 
+    """
+    Calculate every derived metric which the columns of frame allow, without
+    modifying frame. Plotting should use getCols, which only calculates what is
+    asked for.
+    """
     def _calced_cols(self,
                      frame):
-        out_frame = pd.DataFrame()
-        heat_mask = frame.heat_1_b % 2
-        heat_mask[heat_mask == 0] = np.nan
-
-        # Additional calculated columns
-        frame['power_tot'] = frame.TAH_W + frame.HP_W
-        try:
-            out_frame['geo_tot_w'] = frame.Emp_TAH_w + frame.Emp_TES_w
-
-        except AttributeError:
-            out_frame['geo_tot_w'] = frame.power_tot
-        try:
-            out_frame['base_load_w'] = np.abs(frame.Emp_Total_w
-                                              - out_frame['geo_tot_w']
-                                              - frame['Emp_Tesla_w']
-                                              - frame['Emp_Dehumid+Washer_w']
-                                              - frame['Emp_Dryer_w']
-                                              - frame['Emp_Barn_w'])
-        except AttributeError or KeyError:
-            pass
-        try:
-            out_frame['T_diff'] = np.abs(np.nanmean([frame.fireplace_T,
-                                                     frame.D_room_T,
-                                                     frame.V_room_T,
-                                                     frame.T_room_T])
-                                         - frame.outside_T)
-        except AttributeError:
-            try:
-                out_frame['T_diff'] = np.abs(frame.living_T
-                                             - frame.outside_T)
-            except AttributeError:
-                out_frame['T_diff'] = np.nan
-
-        # COP calculation
-        air_density = 1.15  # kg/m^3
-        surface_area = 0.34  # m^2
-        heat_capacity = 1.01  # J/kg
-        COP = (((air_density * surface_area * heat_capacity * frame.TAH_fpm)
-                * (np.abs(frame.TAH_out_T - frame.TAH_in_T)))
-               / (frame.power_tot / 1000))
-        COP[COP > 4] = np.nan
-        COP = COP * heat_mask
-        out_frame['COP'] = COP
-        # WEL COP calculation
-        heat_2_mask = frame.heat_2_b % 2
-        well_gpm = np.full(len(frame.loop_out_T), 13.6)  # gal/min
-        well_gpm_h2 = np.full(len(frame.loop_out_T), 14.4)  # during heat 2
-        well_gpm = ((well_gpm * (1 - heat_2_mask))
-                    + (well_gpm_h2 * heat_2_mask))
-        gpm_to_lps = 0.064  # min L/ gal sec
-        heat_cap_glycol = 3.65  # J/kg
-        out_frame['well_W'] = ((well_gpm * gpm_to_lps) * heat_cap_glycol
-                               * (np.abs(frame.loop_out_T - frame.loop_in_T)))
-        well_COP = out_frame.well_W / (frame.power_tot / 1000)
-        well_COP[well_COP > 4] = np.nan
-        well_COP = well_COP * heat_mask
-        out_frame['well_COP'] = well_COP
-
-        out_frame['T_diff_eff'] = ((out_frame.geo_tot_w
-                                    * out_frame['COP'].fillna(0)
-                                    + out_frame['base_load_w'])
-                                   / out_frame.T_diff)
-
-        # Reset rain accumulation every 24 hrs
-        try:
-            rain_offset = (frame.groupby(frame.index.date)['weather_station_R']
-                           .transform(lambda x: np.mean(x.iloc[-10:-1])))
-            out_frame['rain_accum_R'] = (frame['weather_station_R']
-                                         - rain_offset)
-        except KeyError:
-            message("Weather station rain data not present in selection",
-                    mssgType='WARNING')
-        return out_frame
+        return calculate(frame)
 
     """
     Check if the last month's log has been downloaded, and download if not.
@@ -295,69 +244,227 @@ class WELData:
         [self.check_dl_db(month=month, forcedl=forcedl) for month in monthlist]
 
     """
-    Load correct months of data based on timerange.
+    Load the timerange from the data source's backend, indexed by UTC sample
+    time.
     """
     def _stitch(self):
-        if self._data_source == 'WEL':
-            load_new = False
-            if self.data is not None:
-                if ((self.data.dateandtime.iloc[0] > self.timerange[0]) or
-                   (self.data.dateandtime.iloc[-1] < self.timerange[1])):
-                    load_new = True
-            else:
-                load_new = True
-            if load_new:
-                num_months = ((self.timerange[1].year - self.timerange[0].year)
-                              * 12 + self.timerange[1].month
-                              - self.timerange[0].month)
-                monthlist = [self.timerange[0] + relativedelta(months=x)
-                             for x in range(num_months + 1)]
-                loadedstring = [F'{month.year}-{month.month}'
-                                for month in monthlist]
-                message(F'Loaded: {loadedstring}', mssgType='ADMIN')
-                datalist = [self.read_log(self._dl_db_path
-                                          + F'WEL_log_{month.year}'
-                                          + F'_{month.month:02d}.xls')
-                            for month in monthlist]
-                # print(datalist)
-                self.data = pd.concat(datalist)
-
-                # Shift power meter data by one sample for better alignment
-                self.data.HP_W = self.data.HP_W.shift(-1)
-                self.data.TAH_W = self.data.TAH_W.shift(-1)
-                tmask = ((self.data.index > self.timerange[0])
-                         & (self.data.index < self.timerange[1]))
-                self.data = self.data[tmask]
-
-        if self._data_source == 'Pi':
-            query = {'dateandtime': {'$gte': self.timerange[0]
-                                     .astimezone(self._db_tzone),
-                                     '$lte': self.timerange[1]
-                                     .astimezone(self._db_tzone)}}
-            # print(F"#DEBUG: query: {query}")
-            self.data = pd.DataFrame(list(self._mongo_db.data.find(query)))
-            if len(self.data) == 0:
-                raise Exception("No data came back from mongo server.")
-            self.data.index = self.data['dateandtime']
-            self.data = self.data.drop(columns=['dateandtime'])
-            # print(self.data.columns)
-            self.data = self.data.tz_localize(self._db_tzone)
-            self.data = self.data.tz_convert(self._to_tzone)
-            # print(F"#DEBUG: timerange from: {self.data.index[-1]}"
-            #       "to {self.data.index[0]}")
-
-            # Shift power meter data by one sample for better alignment
-            self.data.HP_W = self.data.HP_W.shift(-1)
-            self.data.TAH_W = self.data.TAH_W.shift(-1)
-
-            self.data = pd.concat((self.data, self._calced_cols(self.data)),
-                                  axis=1)
-
-    """
-    Returns list of all column names.
+        self.data = self._query(self.timerange)
+        if len(self.data) == 0:
+            raise Exception(F"No data came back from {self._data_source}.")
+
+        self._data_version = next(_versions)
+
+    """
+    Read a timerange of the needed raw columns from the backend, cast to
+    compact dtypes unless disabled, see backends.dtypePlan. Power meter data
+    is shifted within the result.
+    """
+    def _query(self,
+               timerange):
+        columns = None
+        if self._columns is not None:
+            columns = rawInputs(self._columns)
+        data = self._backend.read(timerange, columns)
+        if len(data) == 0 or not self._compact:
+            return data
+        return compactFrame(data)
+
+    """
+    Extend the loaded data to also cover timerange, only querying the head
+    and tail which are not loaded yet. Ranges which don't overlap the loaded
+    one, and backends which aren't incremental, are loaded in full instead.
+
+    timerange : start and end datetimes.
+
+    returns number of rows fetched.
+    """
+    def extendRange(self,
+                    timerange):
+        timerange = self._localize(timerange)
+        self._now = dt.datetime.now().astimezone(self._to_tzone)
+        overlaps = (timerange[0] <= self.timerange[1]
+                    and timerange[1] >= self.timerange[0])
+        if (not self._backend.incremental or not overlaps
+                or len(self.data) == 0):
+            self.timerange = timerange
+            self._stitch()
+            return len(self.data)
+
+        fetched = 0
+        data = self.data
+        if timerange[0] < self.timerange[0]:
+            # Query through the first loaded sample so the power shift of
+            # the head is complete, then keep the loaded copy of it
+            head = self._query([timerange[0], data.index[0]])
+            head = head[head.index < data.index[0]]
+            fetched += len(head)
+            data = pd.concat((head, data))
+        if timerange[1] > self.timerange[1]:
+            # The last loaded sample has no shifted power until its
+            # successor is known, so it is fetched again with the tail
+            tail = self._query([data.index[-1], timerange[1]])
+            if len(tail) > 0:
+                fetched += len(tail) - 1
+                data = pd.concat((data[data.index < tail.index[0]], tail))
+        if fetched > 0:
+            self.data = data
+            self._data_version = next(_versions)
+        self.timerange = [min(timerange[0], self.timerange[0]),
+                          max(timerange[1], self.timerange[1])]
+        return fetched
+
+    """
+    Drop loaded data from before start.
+    """
+    def trimRange(self,
+                  start):
+        if start <= self.timerange[0]:
+            return
+        self.data = self.data.iloc[self.data.index.searchsorted(start):]
+        self.timerange = [start, self.timerange[1]]
+        self._data_version = next(_versions)
+
+    """
+    Returns a WELData for part of the loaded timerange, sharing this object's
+    data and derived metrics without copying them. The view reads from a
+    snapshot, so later extendRange and trimRange calls don't move its rows.
+    Views are shared between sessions and must not be modified.
+
+    timerange : start and end datetimes within the loaded timerange.
+    """
+    def subset(self,
+               timerange):
+        self._memo()
+        # Brought up to date here, while the data can't change, so the stats
+        # are extended incrementally and shared with the snapshot
+        self.runningStats()
+        view = copy(self)
+        view.timerange = list(timerange)
+        view._parent = copy(self)
+        view._rows = slice(self.data.index.searchsorted(timerange[0]),
+                           self.data.index.searchsorted(timerange[1],
+                                                        side='right'))
+        view.data = self.data.iloc[view._rows]
+        return view
+
+    """
+    Returns the derived metric memo for the current data version.
+    """
+    def _memo(self):
+        if self._derived_memo_version != self._data_version:
+            self._derived_memo = {}
+            self._derived_memo_version = self._data_version
+        return self._derived_memo
+
+    """
+    Returns the RunningStats of the loaded data, extended from the previous
+    ones when samples were only added or dropped at the ends. Views use their
+    parent's.
+    """
+    def runningStats(self):
+        if self._parent is not None:
+            return self._parent.runningStats()
+        if self._running_stats_version != self._data_version:
+            previous = self._running_stats or RunningStats.empty()
+            self._running_stats = previous.update(self.getCols(STATS_INPUTS))
+            self._running_stats_version = self._data_version
+        return self._running_stats
+
+    """
+    Returns a token identifying the loaded data, which changes whenever the
+    data do.
+    """
+    def dataVersion(self):
+        return self._data_version
+
+    """
+    Returns bytes held by the loaded data and memoized derived metrics.
+    """
+    def memoryUsage(self):
+        # deep, so the object _id column is counted by its ObjectIds
+        nbytes = self.data.memory_usage(index=True, deep=True).sum()
+        if self._derived_memo is not None:
+            nbytes += sum(col.memory_usage(index=False)
+                          for col in self._derived_memo.values()
+                          if col is not None)
+        return int(nbytes)
+
+    """
+    Returns list of all column names, including derived metrics.
     """
     def vars(self):
-        return [col for col in self.data.columns]
+        cols = [col for col in self.data.columns]
+        if self._calc_cols:
+            cols += [name for name in metricNames() if name not in cols]
+        return cols
+
+    """
+    Return the named raw columns and derived metrics as a dataframe. Derived
+    metrics are calculated on first request and memoized until the data
+    changes. Names which are not available are left out.
+
+    names : list of column and derived metric names.
+    """
+    def getCols(self,
+                names):
+        if self._parent is not None:
+            return self._parent.getCols(names).iloc[self._rows]
+        if not self._calc_cols:
+            return self.data[[name for name in names
+                              if name in self.data.columns]]
+        with profiler.span('Derived metrics') as calc_span:
+            metrics = MetricFrame(self.data, self._memo())
+            cols = pd.DataFrame({name: metrics[name] for name in names
+                                 if name in metrics},
+                                index=self.data.index)
+            calc_span.rows = len(cols)
+        return cols
+
+    """
+    Return the named raw columns and derived metrics as means of buckets of
+    width seconds aligned to the epoch, see downsample.bucketMeans. Buckets
+    are calculated once over the loaded data and memoized with the derived
+    metrics, so views, and the sessions sharing them, only select their
+    buckets. Buckets are whole, the first and last may include loaded samples
+    just outside a view's range, as tile reads do.
+
+    names : list of column and derived metric names.
+    width : bucket width in seconds.
+    """
+    def resampled(self,
+                  names,
+                  width):
+        if self._parent is not None:
+            buckets = self._parent.resampled(names, width)
+            if buckets.empty:
+                return buckets
+            ns = width * 1_000_000_000
+            start = pd.Timestamp(self.timerange[0]).value // ns * ns
+            end = pd.Timestamp(self.timerange[1]).value
+            return buckets[(buckets.index.asi8 >= start)
+                           & (buckets.index.asi8 <= end)]
+        memo = self._memo()
+        missing = [name for name in names
+                   if ('resampled', width, name) not in memo]
+        if missing:
+            means = bucketMeans(self.getCols(missing), width)
+            for name in missing:
+                memo[('resampled', width, name)] = (means[name]
+                                                    if name in means
+                                                    else None)
+        return pd.DataFrame({name: memo[('resampled', width, name)]
+                             for name in names
+                             if memo[('resampled', width, name)] is not None})
+
+    """
+    Return a single raw column or derived metric as a series.
+    """
+    def getCol(self,
+               name):
+        col = self.getCols([name])
+        if name not in col:
+            raise KeyError(name)
+        return col[name]
 
     """
     Takes a list with a start and end time. If either is 'none', defaults to
@@ -383,34 +490,20 @@ class WELData:
         return timerange
 
     """
-    Converts variable name string into object data string, to be evaluated as
-    a python expression.
-
-    string : expression string to be modified.
-    optional mask : indicates this is for status mask data, including a call to
-                    remOffset
-    """
-    def _varExprParse(self,
-                      string,
-                      mask=False):
-        splitString = re.split('(\\()|(\\))|(\\s)', string)
-        splitString = [w for w in splitString if w is not None]
+    Evaluate a list of variable expressions, see var_expr.compileExpr for the
+    syntax. Expressions are compiled once per column schema and cached.
 
-        expr = ""
-        for word in splitString:
-            possibleVars = [var for var in self.data.columns if var in word]
-            if len(possibleVars) > 0:
-                foundVar = max(possibleVars, key=len)
-                if mask:
-                    rst = ("self.remOffset(self.data['"
-                           + foundVar + "'])")
-                else:
-                    rst = "self.data['" + foundVar + "']"
-                expr += word.replace(foundVar, rst)
-            else:
-                expr += word
+    exprs : list of expression strings.
+    optional mask : indicates this is for status mask data, removing the
+                    plotting offset from each variable.
 
-        return expr
+    returns list of series.
+    """
+    def evalExprs(self,
+                  exprs,
+                  mask=False):
+        return evaluateExprs(exprs, tuple(self.vars()), self.getCols,
+                             mask=mask)
 
     """
     Adds day/night background shading based on calculated sunrise/sunset times
@@ -451,9 +544,8 @@ class WELData:
     """
     def remOffset(self,
                   status):
-        mask = np.array(status) % 2
-        mask[mask == 0.] = np.nan
-        return mask
+        return remOffset(pd.Series(status).to_numpy(dtype=np.float64,
+                                                    na_value=np.nan))
 
     """
     Plot two variables against each other.
@@ -486,25 +578,25 @@ class WELData:
                 **kwargs):
         if type(y) is not list:
             y = [y]
-        p_locals = locals()
         if statusmask is not None:
-            smask = eval(self._varExprParse(statusmask, mask=True), p_locals)
+            smask = self.evalExprs([statusmask], mask=True)[0]
         else:
             smask = np.full(np.shape(self.data.index), True)
 
-        # plotx = eval(self._varExprParse(x), p_locals)
-        ploty = [eval(self._varExprParse(expr), p_locals) for expr in y]
+        ploty = self.evalExprs(y)
 
         if axes is None:
-            fig = plt.figure(figsize=self._figsize)
+            plt.figure(figsize=self._figsize)
             axes = plt.gca()
 
         if ('time' or 'date') in x:
-            lines = {label: axes.plot_date(plotDatum.index, plotDatum * smask,
+            lines = {label: axes.plot_date(self._localTime(plotDatum.index),
+                                           plotDatum * smask,
                                            '-', label=label, **kwargs)
                      for label, plotDatum in zip(y, ploty)}
             if statusmask is not None and maskghost:
-                [axes.plot_date(plotDatum.index, plotDatum, fmt='-', alpha=0.3,
+                [axes.plot_date(self._localTime(plotDatum.index), plotDatum,
+                                fmt='-', alpha=0.3,
                                 color=lines[label][0].get_color(), **kwargs)
                  for label, plotDatum in zip(y, ploty)]
             plt.setp(axes.get_xticklabels(), rotation=20, ha='right')
@@ -518,7 +610,7 @@ class WELData:
         #     axes.set_xlim((np.nanmin(plotx), np.nanmax(plotx)))
 
         if yunits == 'None':
-            usedVars = [var for var in self.data.columns if var in y[0]]
+            usedVars = compileExpr(y[0], tuple(self.vars()), False).columns
             if usedVars[0][-1] == 'T':
                 yunits = "Temperature / °C"
             if usedVars[0][-1] == 'W':
@@ -560,17 +652,15 @@ class WELData:
                                 'humid_b']):
         labels = [stat[:-2] for stat in status_list]
 
-        p_locals = locals()
-        # plotx = eval(self._varExprParse('dateandtime'), p_locals)
-        ploty = [eval(self._varExprParse(stat), p_locals)
-                 for stat in status_list]
+        ploty = self.evalExprs(status_list)
 
         if axes is None:
-            fig = plt.figure(figsize=(self._figsize[0],
-                                      self._figsize[1] * 0.75))
+            plt.figure(figsize=(self._figsize[0],
+                                self._figsize[1] * 0.75))
             axes = plt.gca()
 
-        [axes.plot_date(plotDatum.index, plotDatum, fmt='-', label=label)
+        [axes.plot_date(self._localTime(plotDatum.index), plotDatum, fmt='-',
+                        label=label)
             for label, plotDatum in zip(labels, ploty)]
 
         axes.set_ylim((-0.75, 2 * (len(status_list) - 1) + 1.75))
@@ -17,6 +17,7 @@ from sense_energy import Senseable
 from sense_energy.sense_exceptions import SenseAPITimeoutException
 from log_message import message
 from WELData import mongoConnect
+from materialize import materializePending
 
 
 WEL_IP = '192.168.68.107'
@@ -134,9 +135,7 @@ async def getWELData():
     url = "http://" + WEL_IP + ":5150/data.xml"
 
     post = {}
-    local_now = (dt.datetime.now()
-                 .replace(microsecond=0)
-                 .replace(tzinfo=TO_TZONE))
+    local_now = dt.datetime.now(TO_TZONE).replace(microsecond=0)
     sunrise = sun.sunrise(LOC.observer, date=local_now.date(),
                           tzinfo=TO_TZONE).astimezone(DB_TZONE)
     sunset = sun.sunset(LOC.observer, date=local_now.date(),
@@ -268,7 +267,20 @@ async def send_post(post):
                 mssgType='WARNING')
 
 
+def materializePosts(mongo_db,
+                     since):
+    # Run in a worker thread, returns since for the next pass
+    try:
+        return materializePending(mongo_db, since)[1]
+    except Exception as e:
+        message(F"Error materializing metrics: {e}", mssgType='ERROR')
+        return since
+
+
 async def main(interval):
+    loop = asyncio.get_running_loop()
+    materializing = None
+    since = None
     while True:
         then = time.time()
         post = await getWELData()
@@ -282,6 +294,14 @@ async def main(interval):
                                .replace(tzinfo=DB_TZONE))
 
         await send_post(post)
+        # Materialize metrics for the previous post, now it has a successor,
+        # off the loop so sampling keeps its interval. A pass still running
+        # is left to finish, the next one catches up.
+        if materializing is None or materializing.done():
+            if materializing is not None:
+                since = materializing.result()
+            materializing = loop.run_in_executor(
+                None, materializePosts, connects.db.database, since)
 
 
 if __name__ == "__main__":
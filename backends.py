@@ -0,0 +1,606 @@
+import os
+import datetime as dt
+import numpy as np
+import pandas as pd
+import bson
+from dateutil.relativedelta import relativedelta
+from pytz import timezone
+from log_message import message
+from config import configValue
+import profiler
+from synthetic_data import syntheticFrame
+
+"""
+Storage backends WELData reads its samples from. Every backend reads a
+timerange of raw columns, optionally projected to some columns, as a frame
+indexed by UTC sample time, and aggregates a timerange into epoch aligned
+buckets of min, mean, max and sample count per column, which backends push
+down to their engine where they can. Frames stay in UTC through the data
+layer, only display converts them to local time.
+
+MongoBackend    the Pi's Mongo server, data_source 'Pi'
+ReplicaBackend  closed days from a local replica and the rest from Mongo,
+                data_source 'Pi' when config.txt sets a replica_path
+WELLogBackend   the WEL's monthly spreadsheet logs, data_source 'WEL'
+ParquetBackend  day partitions of Parquet files, data_source 'Parquet',
+                read with pyarrow and aggregated with DuckDB when installed
+SyntheticBackend  generated data, data_source 'Synthetic'
+"""
+DB_TZONE = timezone('UTC')
+STATS = ['min', 'mean', 'max', 'count']
+# Power meters are logged one sample late
+POWER_METERS = ['HP_W', 'TAH_W']
+# In memory dtypes of loaded columns, see compactFrame. Status channels hold
+# their plotting offset plus the on bit, flags are 0 or 1, and float32 keeps
+# about seven significant digits, more than any analog sensor resolves.
+STATUS_DTYPE = 'Int8'
+FLAG_DTYPE = 'boolean'
+ANALOG_DTYPE = 'float32'
+FLAGS = ['daylight']
+# Left as read: document ids and versions
+UNPLANNED = ['_id', 'calc_version']
+
+
+def shiftPower(frame):
+    """
+    Shift power meter data by one sample for better alignment, within frame.
+    """
+    for col in POWER_METERS:
+        if col in frame:
+            frame[col] = frame[col].shift(-1)
+    return frame
+
+
+def dtypePlan(columns):
+    """
+    Returns dict of in memory dtype by column name, from the naming scheme:
+    status channels end in '_b', FLAGS are 0/1 flags and every other field is
+    an analog sensor. Nullable dtypes keep samples where a source was
+    missing from a post.
+    """
+    plan = {}
+    for col in columns:
+        if col in UNPLANNED:
+            continue
+        if col.endswith('_b'):
+            plan[col] = STATUS_DTYPE
+        elif col in FLAGS:
+            plan[col] = FLAG_DTYPE
+        else:
+            plan[col] = ANALOG_DTYPE
+    return plan
+
+
+def compactFrame(frame):
+    """
+    Cast a loaded frame to its dtype plan. Stray strings, e.g. from the WEL's
+    XML when a value fails to parse, are coerced to NaN first.
+    """
+    plan = dtypePlan(frame.columns)
+    cols = {}
+    for col in frame.columns:
+        values = frame[col]
+        if col in plan:
+            if values.dtype == object:
+                values = pd.to_numeric(values, errors='coerce')
+            if plan[col] == STATUS_DTYPE:
+                values = values.round()
+            values = values.astype(plan[col])
+        cols[col] = values
+    return pd.DataFrame(cols, index=frame.index)
+
+
+def _utcIndex(frame):
+    # Index by the dateandtime column, stored as naive or aware UTC
+    frame.index = pd.DatetimeIndex(frame.pop('dateandtime'))
+    if frame.index.tz is None:
+        frame = frame.tz_localize(DB_TZONE)
+    elif frame.index.tz != DB_TZONE:
+        frame = frame.tz_convert(DB_TZONE)
+    frame = frame.sort_index()
+    frame.index.name = 'dateandtime'
+    return frame
+
+
+def _bucketIndex(seconds):
+    index = pd.to_datetime(np.asarray(seconds, dtype=np.int64), unit='s',
+                           utc=True)
+    index.name = 'dateandtime'
+    return index
+
+
+def bucketStats(frame,
+                width,
+                stats=STATS):
+    """
+    Aggregate a frame into buckets of width seconds aligned to the epoch.
+
+    returns dict of dataframe by stat, indexed by bucket start.
+    """
+    frame = frame.select_dtypes(include=['number', 'bool']).drop(
+        columns=['calc_version'], errors='ignore').astype(np.float64)
+    seconds = frame.index.asi8 // 1_000_000_000 // width * width
+    grouped = frame.groupby(seconds)
+    out = {}
+    for stat in stats:
+        agg = grouped.agg(stat)
+        agg.index = _bucketIndex(agg.index)
+        out[stat] = agg
+    return out
+
+
+class Backend:
+    """
+    Interface of a storage backend. Subclasses implement fetch, and may push
+    aggregate down to their engine.
+
+    incremental : reads of adjacent ranges join up, so a loaded range can be
+                  extended with only its missing head and tail.
+    """
+    incremental = True
+
+    def read(self,
+             timerange,
+             columns=None):
+        """
+        Returns the samples within timerange, both ends included, indexed by
+        UTC time. Power meter data is shifted within the result.
+
+        timerange : start and end tz aware datetimes.
+        optional columns : raw columns to read. Default all.
+        """
+        frame = self.fetch(timerange, columns)
+        if len(frame) == 0:
+            return frame
+        return shiftPower(frame)
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        """
+        Returns the samples within timerange as stored, without the power
+        meter shift.
+        """
+        raise NotImplementedError
+
+    def aggregate(self,
+                  timerange,
+                  width,
+                  columns=None,
+                  stats=STATS):
+        """
+        Returns dict of dataframe by stat of the raw columns in buckets of
+        width seconds aligned to the epoch, indexed by bucket start.
+        """
+        return bucketStats(self.read(timerange, columns), width, stats)
+
+
+class MongoBackend(Backend):
+    """
+    The data collection of the Pi's Mongo server.
+
+    mongo_db : database with the data collection.
+    """
+    _mongo_db = None
+
+    def __init__(self,
+                 mongo_db):
+        self._mongo_db = mongo_db
+
+    def _match(self,
+               timerange):
+        return {'dateandtime': {'$gte': timerange[0].astimezone(DB_TZONE),
+                                '$lte': timerange[1].astimezone(DB_TZONE)}}
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        projection = None
+        if columns is not None:
+            projection = {col: 1 for col in columns}
+            projection['dateandtime'] = 1
+        # Raw batches keep the network fetch and decoding apart for the
+        # profiler
+        with profiler.span('Mongo query') as query_span:
+            batches = list(self._mongo_db.data.find_raw_batches(
+                self._match(timerange), projection))
+            query_span.nbytes = sum(len(batch) for batch in batches)
+        with profiler.span('BSON decode') as decode_span:
+            frame = pd.DataFrame([doc for batch in batches
+                                  for doc in bson.decode_all(batch)])
+            decode_span.rows = len(frame)
+        if len(frame) == 0:
+            return frame
+        with profiler.span('Index') as index_span:
+            frame = _utcIndex(frame)
+            index_span.rows = len(frame)
+        return frame
+
+    def aggregate(self,
+                  timerange,
+                  width,
+                  columns=None,
+                  stats=STATS):
+        # Grouped on the server, without the power meter shift. Fields are
+        # only known from the documents, so all columns are read locally.
+        if columns is None:
+            return super().aggregate(timerange, width, columns, stats)
+        epoch = dt.datetime(1970, 1, 1)
+        ops = {'min': '$min', 'mean': '$avg', 'max': '$max'}
+        group = {'_id': {'$subtract': [
+            '$dateandtime',
+            {'$mod': [{'$subtract': ['$dateandtime', epoch]},
+                      width * 1000]}]}}
+        for i, col in enumerate(columns):
+            # NaN sorts below every number in Mongo, so this skips NaN as
+            # well as missing and null values, as pandas does
+            valid = {'$gte': [F"${col}", float('-inf')]}
+            for stat in stats:
+                if stat == 'count':
+                    group[F"c{i}_{stat}"] = {'$sum': {'$cond': [valid, 1, 0]}}
+                else:
+                    group[F"c{i}_{stat}"] = {ops[stat]: {'$cond': [
+                        valid, F"${col}", None]}}
+        with profiler.span('Mongo aggregate') as agg_span:
+            docs = list(self._mongo_db.data.aggregate(
+                [{'$match': self._match(timerange)}, {'$group': group},
+                 {'$sort': {'_id': 1}}]))
+            agg_span.rows = len(docs)
+        frame = pd.DataFrame(docs)
+        index = _bucketIndex(
+            pd.DatetimeIndex(frame['_id'] if len(frame) else [])
+            .asi8 // 1_000_000_000)
+        return {stat: pd.DataFrame({col: (frame[F"c{i}_{stat}"].to_numpy()
+                                          if len(frame) else [])
+                                    for i, col in enumerate(columns)},
+                                   index=index)
+                for stat in stats}
+
+
+def readLog(filepath):
+    """
+    Read a WEL spreadsheet log, indexed by UTC sample time. The WEL logs in
+    EST all year.
+    """
+    try:
+        data = pd.read_excel(filepath)
+    except Exception:
+        data = pd.read_csv(filepath, sep='\t',
+                           index_col=False, na_values=['?'])
+
+    for col in data.columns:
+        if ('Date' not in col) and ('Time' not in col):
+            data[col] = data[col].astype(np.float64)
+
+    data.Date = data.Date.apply(lambda date:
+                                dt.datetime.strptime(date, "%m/%d/%Y"))
+    data.Time = data.Time.apply(lambda time:
+                                dt.datetime.strptime(time,
+                                                     "%H:%M:%S").time())
+
+    data.index = pd.DatetimeIndex([dt.datetime.combine(date, time)
+                                   for date, time in zip(data.Date,
+                                                         data.Time)],
+                                  name='dateandtime')
+    data = data.tz_localize(timezone('EST'))
+    data = data.tz_convert(DB_TZONE)
+    return data.drop(columns=['Date', 'Time'])
+
+
+class WELLogBackend(Backend):
+    """
+    Monthly WEL logs downloaded to dl_db_path. Months are read whole, so
+    ranges are always loaded in full.
+    """
+    incremental = False
+    _dl_db_path = None
+
+    def __init__(self,
+                 dl_db_path):
+        self._dl_db_path = dl_db_path
+
+    def _months(self,
+                timerange):
+        num_months = ((timerange[1].year - timerange[0].year) * 12
+                      + timerange[1].month - timerange[0].month)
+        monthlist = [timerange[0] + relativedelta(months=x)
+                     for x in range(num_months + 1)]
+        message(F"Loaded: {[F'{m.year}-{m.month}' for m in monthlist]}",
+                mssgType='ADMIN')
+        return pd.concat([readLog(self._dl_db_path
+                                  + F'WEL_log_{month.year}'
+                                  + F'_{month.month:02d}.xls')
+                          for month in monthlist])
+
+    def _within(self,
+                data,
+                timerange,
+                columns):
+        data = data[(data.index >= timerange[0])
+                    & (data.index <= timerange[1])]
+        if columns is not None:
+            data = data[[col for col in columns if col in data]]
+        return data
+
+    def read(self,
+             timerange,
+             columns=None):
+        # Shifted before cutting so the range's last sample keeps its power
+        return self._within(shiftPower(self._months(timerange)), timerange,
+                            columns)
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        return self._within(self._months(timerange), timerange, columns)
+
+
+class SyntheticBackend(Backend):
+    """
+    Deterministic generated data, see synthetic_data.
+    """
+    _seed = None
+
+    def __init__(self,
+                 seed=0):
+        self._seed = seed
+
+    def read(self,
+             timerange,
+             columns=None):
+        # Generated already aligned, there is no meter lag to shift out
+        return self.fetch(timerange, columns)
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        return syntheticFrame(timerange, self._seed, columns)
+
+
+class ParquetBackend(Backend):
+    """
+    Local columnar copy of the data as one Parquet file per UTC day, named
+    YYYY-MM-DD.parquet, with a dateandtime column in UTC and one column per
+    field. Reads only open the days of the range and only decode the asked
+    for columns. Needs pyarrow, aggregates use DuckDB when it is installed.
+
+    path : directory of the day files.
+    """
+    _path = None
+
+    def __init__(self,
+                 path):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise Exception("The Parquet backend needs pyarrow installed")
+        self._path = path
+
+    def dayPath(self,
+                day):
+        return os.path.join(self._path, F"{day:%Y-%m-%d}.parquet")
+
+    def days(self):
+        """
+        Returns the sorted UTC days which have a day file.
+        """
+        if not os.path.isdir(self._path):
+            return []
+        return sorted(dt.date.fromisoformat(name[:-len('.parquet')])
+                      for name in os.listdir(self._path)
+                      if name.endswith('.parquet'))
+
+    def _files(self,
+               timerange):
+        day = timerange[0].astimezone(DB_TZONE).date()
+        last = timerange[1].astimezone(DB_TZONE).date()
+        files = []
+        while day <= last:
+            if os.path.exists(self.dayPath(day)):
+                files.append(self.dayPath(day))
+            day += dt.timedelta(days=1)
+        return files
+
+    def _dataset(self,
+                 files):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+        # Days may have different fields
+        schema = pa.unify_schemas([pq.read_schema(file) for file in files])
+        return ds.dataset(files, schema=schema, format='parquet')
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        import pyarrow.dataset as ds
+        files = self._files(timerange)
+        if not files:
+            return pd.DataFrame()
+        with profiler.span('Parquet read') as read_span:
+            dataset = self._dataset(files)
+            names = [name for name in dataset.schema.names
+                     if columns is None or name in columns
+                     or name == 'dateandtime']
+            time = ds.field('dateandtime')
+            table = dataset.to_table(
+                columns=names,
+                filter=((time >= pd.Timestamp(timerange[0]).tz_convert(
+                            DB_TZONE))
+                        & (time <= pd.Timestamp(timerange[1]).tz_convert(
+                            DB_TZONE))))
+            read_span.nbytes = table.nbytes
+            frame = table.to_pandas()
+            read_span.rows = len(frame)
+        if len(frame) == 0:
+            return frame
+        return _utcIndex(frame)
+
+    def aggregate(self,
+                  timerange,
+                  width,
+                  columns=None,
+                  stats=STATS):
+        # Pushed down to DuckDB's scan when it is installed, without the
+        # power meter shift
+        try:
+            import duckdb
+        except ImportError:
+            return super().aggregate(timerange, width, columns, stats)
+        files = self._files(timerange)
+        if not files:
+            return {stat: pd.DataFrame() for stat in stats}
+        names = [name for name in self._dataset(files).schema.names
+                 if name not in ['dateandtime', 'calc_version']
+                 and (columns is None or name in columns)]
+        ops = {'min': 'min', 'mean': 'avg', 'max': 'max', 'count': 'count'}
+        selects = ", ".join(F'{ops[stat]}("{name}") AS "c{i}_{stat}"'
+                            for i, name in enumerate(names)
+                            for stat in stats)
+        bucket = F"floor(epoch(dateandtime) / {width}) * {width}"
+        with profiler.span('DuckDB aggregate') as agg_span:
+            frame = duckdb.connect().execute(
+                F"SELECT {bucket} AS bucket, {selects} "
+                F"FROM read_parquet(?, union_by_name=true) "
+                F"WHERE epoch(dateandtime) BETWEEN ? AND ? "
+                F"GROUP BY bucket ORDER BY bucket",
+                # Epoch seconds, as naive times would be read in the
+                # session's time zone, the host's by default
+                [files, timerange[0].timestamp(), timerange[1].timestamp()]
+            ).df()
+            agg_span.rows = len(frame)
+        index = _bucketIndex(frame['bucket'])
+        return {stat: pd.DataFrame({name: frame[F"c{i}_{stat}"].to_numpy()
+                                    for i, name in enumerate(names)},
+                                   index=index)
+                for stat in stats}
+
+    def write(self,
+              frame,
+              compression='zstd'):
+        """
+        Write a frame of raw samples, indexed by time, as day files,
+        replacing the days it covers. Power meter data must be unshifted, as
+        stored in Mongo. Mongo's document ids are not written. Fields are
+        stored as float64, whatever type a day's documents gave them, so
+        every day file has the same schema. Each file is written aside and
+        moved into place, so readers never see part of a day.
+
+        optional compression : Parquet codec of the files.
+
+        returns list of days written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        os.makedirs(self._path, exist_ok=True)
+        # Ints and flags vary by day, and the WEL fallback posts strings
+        frame = frame.drop(columns=['_id'], errors='ignore').apply(
+            pd.to_numeric, errors='coerce').astype(np.float64)
+        frame.index = frame.index.tz_convert(DB_TZONE)
+        frame.index.name = 'dateandtime'
+        days = []
+        for day, part in frame.groupby(frame.index.date):
+            table = pa.Table.from_pandas(part.reset_index(),
+                                         preserve_index=False)
+            path = self.dayPath(day)
+            pq.write_table(table, path + '.tmp', compression=compression)
+            os.replace(path + '.tmp', path)
+            days.append(day)
+        return days
+
+
+class ReplicaBackend(Backend):
+    """
+    Reads the days of a range which are in a local replica, kept by
+    replica.py, from it and the others, the current day and any days not
+    replicated yet, from the live backend. Segments are joined before the
+    power meter shift, so samples at a seam are shifted as if read from one
+    source.
+
+    replica : ParquetBackend of the replicated days.
+    live : backend of everything else, usually a MongoBackend.
+    """
+    _replica = None
+    _live = None
+
+    def __init__(self,
+                 replica,
+                 live):
+        self._replica = replica
+        self._live = live
+
+    def segments(self,
+                 timerange):
+        """
+        Split timerange at UTC midnights into runs of replicated and not
+        replicated days.
+
+        returns list of (timerange, backend).
+        """
+        def midnight(day):
+            return DB_TZONE.localize(dt.datetime.combine(
+                day, dt.datetime.min.time()))
+
+        day = timerange[0].astimezone(DB_TZONE).date()
+        last = timerange[1].astimezone(DB_TZONE).date()
+        runs = []
+        while day <= last:
+            backend = (self._replica
+                       if os.path.exists(self._replica.dayPath(day))
+                       else self._live)
+            if runs and runs[-1][1] is backend:
+                runs[-1][0][1] = day
+            else:
+                runs.append([[day, day], backend])
+            day += dt.timedelta(days=1)
+        # Both ends of a read are included, so segments end just before the
+        # next midnight
+        return [([max(timerange[0], midnight(first)),
+                  min(timerange[1], midnight(last + dt.timedelta(days=1))
+                      - dt.timedelta(milliseconds=1))], backend)
+                for (first, last), backend in runs]
+
+    def fetch(self,
+              timerange,
+              columns=None):
+        frames = [backend.fetch(segment, columns)
+                  for segment, backend in self.segments(timerange)]
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames).sort_index()
+
+
+def backendFor(data_source,
+               mongo_connection=None,
+               dl_db_path='../log_db/',
+               parquet_path='../parquet_db/'):
+    """
+    Returns the backend of a data source name, 'Pi', 'WEL', 'Parquet' or
+    'Synthetic'. Backends are passed through. 'Pi' reads closed days from
+    the local replica when config.txt sets its directory, e.g.
+
+        replica_path: /home/ubuntu/WEL/replica_db/
+
+    optional mongo_connection : database for 'Pi'.
+    optional dl_db_path : directory of the logs for 'WEL'.
+    optional parquet_path : directory of the day files for 'Parquet'.
+    """
+    if isinstance(data_source, Backend):
+        return data_source
+    if data_source == 'Pi':
+        replica_path = configValue('replica_path')
+        if replica_path:
+            return ReplicaBackend(ParquetBackend(replica_path[0]),
+                                  MongoBackend(mongo_connection))
+        return MongoBackend(mongo_connection)
+    if data_source == 'WEL':
+        return WELLogBackend(dl_db_path)
+    if data_source == 'Parquet':
+        return ParquetBackend(parquet_path)
+    if data_source == 'Synthetic':
+        return SyntheticBackend()
+    raise Exception(F"Unknown data source: {data_source}, valid sources are "
+                    F"'Pi', 'WEL', 'Parquet' or 'Synthetic'")
@@ -0,0 +1,25 @@
+import os
+from pytz import timezone
+
+"""
+Reads settings from config.txt next to the code, one "key: values" setting
+per line.
+"""
+# The house's time zone, of local days and of everything displayed
+TO_TZONE = timezone('America/New_York')
+
+
+def configValue(key):
+    """
+    Returns the whitespace separated values of a setting, None when it or
+    config.txt is missing.
+    """
+    try:
+        with open(os.path.join(os.path.dirname(__file__),
+                               "config.txt")) as f:
+            for line in f:
+                if line.startswith(F"{key}:"):
+                    return line.split(':', 1)[1].split()
+    except FileNotFoundError:
+        pass
+    return None
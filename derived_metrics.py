@@ -0,0 +1,295 @@
+import numpy as np
+import pandas as pd
+from log_message import message
+from config import TO_TZONE
+
+"""
+Registry of metrics derived from the raw sensor columns. Each metric declares
+the columns it reads, which may be raw database fields or other derived
+metrics, and is only calculated when something asks for it.
+
+Per sample metrics are also materialized into the database documents by
+materialize.py, tagged with METRICS_VERSION. Bump METRICS_VERSION whenever a
+per sample formula or constant changes, then run a backfill.
+"""
+METRICS_VERSION = 1
+
+WELL_GPM = 13.6  # gal/min
+WELL_GPM_HEAT_2 = 14.4  # gal/min during heat 2
+
+_metrics = {}
+
+
+class DerivedMetric:
+    name = None
+    inputs = None
+    func = None
+    per_sample = None
+
+    def __init__(self,
+                 name,
+                 inputs,
+                 func,
+                 per_sample=True):
+        self.name = name
+        self.inputs = inputs
+        self.func = func
+        self.per_sample = per_sample
+
+
+class MetricFrame:
+    """
+    Column accessor handed to metric functions. Raw columns are read from the
+    frame, derived ones are calculated on first use and memoized in memo.
+    Metrics already materialized in the frame at METRICS_VERSION are read as
+    is, only rows at another version are recalculated. Missing columns raise
+    KeyError.
+    """
+    frame = None
+    memo = None
+
+    def __init__(self,
+                 frame,
+                 memo=None):
+        self.frame = frame
+        self.memo = {} if memo is None else memo
+
+    @property
+    def index(self):
+        return self.frame.index
+
+    def __contains__(self,
+                     name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self,
+                    name):
+        if name not in _metrics:
+            return self.frame[name]
+        if name not in self.memo:
+            self.memo[name] = self._calculate(name)
+        if self.memo[name] is None:
+            raise KeyError(name)
+        return self.memo[name]
+
+    def _calculate(self,
+                   name):
+        current = None
+        if name in self.frame.columns:
+            if 'calc_version' not in self.frame.columns:
+                return self.frame[name]
+            current = self.frame['calc_version'] == METRICS_VERSION
+            if current.all():
+                return self.frame[name]
+        try:
+            calced = _metrics[name].func(self)
+        except KeyError:
+            if current is None:
+                return None
+            calced = np.nan
+        if current is not None:
+            calced = self.frame[name].where(current, calced)
+        return calced
+
+
+"""
+Decorator registering a derived metric.
+
+name : column name the metric is available under.
+inputs : every column the metric may read, including fallbacks.
+optional per_sample : the metric only depends on its own sample, so it can
+                      be materialized at ingest. Default True.
+"""
+def derived(name,
+            inputs,
+            per_sample=True):
+    def register(func):
+        _metrics[name] = DerivedMetric(name, inputs, func, per_sample)
+        return func
+    return register
+
+
+def isDerived(name):
+    return name in _metrics
+
+
+def metricNames():
+    return list(_metrics)
+
+
+def materializedNames():
+    return [name for name, metric in _metrics.items() if metric.per_sample]
+
+
+"""
+Walk the dependency graph and return the columns needed to calculate the
+given names. Materialized metrics are included themselves, with their
+calc_version, along with the raw inputs for rows not yet materialized.
+Names which are not derived metrics are returned as is.
+"""
+def rawInputs(names):
+    raw = []
+    seen = set()
+
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _metrics:
+            if _metrics[name].per_sample:
+                raw.append(name)
+                visit('calc_version')
+            [visit(dep) for dep in _metrics[name].inputs]
+        else:
+            raw.append(name)
+
+    [visit(name) for name in names]
+    return raw
+
+
+"""
+Calculate the named derived metrics, default all of them, for a frame
+without modifying it. Metrics the frame can't support are left out.
+"""
+def calculate(frame,
+              names=None):
+    if names is None:
+        names = metricNames()
+    metrics = MetricFrame(frame)
+    return pd.DataFrame({name: metrics[name] for name in names
+                         if name in metrics},
+                        index=frame.index)
+
+
+def _values(series):
+    # float64 array of a column, a view when it already is float64
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _statusMask(status):
+    mask = np.mod(_values(status), 2)
+    mask[mask == 0] = np.nan
+    return mask
+
+
+# ------------------------------- Metrics -------------------------------------
+
+@derived('power_tot', ['TAH_W', 'HP_W'])
+def _power_tot(frame):
+    return frame['TAH_W'] + frame['HP_W']
+
+
+@derived('geo_tot_w', ['Emp_TAH_w', 'Emp_TES_w', 'power_tot'])
+def _geo_tot_w(frame):
+    try:
+        return frame['Emp_TAH_w'] + frame['Emp_TES_w']
+    except KeyError:
+        return frame['power_tot']
+
+
+@derived('base_load_w', ['Emp_Total_w', 'geo_tot_w', 'Emp_Tesla_w',
+                         'Emp_Dehumid+Washer_w', 'Emp_Dryer_w', 'Emp_Barn_w'])
+def _base_load_w(frame):
+    return np.abs(frame['Emp_Total_w']
+                  - frame['geo_tot_w']
+                  - frame['Emp_Tesla_w']
+                  - frame['Emp_Dehumid+Washer_w']
+                  - frame['Emp_Dryer_w']
+                  - frame['Emp_Barn_w'])
+
+
+@derived('T_diff', ['fireplace_T', 'D_room_T', 'V_room_T', 'T_room_T',
+                    'living_T', 'outside_T'])
+def _T_diff(frame):
+    try:
+        inside_T = pd.concat([frame['fireplace_T'],
+                              frame['D_room_T'],
+                              frame['V_room_T'],
+                              frame['T_room_T']], axis=1).mean(axis=1)
+        return np.abs(inside_T - frame['outside_T'])
+    except KeyError:
+        try:
+            return np.abs(frame['living_T'] - frame['outside_T'])
+        except KeyError:
+            return pd.Series(np.nan, index=frame.index)
+
+
+@derived('COP', ['TAH_fpm', 'TAH_out_T', 'TAH_in_T', 'power_tot', 'heat_1_b'])
+def _COP(frame):
+    air_density = 1.15  # kg/m^3
+    surface_area = 0.34  # m^2
+    heat_capacity = 1.01  # J/kg
+    COP = np.subtract(_values(frame['TAH_out_T']), _values(frame['TAH_in_T']))
+    np.abs(COP, out=COP)
+    COP *= _values(frame['TAH_fpm'])
+    COP *= air_density * surface_area * heat_capacity * 1000
+    COP /= _values(frame['power_tot'])
+    COP[COP > 4] = np.nan
+    COP *= _statusMask(frame['heat_1_b'])
+    return pd.Series(COP, index=frame.index)
+
+
+@derived('well_W', ['loop_out_T', 'loop_in_T', 'heat_2_b'])
+def _well_W(frame):
+    gpm_to_lps = 0.064  # min L/ gal sec
+    heat_cap_glycol = 3.65  # J/kg
+    # Flow is WELL_GPM, or WELL_GPM_HEAT_2 while heat 2 is on
+    well_W = np.mod(_values(frame['heat_2_b']), 2)
+    well_W *= WELL_GPM_HEAT_2 - WELL_GPM
+    well_W += WELL_GPM
+    well_W *= gpm_to_lps * heat_cap_glycol
+    loop_diff = np.subtract(_values(frame['loop_out_T']),
+                            _values(frame['loop_in_T']))
+    well_W *= np.abs(loop_diff, out=loop_diff)
+    return pd.Series(well_W, index=frame.index)
+
+
+@derived('well_COP', ['well_W', 'power_tot', 'heat_1_b'])
+def _well_COP(frame):
+    well_COP = np.divide(_values(frame['well_W']),
+                         _values(frame['power_tot']))
+    well_COP *= 1000
+    well_COP[well_COP > 4] = np.nan
+    well_COP *= _statusMask(frame['heat_1_b'])
+    return pd.Series(well_COP, index=frame.index)
+
+
+@derived('T_diff_eff', ['geo_tot_w', 'COP', 'base_load_w', 'T_diff'])
+def _T_diff_eff(frame):
+    return ((frame['geo_tot_w'] * frame['COP'].fillna(0)
+             + frame['base_load_w'])
+            / frame['T_diff'])
+
+
+@derived('rain_accum_R', ['weather_station_R'], per_sample=False)
+def _rain_accum_R(frame):
+    # Reset rain accumulation every 24 hrs, using the mean of the 2nd to 10th
+    # last samples of each local day as that day's offset
+    try:
+        rain = frame['weather_station_R']
+    except KeyError:
+        message("Weather station rain data not present in selection",
+                mssgType='WARNING')
+        raise
+    values = _values(rain)
+    local_ns = rain.index.tz_convert(TO_TZONE).tz_localize(None).asi8
+    days, day_idx, day_len = np.unique(local_ns // 86_400_000_000_000,
+                                       return_inverse=True,
+                                       return_counts=True)
+    order = np.argsort(day_idx, kind='stable')
+    sorted_idx = day_idx[order]
+    day_start = np.cumsum(day_len) - day_len
+    from_end = day_len[sorted_idx] - (np.arange(len(order))
+                                      - day_start[sorted_idx])
+    sorted_values = values[order]
+    use = (from_end >= 2) & (from_end <= 10) & ~np.isnan(sorted_values)
+    offset_sum = np.bincount(sorted_idx[use], weights=sorted_values[use],
+                             minlength=len(days))
+    offset_count = np.bincount(sorted_idx[use], minlength=len(days))
+    offset = np.full(len(days), np.nan)
+    np.divide(offset_sum, offset_count, out=offset, where=offset_count > 0)
+    return pd.Series(values - offset[day_idx], index=rain.index)
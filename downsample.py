@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+"""
+Point budget downsampling for plotted series. 'mean' averages time buckets
+of one of NICE_WIDTHS aligned to the epoch, so any two ranges share their
+bucket grid and bucket means can be reused between them. 'minmax' keeps the
+lowest and highest sample of each bucket so short spikes survive. 'lttb'
+(Largest Triangle Three Buckets) keeps the sample of each bucket which best
+preserves the visual shape of the line.
+minmax and lttb return real samples at their original times, so different
+series end up on different timestamps.
+"""
+METHODS = ['mean', 'minmax', 'lttb']
+# Bucket widths of 'mean' in seconds, from the 30 s logging period to a day
+NICE_WIDTHS = [30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600,
+               43200, 86400]
+
+
+def niceWidth(span,
+              n_out):
+    """
+    Returns the width of NICE_WIDTHS giving the number of buckets closest to
+    n_out over span seconds.
+    """
+    target = max(span, 1) / max(n_out, 1)
+    return min(NICE_WIDTHS, key=lambda width: abs(np.log(width / target)))
+
+
+def bucketMeans(data,
+                width):
+    """
+    Average a time indexed frame or series in buckets of width seconds
+    aligned to the epoch, labelled by bucket start.
+    """
+    return data.resample(F"{width}s", origin='epoch').mean()
+
+
+def lttb(x,
+         y,
+         n_out):
+    """
+    Largest Triangle Three Buckets on arrays sorted by x, without NaN.
+
+    returns positions of the kept samples.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket, or the last sample for the last bucket
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x = x[-1]
+            next_y = y[-1]
+        area = np.abs((x[prev] - next_x) * (y[start:end] - y[prev])
+                      - (x[prev] - x[start:end]) * (next_y - y[prev]))
+        prev = start + int(np.argmax(area))
+        kept[i + 1] = prev
+    return kept
+
+
+def minMax(bucket,
+           y):
+    """
+    Lowest and highest sample of each bucket, on arrays without NaN.
+
+    bucket : bucket number of each sample.
+
+    returns sorted positions of the kept samples.
+    """
+    if len(y) == 0:
+        return np.arange(0)
+    order = np.lexsort((y, bucket))
+    first = np.flatnonzero(np.diff(bucket[order], prepend=-1) != 0)
+    last = np.append(first[1:], len(order)) - 1
+    return np.unique(np.concatenate([order[first], order[last]]))
+
+
+def downsample(series,
+               n_out,
+               method='mean'):
+    """
+    Reduce a time indexed series to about n_out points.
+
+    series : series with a sorted DatetimeIndex.
+    n_out : point budget.
+    optional method : one of METHODS.
+
+    returns series, NaN samples are dropped for minmax and lttb.
+    """
+    if method not in METHODS:
+        raise Exception(F"Unknown downsampling method '{method}'")
+    if len(series) == 0:
+        return series
+    if method == 'mean':
+        span = (series.index[-1] - series.index[0]).total_seconds()
+        return bucketMeans(series, niceWidth(span, n_out))
+    series = series.dropna()
+    x = series.index.asi8
+    y = series.to_numpy(dtype=np.float64)
+    if len(x) <= n_out:
+        return series
+    if method == 'lttb':
+        kept = lttb(x, y, n_out)
+    else:
+        # Two points per bucket
+        n_buckets = max(n_out // 2, 1)
+        width = (x[-1] - x[0]) / n_buckets
+        bucket = np.minimum(((x - x[0]) / width).astype(np.int64),
+                            n_buckets - 1)
+        kept = minMax(bucket, y)
+    return pd.Series(y[kept], index=series.index[kept], name=series.name)
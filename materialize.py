@@ -0,0 +1,176 @@
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from pytz import timezone
+from log_message import message
+from WELData import WELData, mongoConnect
+from backends import MongoBackend
+from derived_metrics import MetricFrame, METRICS_VERSION, materializedNames
+
+"""
+Materializes the per sample derived metrics into the database documents next
+to the raw fields, so the frontend only has to read them. The collector calls
+materializePending after every post, which also catches up on documents
+posted while it was down. Run as a script to backfill history after
+METRICS_VERSION changes:
+
+python3 materialize.py --backfill [--start 2020-03-21] [--force]
+"""
+DB_TZONE = timezone('UTC')
+FIRST_DAY = dt.datetime(2020, 3, 21, tzinfo=DB_TZONE)
+# Pending documents materialized per collector call, a day of 30 s posts
+BATCH = 2880
+
+
+"""
+Calculate the per sample metrics for a loaded range and write them back to
+their documents. The last loaded sample is left for the next pass, since
+the power meter shift in WELData needs the sample after it.
+
+mongo_db : database with the data collection.
+timerange : aware start and end datetimes.
+optional force : recalculate documents already at METRICS_VERSION.
+
+returns number of documents updated.
+"""
+def materializeRange(mongo_db,
+                     timerange,
+                     force=False):
+    try:
+        # Straight from Mongo, the updates need the document ids
+        dat = WELData(data_source=MongoBackend(mongo_db),
+                      timerange=list(timerange))
+    except Exception as e:
+        message(F"Nothing to materialize: {e}", mssgType='WARNING')
+        return 0
+
+    names = materializedNames()
+    stored = [col for col in names + ['calc_version']
+              if col in dat.data.columns]
+    raw = dat.data.drop(columns=stored)
+    metrics = MetricFrame(raw)
+    calced = pd.DataFrame({name: metrics[name] for name in names
+                           if name in metrics},
+                          index=raw.index)
+    calced = calced.astype(np.float64).iloc[:-1]
+    ids = dat.data['_id'].iloc[:-1]
+    if not force and 'calc_version' in dat.data:
+        pending = (dat.data['calc_version'].iloc[:-1]
+                   != METRICS_VERSION).to_numpy()
+        calced = calced[pending]
+        ids = ids[pending]
+
+    updates = []
+    for _id, record in zip(ids, calced.to_dict('records')):
+        values = {name: value for name, value in record.items()
+                  if not np.isnan(value)}
+        values['calc_version'] = METRICS_VERSION
+        update = {'$set': values}
+        missing = {name: "" for name in names if name not in values}
+        if missing:
+            update['$unset'] = missing
+        updates.append(UpdateOne({'_id': _id}, update))
+    if updates:
+        mongo_db.data.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+"""
+Materialize the documents not yet at METRICS_VERSION, from the oldest pending
+one at or after since and at most batch of them, so a long backlog is caught
+up over several calls. Meant to run after each post from the collector, which
+passes back the returned since.
+
+optional since : aware time of the oldest document which may be pending.
+                 Default the newest document at METRICS_VERSION, or the first
+                 day of data when there is none, e.g. after a version change.
+optional batch : most pending documents materialized per call.
+
+returns number of documents updated, and since for the next call.
+"""
+def materializePending(mongo_db,
+                       since=None,
+                       batch=BATCH):
+    if since is None:
+        newest = mongo_db.data.find_one({'calc_version': METRICS_VERSION},
+                                        {'dateandtime': 1},
+                                        sort=[('dateandtime', -1)])
+        since = (FIRST_DAY if newest is None
+                 else newest['dateandtime'].replace(tzinfo=DB_TZONE))
+    query = {'dateandtime': {'$gte': since},
+             'calc_version': {'$ne': METRICS_VERSION}}
+    first = mongo_db.data.find_one(query, {'dateandtime': 1},
+                                   sort=[('dateandtime', 1)])
+    if first is None:
+        return 0, since
+    start = first['dateandtime'].replace(tzinfo=DB_TZONE)
+    # Loaded up to the document after the batch, which is left for the next
+    # call as the last loaded sample
+    after = list(mongo_db.data.find(query, {'dateandtime': 1})
+                 .sort('dateandtime', 1).skip(batch).limit(1))
+    end = (after[0]['dateandtime'].replace(tzinfo=DB_TZONE) if after
+           else dt.datetime.now(DB_TZONE))
+    return materializeRange(mongo_db, [start, end]), start
+
+
+"""
+Recalculate history one day at a time.
+
+optional start : first day to backfill. Default first day of data.
+optional end : last day to backfill. Default now.
+optional force : rewrite documents already at METRICS_VERSION.
+"""
+def backfill(mongo_db,
+             start=FIRST_DAY,
+             end=None,
+             force=False):
+    if end is None:
+        end = dt.datetime.now(DB_TZONE)
+    total = 0
+    day = start
+    while day < end:
+        # Overlap by a sample so the last sample of each day is included
+        day_end = min(day + dt.timedelta(days=1, minutes=1), end)
+        count = materializeRange(mongo_db, [day, day_end], force=force)
+        total += count
+        message([F"{day.strftime('%Y-%m-%d')}: ", F"{count} updated"],
+                mssgType='ADMIN')
+        day += dt.timedelta(days=1)
+    message(F"Backfill to version {METRICS_VERSION} done, "
+            F"{total} documents updated", mssgType='SUCCESS')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backfill', action='store_true',
+                        help='recalculate stored metrics for history.')
+    parser.add_argument('--start', type=str, action='store',
+                        help='first day to backfill as iso string.')
+    parser.add_argument('--end', type=str, action='store',
+                        help='last day to backfill as iso string.')
+    parser.add_argument('--force', action='store_true',
+                        help='rewrite documents already at the current '
+                             'metrics version.')
+    args = parser.parse_args()
+
+    mongo_db = mongoConnect()
+    if args.backfill:
+        start = FIRST_DAY
+        end = None
+        if args.start:
+            start = (dt.datetime.fromisoformat(args.start)
+                     .replace(tzinfo=DB_TZONE))
+        if args.end:
+            end = (dt.datetime.fromisoformat(args.end)
+                   .replace(tzinfo=DB_TZONE))
+        backfill(mongo_db, start=start, end=end, force=args.force)
+    else:
+        count, _ = materializePending(mongo_db)
+        message(F"{count} documents materialized", mssgType='SUCCESS')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 import streamlit as st
-import altair as alt
-import time
-from StreamPlot import StreamPlot
-from log_message import message
+from StreamPlot import StreamPlot, vconcat
+import profiler
 
 
 class Monit(StreamPlot):
@@ -15,12 +13,12 @@ class Monit(StreamPlot):
                  resample_N,
                  date_range,
                  onlyPlots=False,
-                 sensor_container=None):
-        super().__init__(resample_N)
-
-        display_log = st.sidebar.checkbox("Display Log")
-        if display_log:
-            self.makeDebugTbl()
+                 sensor_container=None,
+                 resample_method='mean',
+                 live=False,
+                 data_source='Pi'):
+        super().__init__(resample_N, resample_method, live=live,
+                         data_source=data_source)
 
         self.makeWEL(date_range)
 
@@ -48,11 +46,17 @@ class Monit(StreamPlot):
         return sensor_groups
 
     def _plots(self):
-        tic = time.time()
         if self._sensor_groups is None:
             self._sensor_groups = [self.in_default]
-        with st.spinner('Generating Plots'):
-            plot = alt.vconcat(
+        power_vars = ['Emp_Solar_w', 'Emp_Tesla_w', 'base_load_w',
+                      'Emp_Dehumid+Washer_w', 'geo_tot_w', 'Emp_Dryer_w']
+        with st.spinner('Generating Plots'), \
+                profiler.span('Chart build'):
+            self.planData([(['daylight'] + self.status_list + power_vars
+                            + ['COP', 'well_COP', 'T_diff_eff'], 'mean'),
+                           (['outside_T'] + self._sensor_groups[0],
+                            self.resample_method)])
+            plot = vconcat(
                 self.plotStatus().properties(
                     width=self.def_width,
                     height=self.def_height * self.stat_height_mod
@@ -61,10 +65,7 @@ class Monit(StreamPlot):
                     width=self.def_width,
                     height=self.def_height * self.pwr_height_mod
                 ),
-                self.plotPowerStack(['Emp_Solar_w', 'Emp_Tesla_w',
-                                     'base_load_w', 'Emp_Dehumid+Washer_w',
-                                     'geo_tot_w', 'Emp_Dryer_w'],
-                                    ).properties(
+                self.plotPowerStack(power_vars).properties(
                     width=self.def_width,
                     height=self.def_height * self.pwr_height_mod
                 ),
@@ -104,8 +105,6 @@ class Monit(StreamPlot):
         ).configure_view(
             cornerRadius=2
         )
+        spec = self.toSpec(plot)
 
-        message([F"{'Altair plot gen:': <20}", F"{time.time() - tic:.2f} s"],
-                tbl=self.mssg_tbl, mssgType='TIMING')
-
-        return [plot]
+        return [spec]
@@ -1,8 +1,6 @@
 import streamlit as st
-import altair as alt
-import time
-from StreamPlot import StreamPlot
-from log_message import message
+from StreamPlot import StreamPlot, vconcat
+import profiler
 
 
 class PandW(StreamPlot):
@@ -18,12 +16,12 @@ class PandW(StreamPlot):
                  resample_N,
                  date_range,
                  onlyPlots=False,
-                 sensor_container=None):
-        super().__init__(resample_N)
-
-        display_log = st.sidebar.checkbox("Display Log")
-        if display_log:
-            self.makeDebugTbl()
+                 sensor_container=None,
+                 resample_method='mean',
+                 live=False,
+                 data_source='Pi'):
+        super().__init__(resample_N, resample_method, live=live,
+                         data_source=data_source)
 
         self.makeWEL(date_range)
 
@@ -50,11 +48,16 @@ class PandW(StreamPlot):
         return sensor_groups
 
     def _plots(self):
-        tic = time.time()
         if self._sensor_groups is None:
             self._sensor_groups = [self.work_default, self.water_default]
-        with st.spinner('Generating Plots'):
-            plot = alt.vconcat(
+        with st.spinner('Generating Plots'), \
+                profiler.span('Chart build'):
+            self.planData([(['daylight'] + self.status_list, 'mean'),
+                           (['outside_T', 'TAH_fpm']
+                            + self._sensor_groups[0]
+                            + self._sensor_groups[1],
+                            self.resample_method)])
+            plot = vconcat(
                 self.plotStatus().properties(
                     width=self.def_width,
                     height=self.def_height * self.stat_height_mod
@@ -90,8 +93,6 @@ class PandW(StreamPlot):
         ).configure_view(
             cornerRadius=2
         )
+        spec = self.toSpec(plot)
 
-        message([F"{'Altair plot gen:': <20}", F"{time.time() - tic:.2f} s"],
-                tbl=self.mssg_tbl, mssgType='TIMING')
-
-        return [plot]
+        return [spec]
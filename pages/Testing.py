@@ -1,8 +1,6 @@
 import streamlit as st
-import altair as alt
-import time
-from StreamPlot import StreamPlot
-from log_message import message
+from StreamPlot import StreamPlot, hconcat
+import profiler
 
 
 class Testing(StreamPlot):
@@ -13,12 +11,12 @@ class Testing(StreamPlot):
                  resample_N,
                  date_range,
                  onlyPlots=False,
-                 sensor_container=None):
-        super().__init__(resample_N)
-
-        display_log = st.sidebar.checkbox("Display Log")
-        if display_log:
-            self.makeDebugTbl()
+                 sensor_container=None,
+                 resample_method='mean',
+                 live=False,
+                 data_source='Pi'):
+        super().__init__(resample_N, resample_method, live=live,
+                         data_source=data_source)
 
         self.makeWEL(date_range)
 
@@ -43,11 +41,11 @@ class Testing(StreamPlot):
         return sensor_groups
 
     def _plots(self):
-        tic = time.time()
         # if self._sensor_groups is None:
         #     self._sensor_groups = [self.in_default]
-        with st.spinner('Generating Plots'):
-            plot = alt.hconcat(
+        with st.spinner('Generating Plots'), \
+                profiler.span('Chart build'):
+            plot = hconcat(
                 self.plotNonTime('T_diff', 'T_diff_eff').properties(
                                  width=self.def_width),
                 self.plotNonTime('solar_w', 'geo_tot_w').properties(
@@ -65,8 +63,6 @@ class Testing(StreamPlot):
         ).configure_view(
             cornerRadius=2
         )
+        spec = self.toSpec(plot)
 
-        message([F"{'Altair plot gen:': <20}", F"{time.time() - tic:.2f} s"],
-                tbl=self.mssg_tbl, mssgType='TIMING')
-
-        return [plot, plot]
+        return [spec, spec]
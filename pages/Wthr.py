@@ -1,8 +1,6 @@
 import streamlit as st
-import altair as alt
-import time
-from StreamPlot import StreamPlot
-from log_message import message
+from StreamPlot import StreamPlot, vconcat
+import profiler
 
 
 class Wthr(StreamPlot):
@@ -17,12 +15,12 @@ class Wthr(StreamPlot):
                  resample_N,
                  date_range,
                  onlyPlots=False,
-                 sensor_container=None):
-        super().__init__(resample_N)
-
-        display_log = st.sidebar.checkbox("Display Log")
-        if display_log:
-            self.makeDebugTbl()
+                 sensor_container=None,
+                 resample_method='mean',
+                 live=False,
+                 data_source='Pi'):
+        super().__init__(resample_N, resample_method, live=live,
+                         data_source=data_source)
 
         self.makeWEL(date_range)
 
@@ -49,11 +47,17 @@ class Wthr(StreamPlot):
         return sensor_groups
 
     def _plots(self):
-        tic = time.time()
         if self._sensor_groups is None:
             self._sensor_groups = [self.wthr_default, self.in_humid_default]
-        with st.spinner('Generating Plots'):
-            plot = alt.vconcat(
+        with st.spinner('Generating Plots'), \
+                profiler.span('Chart build'):
+            self.planData([(['daylight'] + self.status_list, 'mean'),
+                           (['outside_T', 'rain_accum_R', 'weather_station_W']
+                            + self._sensor_groups[0]
+                            + self.out_humid_default
+                            + self._sensor_groups[1],
+                            self.resample_method)])
+            plot = vconcat(
                 self.plotStatus().properties(
                     width=self.def_width,
                     height=self.def_height * self.stat_height_mod
@@ -105,8 +109,6 @@ class Wthr(StreamPlot):
         ).configure_view(
             cornerRadius=2
         )
+        spec = self.toSpec(plot)
 
-        message([F"{'Altair plot gen:': <20}", F"{time.time() - tic:.2f} s"],
-                tbl=self.mssg_tbl, mssgType='TIMING')
-
-        return [plot]
+        return [spec]
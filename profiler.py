@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+"""
+Nested timing spans for a render. A Profiler is activated for the thread
+running a Streamlit session, and code anywhere in the pipeline opens spans
+with the module level span(), which do nothing when no profiler is active.
+Spans can carry row and byte counts. Results are shown as a table, or
+exported in the Chrome trace event format, which chrome://tracing and
+Perfetto open.
+"""
+_local = threading.local()
+
+
+class Span:
+    name = None
+    depth = None
+    start = None
+    end = None
+    rows = None
+    nbytes = None
+
+    def __init__(self,
+                 name,
+                 depth=0):
+        self.name = name
+        self.depth = depth
+        self.start = time.perf_counter()
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Profiler:
+    spans = None
+    _depth = None
+    _origin = None
+
+    def __init__(self):
+        self.spans = []
+        self._depth = 0
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self,
+             name):
+        entry = Span(name, self._depth)
+        self.spans.append(entry)
+        self._depth += 1
+        try:
+            yield entry
+        finally:
+            self._depth -= 1
+            entry.end = time.perf_counter()
+
+    def table(self):
+        """
+        Returns a dataframe of the spans in start order, indented by depth.
+        """
+        return pd.DataFrame(
+            [{'Span': " " * 2 * entry.depth + entry.name,
+              'ms': round(entry.duration * 1000, 1),
+              'rows': entry.rows,
+              'kB': (None if entry.nbytes is None
+                     else round(entry.nbytes / 1024, 1))}
+             for entry in self.spans]).set_index('Span')
+
+    def trace(self):
+        """
+        Returns the spans as a Chrome trace event JSON string.
+        """
+        events = []
+        for entry in self.spans:
+            args = {}
+            if entry.rows is not None:
+                args['rows'] = int(entry.rows)
+            if entry.nbytes is not None:
+                args['bytes'] = int(entry.nbytes)
+            events.append({'name': entry.name,
+                           'ph': 'X',
+                           'ts': (entry.start - self._origin) * 1e6,
+                           'dur': entry.duration * 1e6,
+                           'pid': 0,
+                           'tid': 0,
+                           'args': args})
+        return json.dumps({'traceEvents': events,
+                           'displayTimeUnit': 'ms'})
+
+
+def activate(profiler):
+    """
+    Make profiler the target of span() in the current thread, None to stop.
+    """
+    _local.profiler = profiler
+
+
+def current():
+    return getattr(_local, 'profiler', None)
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block under the active profiler. Yields the Span so the block can
+    set rows and nbytes; without an active profiler it is not recorded.
+    """
+    profiler = current()
+    if profiler is None:
+        yield Span(name)
+        return
+    with profiler.span(name) as entry:
+        yield entry
@@ -0,0 +1,119 @@
+import os
+import argparse
+import datetime as dt
+from pytz import timezone
+from log_message import message
+from config import configValue
+from WELData import mongoConnect
+from backends import MongoBackend, ParquetBackend
+
+"""
+Keeps a local columnar replica of the Pi's history on the frontend host. Each
+closed UTC day is pulled from Mongo in one bulk read and stored as a zstd
+compressed Parquet day file, which WELData then reads for past ranges while
+the current day stays live from Mongo, see backends.ReplicaBackend. The
+directory is set in config.txt:
+
+    replica_path: /home/ubuntu/WEL/replica_db/
+
+Run from cron on the frontend host, e.g. hourly, to add the days closed since
+the last run. The first run copies all of history. Days are copied as
+stored, so after a materialize.py backfill the backfilled days should be
+copied again with --force:
+
+python3 replica.py [--start 2020-03-21] [--end 2021-03-01] [--force]
+"""
+DB_TZONE = timezone('UTC')
+FIRST_DAY = dt.date(2020, 3, 21)
+# Time after midnight for the day's last posts and metrics to land
+SETTLE = dt.timedelta(minutes=15)
+
+
+def lastClosedDay(now):
+    """
+    Returns the last UTC day which is closed and settled at now.
+    """
+    return (now - SETTLE).astimezone(DB_TZONE).date() - dt.timedelta(days=1)
+
+
+def replicateDay(live,
+                 replica,
+                 day):
+    """
+    Copy one UTC day from the live backend into the replica.
+
+    returns number of samples copied.
+    """
+    start = DB_TZONE.localize(dt.datetime.combine(day,
+                                                  dt.datetime.min.time()))
+    frame = live.fetch([start, start + dt.timedelta(days=1)
+                        - dt.timedelta(milliseconds=1)])
+    if len(frame) == 0:
+        return 0
+    replica.write(frame)
+    return len(frame)
+
+
+def syncReplica(mongo_db,
+                path,
+                start=None,
+                end=None,
+                force=False):
+    """
+    Copy the closed days which are not in the replica yet.
+
+    mongo_db : database with the data collection.
+    path : directory of the replica's day files.
+    optional start : first day to copy. Default the day after the last
+                     replicated day, or the first day of data.
+    optional end : last day to copy. Default the last closed day.
+    optional force : copy days already in the replica again.
+
+    returns number of days copied.
+    """
+    live = MongoBackend(mongo_db)
+    replica = ParquetBackend(path)
+    if start is None:
+        replicated = replica.days()
+        start = (replicated[-1] + dt.timedelta(days=1) if replicated
+                 else FIRST_DAY)
+    last = lastClosedDay(dt.datetime.now(DB_TZONE))
+    if end is not None:
+        last = min(end, last)
+    copied = 0
+    day = start
+    while day <= last:
+        if force or not os.path.exists(replica.dayPath(day)):
+            count = replicateDay(live, replica, day)
+            copied += count > 0
+            message([F"{day:%Y-%m-%d}: ", F"{count} samples"],
+                    mssgType='ADMIN')
+        day += dt.timedelta(days=1)
+    message(F"Replica synced to {last:%Y-%m-%d}, {copied} days copied",
+            mssgType='SUCCESS')
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start', type=dt.date.fromisoformat,
+                        help='first day to copy as iso string.')
+    parser.add_argument('--end', type=dt.date.fromisoformat,
+                        help='last day to copy as iso string.')
+    parser.add_argument('--force', action='store_true',
+                        help='copy days already in the replica again.')
+    parser.add_argument('--path', type=str, action='store',
+                        help='replica directory, default replica_path from '
+                             'config.txt.')
+    args = parser.parse_args()
+
+    path = args.path or (configValue('replica_path') or [None])[0]
+    if path is None:
+        raise Exception("No replica directory, set replica_path in "
+                        "config.txt or pass --path")
+    syncReplica(mongoConnect(), path, start=args.start, end=args.end,
+                force=args.force)
+
+
+if __name__ == "__main__":
+    main()
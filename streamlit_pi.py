@@ -1,12 +1,17 @@
 import streamlit as st
 import numpy as np
 import datetime as dt
-import time
 import subprocess
 import json
 import platform
+import time
 import pytz
 from log_message import message
+from StreamPlot import dataCache, cacheWarmer, LIVE_POLL
+from CacheWarmer import roundMinute
+from downsample import METHODS
+from profiler import Profiler
+import profiler
 from pages.PandW import PandW
 from pages.Monit import Monit
 from pages.Wthr import Wthr
@@ -14,6 +19,8 @@ from pages.Testing import Testing
 
 
 to_tz = pytz.timezone('America/New_York')
+LIVE_RERUN = dt.timedelta(minutes=10)   # full redraw of live tailed charts
+LIVE_SLICE = 1      # seconds, between checks for widget changes while tailing
 st.set_page_config(page_title="Geo Monitor",
                    page_icon="🌀",
                    initial_sidebar_state='auto')
@@ -22,6 +29,7 @@ st.set_page_config(page_title="Geo Monitor",
 @st.cache()
 def _serverStartup():
     message("Server Started", mssgType='ADMIN')
+    cacheWarmer()
 
 
 def _date_select():
@@ -38,22 +46,15 @@ def _date_select():
     if selected_today:
         date_range[1] = local_now
     else:
-        date_range[1] = dt.datetime.combine(date_range[1],
-                                            dt.datetime.min.time())
+        date_range[1] = to_tz.localize(
+            dt.datetime.combine(date_range[1], dt.datetime.min.time()))
     if date_range[0] == local_now.date():
         date_range[0] = local_now - dt.timedelta(hours=6)
     else:
-        date_range[0] = dt.datetime.combine(date_range[0],
-                                            dt.datetime.min.time())
+        date_range[0] = to_tz.localize(
+            dt.datetime.combine(date_range[0], dt.datetime.min.time()))
 
-    def min_round(time):
-        time = time.replace(microsecond=0)
-        if time.second > 29:
-            time = time + dt.timedelta(minutes=1)
-        time = time.replace(second=0)
-        return time
-
-    date_range = [min_round(date.astimezone(to_tz)) for date in date_range]
+    date_range = [roundMinute(date.astimezone(to_tz)) for date in date_range]
 
     return date_range
 
@@ -76,38 +77,95 @@ def ping(host):
 
 
 def calc_stats(stp):
-    last_rev_valve = np.round(stp.dat_resample['rev_valve_b'][-1] % 2)
+    # Exact over the full resolution data of the range, or the sample counts
+    # of tile buckets, independent of the number of plotted samples
+    stats = stp.dat.runningStats().query(stp.dat.timerange)
+    last_rev_valve = np.round(stats['rev_valve_b'] % 2)
     rev_valve_stat = {1: "Cooling", 0: "Heating"}
-    N = len(stp.dat_resample)
-    heat_2_count = (stp.dat_resample['heat_2_b'] % 2).sum()
-    heat_1_count = (stp.dat_resample['heat_1_b'] % 2).sum() - heat_2_count
-    # Heat 1 is ~80% of full power
-    duty = 100 * ((0.8 * heat_1_count + heat_2_count) / N)
-    try:
-        house_w_avg = stp.dat_resample['house_w'].mean() / 1000
-        geo_w_avg = stp.dat_resample['power_tot'].mean() / 1000
-    except KeyError:
-        message("House power data not available", mssgType='WARNING',
-                tbl=stp.mssg_tbl)
-        house_w_avg = np.nan
-        geo_w_avg = np.nan
-    return [duty, house_w_avg, geo_w_avg, rev_valve_stat[last_rev_valve]]
-
-
-def _page_select(resample_N, date_range, sensor_container, which):
+    if np.isnan(stats['house_w']) or np.isnan(stats['geo_w']):
+        message("House power data not available", mssgType='WARNING')
+    return [stats['duty'], stats['house_w'] / 1000, stats['geo_w'] / 1000,
+            rev_valve_stat.get(last_rev_valve, "Unknown")]
+
+
+def _cacheInfo():
+    cache = dataCache()
+    warmer = cacheWarmer()
+    st.sidebar.markdown(F"Cache: `{cache.residentBytes() / 2**20:.1f} MB` "
+                        F"hit ratio `{cache.hitRatio():.0%}` "
+                        + " ".join(F"{key} `{value}`"
+                                   for key, value in cache.stats.items()))
+    last_run = ("never" if warmer.last_run is None
+                else F"{warmer.last_run:%H:%M}")
+    st.sidebar.markdown(F"Warmed: `{warmer.runs}` runs, last `{last_run}` "
+                        + " ".join(F"{key} `{value}`"
+                                   for key, value
+                                   in cache.warm_stats.items()))
+    info = cache.info()
+    if not info.empty:
+        st.sidebar.dataframe(info)
+
+
+def _profilerPanel(prof, container):
+    container.subheader("Profiler:")
+    container.dataframe(prof.table())
+    container.download_button("Download Trace", prof.trace(),
+                              file_name="welpi_trace.json",
+                              mime="application/json")
+
+
+def _page_select(resample_N, date_range, sensor_container, which,
+                 resample_method='mean', live=False):
     if which == 'monit':
-        stp = Monit(resample_N, date_range, sensor_container=sensor_container)
+        stp = Monit(resample_N, date_range, sensor_container=sensor_container,
+                    resample_method=resample_method, live=live)
     if which == 'pandw':
-        stp = PandW(resample_N, date_range, sensor_container=sensor_container)
+        stp = PandW(resample_N, date_range, sensor_container=sensor_container,
+                    resample_method=resample_method, live=live)
     if which == 'wthr':
-        stp = Wthr(resample_N, date_range, sensor_container=sensor_container)
+        stp = Wthr(resample_N, date_range, sensor_container=sensor_container,
+                   resample_method=resample_method, live=live)
     if which == 'test':
         stp = Testing(resample_N, date_range,
-                      sensor_container=sensor_container)
+                      sensor_container=sensor_container,
+                      resample_method=resample_method, live=live)
 
     return stp
 
 
+def _liveTail(stp, elements, status):
+    """
+    Append new samples to the displayed charts every LIVE_POLL seconds,
+    instead of redrawing them. Charts are redrawn in full every LIVE_RERUN,
+    which also refreshes the stats and the charts which aren't tailed.
+    Elements only take rows from their own script run, so the run waits
+    between polls. Waits end on the LIVE_POLL grid, where the first session
+    fetches for all. Streamlit only stops a run at its st calls, so the wait
+    updates status every LIVE_SLICE, and a widget change or a closed session
+    ends the run within a slice.
+    """
+    rerun = dt.datetime.now() + LIVE_RERUN
+    while dt.datetime.now() < rerun:
+        # Just past the grid, so the poll ends at the grid point reached
+        now = time.time()
+        poll = now - now % LIVE_POLL + LIVE_POLL + 1
+        while time.time() < poll:
+            status.caption(F"Next poll in `{poll - time.time():.0f} s`")
+            time.sleep(min(LIVE_SLICE, max(poll - time.time(), 0)))
+        rows = stp.liveRows()
+        for element in elements:
+            for name, frame in rows.items():
+                element.add_rows(**{name: frame})
+    st.experimental_rerun()
+
+
+def _methodFormatFunc(option):
+    method = {'mean': "Bucket Mean",
+              'minmax': "Min/Max Envelope",
+              'lttb': "Largest Triangle"}
+    return method[option]
+
+
 def _whichFormatFunc(option):
     which = {'monit': "Main",
              'pandw': "Power and Water",
@@ -171,24 +229,46 @@ def main():
     resample_N = st.sidebar.slider("Number of Data Samples",
                                    min_value=10, max_value=max_samples,
                                    value=720, step=10)
+    resample_method = st.sidebar.selectbox("Downsampling",
+                                           METHODS,
+                                           index=0,
+                                           format_func=_methodFormatFunc)
+    # Only ranges reaching up to now get new samples
+    tailable = date_range[1] >= (dt.datetime.now(to_tz)
+                                 - dt.timedelta(minutes=1))
+    live = (st.sidebar.checkbox("Live Tail", disabled=not tailable)
+            and tailable)
+    live_status = st.sidebar.empty()
+    display_profiler = st.sidebar.checkbox("Display Profiler")
+    profiler_container = st.sidebar.container()
+    # Script runs reuse threads, so always reset the thread's profiler
+    prof = Profiler() if display_profiler else None
+    profiler.activate(prof)
 
     # -- main area --
     st.header(F"{_whichFormatFunc(which)} Monitor")
 
-    stp = _page_select(resample_N, date_range, sensor_container, which)
-    stats = calc_stats(stp)
+    with profiler.span('Page'):
+        stp = _page_select(resample_N, date_range, sensor_container, which,
+                           resample_method, live)
+    with profiler.span('Stats'):
+        stats = calc_stats(stp)
     stats_containers[0].markdown(F"System Duty: `{stats[0]:.1f} %`"
                                  F" `{stats[3]}`")
     stats_containers[1].markdown(F"House Mean Power Use: `{stats[1]:.2f} kW`")
     stats_containers[1].markdown(F"Geo Mean Power Use: `{stats[2]:.2f} kW | "
                                  F"{100 * stats[2] / stats[1]:.0f} %`")
-    tic = time.time()
-    for plot in stp.plots:
-        st.altair_chart(plot)
-    message([F"{'Altair plot disp:': <20}", F"{time.time() - tic:.2f} s"],
-            tbl=stp.mssg_tbl, mssgType='TIMING')
+    with profiler.span('Chart display'):
+        elements = [st.vega_lite_chart(plot) for plot in stp.plots]
+    if prof is not None:
+        _profilerPanel(prof, profiler_container)
+        profiler.activate(None)
+    if st.sidebar.checkbox("Display Cache"):
+        _cacheInfo()
     st.sidebar.markdown("[Github Project]"
                         "(https://github.com/TristanShoemaker/WELPi)")
+    if stp.live:
+        _liveTail(stp, elements, live_status)
 
 
 if __name__ == "__main__":
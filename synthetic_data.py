@@ -0,0 +1,385 @@
+import zlib
+import datetime as dt
+import numpy as np
+import pandas as pd
+from astral import sun, LocationInfo
+from config import TO_TZONE
+
+"""
+Deterministic synthetic sensor data, shaped like what the Pi logs, so the
+pipeline can be run and benchmarked without the Mongo server. Every raw
+column of StreamPlot.sensor_list is generated at the 30 s logging cadence:
+seasonal and daily outside temperatures with day to day weather, heat pump
+cycling driven by heating and cooling demand in the WEL status encoding,
+the power meters and Emporia channels following it, solar, room and water
+temperatures, humidities and the weather station.
+
+Values depend only on the sample time and seed, drawn per UTC day, so any
+range, or a range read in pieces, gives the same samples.
+"""
+SAMPLE_PERIOD = 30          # seconds
+DAY_SAMPLES = 86400 // SAMPLE_PERIOD
+CYCLE_SAMPLES = 60          # heat pump cycle, 30 min
+DROPOUT = 0.005             # fraction of samples missing per column
+LOC = LocationInfo('Home', 'MA', 'America/New_York', 42.485557, -71.433445)
+
+# WEL status channels with their plot offsets, the bit is the value mod 2
+STATUS = {'aux_heat_b': 0, 'heat_1_b': 2, 'heat_2_b': 4, 'rev_valve_b': 6,
+          'TAH_fan_b': 8, 'zone_1_b': 10, 'zone_2_b': 12, 'humid_b': 14}
+# Indoor temperatures and humidities: mean, daily swing, noise
+ROOMS = {'living_T': (20.5, 1.0, 0.1), 'T_room_T': (20.0, 1.2, 0.1),
+         'D_room_T': (19.5, 1.0, 0.1), 'V_room_T': (19.0, 1.5, 0.1),
+         'fireplace_T': (21.0, 1.5, 0.1), 'trist_T': (20.0, 1.0, 0.1),
+         'base_T': (16.0, 0.3, 0.05), 'basement_T': (15.5, 0.3, 0.05),
+         'T_room_H': (40.0, 3.0, 0.5), 'D_room_H': (42.0, 3.0, 0.5),
+         'V_room_H': (41.0, 3.0, 0.5), 'fireplace_H': (38.0, 3.0, 0.5),
+         'basement_H': (55.0, 2.0, 0.5), 'barn_sump_H': (80.0, 2.0, 0.5)}
+# Water and refrigerant temperatures: off, heating, cooling, noise
+PLANT = {'liqu_refrig_T': (20.0, 38.0, 28.0, 0.5),
+         'gas_refrig_T': (18.0, 65.0, 8.0, 1.0),
+         'desup_T': (32.0, 52.0, 48.0, 0.5),
+         'desup_return_T': (30.0, 45.0, 42.0, 0.5),
+         'house_hot_T': (48.0, 50.0, 50.0, 0.3),
+         'tank_h2o_T': (46.0, 49.0, 49.0, 0.3),
+         'buderus_h2o_T': (52.0, 55.0, 55.0, 0.3)}
+# Emporia circuits: base load, noise, (hours, power) of daily use
+CIRCUITS = {'Emp_Bath_Attic_w': (40, 10, (7, 400)),
+            'Emp_K&T_front_w': (120, 20, (19, 300)),
+            'Emp_Kitchen_w': (150, 30, (18, 1500)),
+            'Emp_K&T_Back_w': (80, 15, (20, 200)),
+            'Emp_Dehumid+Washer_w': (5, 2, (10, 600)),
+            'Emp_Barn_w': (60, 10, (8, 250))}
+COLUMNS = (['TAH_W', 'HP_W', 'TAH_fpm', 'outside_T', 'TAH_in_T',
+            'TAH_out_T', 'loop_in_T', 'loop_out_T', 'wood_fire_T', 'daylight',
+            'weather_station_T', 'weather_station_H', 'weather_station_W',
+            'weather_station_A', 'weather_station_R', 'weather_station_UV',
+            'weather_station_LUX', 'outside_shade_T', 'outside_shade_H',
+            'attic_T', 'attic_H', 'barn_T', 'barn_H', 'barn_sump_T',
+            'barn_sump_2_T', 'deg_day_eff', 'Emp_TAH_w', 'Emp_TES_w',
+            'Emp_Solar_w', 'Emp_Tesla_w', 'Emp_Dryer_w', 'Emp_Total_w',
+            'Emp_balance_w', 'house_w', 'solar_w', 'dehumidifier_w',
+            'house_ops_w', 'power_tot_pi', 'furnace_w', 'TES_sense_w',
+            'TAH_sense_w']
+           + list(STATUS) + list(ROOMS) + list(PLANT) + list(CIRCUITS))
+
+
+def _rng(seed,
+         name,
+         day):
+    return np.random.default_rng([seed, zlib.crc32(name.encode()), day])
+
+
+def _daily(seed,
+           name,
+           day,
+           fraction,
+           scale):
+    # Normal day to day values, linearly interpolated through the day so
+    # they don't jump at midnight
+    start = _rng(seed, name, day).normal(0, scale)
+    end = _rng(seed, name, day + 1).normal(0, scale)
+    return start + (end - start) * fraction
+
+
+class _Day:
+    """
+    Drivers shared by the columns of one UTC day: local hours, sun, outside
+    temperature, clouds and the heat pump's state.
+    """
+    def __init__(self,
+                 day,
+                 seed):
+        self.day = day
+        self.seed = seed
+        self.index = pd.date_range(
+            pd.Timestamp(day * 86400, unit='s', tz='UTC'),
+            periods=DAY_SAMPLES, freq=F"{SAMPLE_PERIOD}s")
+        # Daily cycles follow local wall clock time
+        local = self.index.tz_convert(TO_TZONE).tz_localize(None)
+        self.n = len(self.index)
+        fraction = np.arange(self.n) / self.n
+        self.hour = (local.hour + local.minute / 60).to_numpy()
+        doy = local.dayofyear.to_numpy()
+        self.sun = np.zeros(self.n)
+        for date in np.unique(local.date):
+            rise = sun.sunrise(LOC.observer, date=date, tzinfo=TO_TZONE)
+            sets = sun.sunset(LOC.observer, date=date, tzinfo=TO_TZONE)
+            rise = rise.hour + rise.minute / 60
+            sets = sets.hour + sets.minute / 60
+            on = local.date == date
+            self.sun[on] = np.clip(np.sin(np.pi * (self.hour[on] - rise)
+                                          / (sets - rise)), 0, None)
+        self.daylight = (self.sun > 0) * 1.
+        self.clouds = np.clip(0.4 + _daily(seed, 'clouds', day, fraction,
+                                           0.35), 0, 1)
+        self.outside = (9 - 13 * np.cos(2 * np.pi * (doy - 20) / 365.25)
+                        + 5 * np.cos(2 * np.pi * (self.hour - 15) / 24)
+                        * (1 - 0.5 * self.clouds)
+                        + _daily(seed, 'weather', day, fraction, 4))
+        # Heat pump cycles with an on fraction of the demand
+        phase = (day * DAY_SAMPLES + np.arange(self.n)) % CYCLE_SAMPLES
+        phase = phase / CYCLE_SAMPLES
+        heat = np.clip((16 - self.outside) / 22, 0, 1)
+        cool = np.clip((self.outside - 24) / 10, 0, 1)
+        self.cooling = cool > 0
+        demand = np.where(self.cooling, cool, heat)
+        self.heat_1 = phase < demand
+        self.heat_2 = self.heat_1 & (phase < (demand - 0.6) / 0.4)
+        self.aux = self.heat_2 & (self.outside < -12)
+        self.fan = self.heat_1 | (phase < 0.1)
+        self.zone_2 = self.heat_1 & (phase < demand * 0.6)
+        self.humid = self.heat_1 & ~self.cooling & (self.outside < 0)
+
+    def noise(self,
+              name,
+              scale):
+        return _rng(self.seed, name, self.day).normal(0, scale, self.n)
+
+    def events(self,
+               name,
+               hour,
+               power,
+               hours=1.0,
+               chance=0.7):
+        # One block of use around hour on some days
+        rng = _rng(self.seed, name + '_event', self.day)
+        if rng.random() > chance:
+            return np.zeros(self.n)
+        start = (hour + rng.normal(0, 1)) % 24
+        return power * ((self.hour >= start)
+                        & (self.hour < start + hours))
+
+    def column(self,
+               name):
+        if name in STATUS:
+            bit = {'aux_heat_b': self.aux, 'heat_1_b': self.heat_1,
+                   'heat_2_b': self.heat_2, 'rev_valve_b': self.cooling,
+                   'TAH_fan_b': self.fan, 'zone_1_b': self.heat_1,
+                   'zone_2_b': self.zone_2, 'humid_b': self.humid}[name]
+            return STATUS[name] + bit * 1.
+        if name in ROOMS:
+            mean, swing, noise = ROOMS[name]
+            return (mean + swing * np.cos(2 * np.pi * (self.hour - 17) / 24)
+                    + 0.05 * (self.outside - 9) + self.noise(name, noise))
+        if name in PLANT:
+            off, heating, cooling, noise = PLANT[name]
+            return (np.where(self.heat_1,
+                             np.where(self.cooling, cooling, heating), off)
+                    + self.noise(name, noise))
+        if name in CIRCUITS:
+            base, noise, (hour, power) = CIRCUITS[name]
+            return np.abs(base + self.noise(name, noise)
+                          + self.events(name, hour, power))
+        return getattr(self, '_' + name.replace('+', '_'))()
+
+    def _HP_W(self):
+        return np.clip(self.heat_1 * 2600 + self.heat_2 * 900 + self.aux * 5000
+                       + self.noise('HP_W', 30), 0, None)
+
+    def _TAH_W(self):
+        return np.clip(self.fan * 180 + self.heat_1 * 170 + self.heat_2 * 120
+                       + self.noise('TAH_W', 10), 0, None)
+
+    def _TAH_fpm(self):
+        return np.clip(self.fan * 250 + self.heat_1 * 150 + self.heat_2 * 80
+                       + self.noise('TAH_fpm', 10), 0, None)
+
+    def _Emp_TES_w(self):
+        return np.abs(self._HP_W() * 1.02 + self.noise('Emp_TES_w', 10))
+
+    def _Emp_TAH_w(self):
+        return np.abs(self._TAH_W() * 1.02 + self.noise('Emp_TAH_w', 5))
+
+    def _outside_T(self):
+        return self.outside + self.noise('outside_T', 0.1)
+
+    def _TAH_in_T(self):
+        return 19.5 + self.noise('TAH_in_T', 0.2)
+
+    def _TAH_out_T(self):
+        rise = np.where(self.cooling, -8, 14 + 6 * self.heat_2)
+        return 19.5 + self.heat_1 * rise + self.noise('TAH_out_T', 0.3)
+
+    def _loop_in_T(self):
+        ground = 10 + 0.1 * (self.outside - 9)
+        return (ground - np.where(self.cooling, -3, 3) * self.heat_1
+                + self.noise('loop_in_T', 0.1))
+
+    def _loop_out_T(self):
+        return (self._loop_in_T()
+                + np.where(self.cooling, 4, -3) * self.heat_1
+                + self.noise('loop_out_T', 0.1))
+
+    def _wood_fire_T(self):
+        fire = self.events('wood_fire', 18, 180, hours=4,
+                           chance=np.clip((5 - self.outside.mean()) / 10,
+                                          0, 1))
+        return 20 + fire + self.noise('wood_fire_T', 0.5)
+
+    def _daylight(self):
+        return self.daylight
+
+    def _weather_station_T(self):
+        return (self.outside + 3 * self.sun * (1 - self.clouds)
+                + self.noise('weather_station_T', 0.2))
+
+    def _weather_station_H(self):
+        return np.clip(70 - 0.8 * (self.outside - 9) + 15 * self.clouds
+                       - 10 * self.sun + self.noise('weather_station_H', 1),
+                       5, 100)
+
+    def _weather_station_W(self):
+        return np.abs(2 + 3 * self.clouds + self.noise('weather_station_W',
+                                                       1.5))
+
+    def _weather_station_A(self):
+        return (200 + 60 * self.clouds
+                + self.noise('weather_station_A', 30)) % 360
+
+    def _weather_station_R(self):
+        # Daily total, restarting at local midnight
+        rain = (self.clouds > 0.7) * np.abs(self.noise('weather_station_R',
+                                                       0.02))
+        midnight = np.concatenate(([True], np.diff(self.hour) < 0))
+        total = np.cumsum(rain)
+        return total - np.maximum.accumulate(np.where(midnight, total - rain,
+                                                      0))
+
+    def _weather_station_UV(self):
+        return 8 * self.sun * (1 - 0.7 * self.clouds)
+
+    def _weather_station_LUX(self):
+        return 100000 * self.sun * (1 - 0.8 * self.clouds)
+
+    def _outside_shade_T(self):
+        return self.outside + self.noise('outside_shade_T', 0.2)
+
+    def _outside_shade_H(self):
+        return np.clip(self._weather_station_H()
+                       + self.noise('outside_shade_H', 1), 5, 100)
+
+    def _attic_T(self):
+        return (self.outside + 12 * self.sun * (1 - self.clouds)
+                + self.noise('attic_T', 0.3))
+
+    def _attic_H(self):
+        return np.clip(60 - (self._attic_T() - self.outside)
+                       + self.noise('attic_H', 1), 5, 100)
+
+    def _barn_T(self):
+        return self.outside + 2 + self.noise('barn_T', 0.2)
+
+    def _barn_H(self):
+        return np.clip(self._weather_station_H() - 5
+                       + self.noise('barn_H', 1), 5, 100)
+
+    def _barn_sump_T(self):
+        return 8 + 0.1 * self.outside + self.noise('barn_sump_T', 0.05)
+
+    def _barn_sump_2_T(self):
+        return 8.5 + 0.1 * self.outside + self.noise('barn_sump_2_T', 0.05)
+
+    def _deg_day_eff(self):
+        return (np.clip(18 - self.outside, 0, None) / 24
+                + self.noise('deg_day_eff', 0.01))
+
+    def _Emp_Solar_w(self):
+        # Already negative like the Emporia reading
+        return -np.clip(5000 * self.sun * (1 - 0.8 * self.clouds)
+                        + self.noise('Emp_Solar_w', 20), 0, None)
+
+    def _Emp_Tesla_w(self):
+        return self.events('Emp_Tesla_w', 23, 7000, hours=3, chance=0.4)
+
+    def _Emp_Dryer_w(self):
+        return (self.events('Emp_Dryer_w', 14, 4500, chance=0.3)
+                + np.abs(self.noise('Emp_Dryer_w', 1)))
+
+    def _Emp_balance_w(self):
+        return 150 + self.noise('Emp_balance_w', 40)
+
+    def _Emp_Total_w(self):
+        return (sum(self.column(name) for name in CIRCUITS)
+                + self._Emp_TES_w() + self._Emp_TAH_w() + self._Emp_Solar_w()
+                + self._Emp_Tesla_w() + self._Emp_Dryer_w()
+                + self._Emp_balance_w())
+
+    def _house_w(self):
+        return self._Emp_Total_w() - self._Emp_Solar_w()
+
+    def _solar_w(self):
+        return -self._Emp_Solar_w()
+
+    def _dehumidifier_w(self):
+        return self.column('Emp_Dehumid+Washer_w')
+
+    def _house_ops_w(self):
+        return self._house_w() - self._HP_W() - self._TAH_W()
+
+    def _power_tot_pi(self):
+        return self._HP_W() + self._TAH_W()
+
+    def _furnace_w(self):
+        return self.aux * 150 + np.abs(self.noise('furnace_w', 2))
+
+    def _TES_sense_w(self):
+        return np.abs(self._HP_W() + self.noise('TES_sense_w', 15))
+
+    def _TAH_sense_w(self):
+        return np.abs(self._TAH_W() + self.noise('TAH_sense_w', 5))
+
+    def frame(self,
+              columns):
+        frame = pd.DataFrame({name: self.column(name) for name in columns},
+                             index=self.index)
+        for name in columns:
+            if name != 'daylight':
+                drop = _rng(self.seed, name + '_drop',
+                            self.day).random(self.n) < DROPOUT
+                frame.loc[drop, name] = np.nan
+        return frame
+
+
+def syntheticFrame(timerange,
+                   seed=0,
+                   columns=None):
+    """
+    Generate the samples within timerange.
+
+    timerange : start and end datetimes, tz aware or local.
+    optional seed : selects the data set, samples are the same for any
+                    range with the same seed.
+    optional columns : raw columns to generate. Default all of COLUMNS.
+
+    returns dataframe indexed by sample time in UTC.
+    """
+    start, end = [pd.Timestamp(time) for time in timerange]
+    start, end = [time.tz_localize(TO_TZONE) if time.tzinfo is None
+                  else time for time in (start, end)]
+    if columns is None:
+        columns = COLUMNS
+    columns = [name for name in columns if name in COLUMNS]
+    first = int(start.timestamp() // 86400)
+    last = int(end.timestamp() // 86400)
+    frame = pd.concat([_Day(day, seed).frame(columns)
+                       for day in range(first, last + 1)])
+    frame = frame[(frame.index >= start) & (frame.index <= end)]
+    frame.index.name = 'dateandtime'
+    return frame
+
+
+def syntheticDays(days,
+                  start=dt.date(2021, 1, 1),
+                  seed=0,
+                  columns=None):
+    """
+    Generate days of samples from local midnight of start.
+    """
+    def midnight(day):
+        return TO_TZONE.localize(dt.datetime.combine(day,
+                                                     dt.datetime.min.time()))
+
+    return syntheticFrame([midnight(start),
+                           midnight(start + dt.timedelta(days=days))
+                           - dt.timedelta(seconds=1)],
+                          seed, columns)
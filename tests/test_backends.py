@@ -0,0 +1,45 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+from backends import STATS, MongoBackend, SyntheticBackend, bucketStats
+from config import TO_TZONE
+
+"""
+Aggregates pushed down to a backend's engine must match bucketStats of the
+same samples.
+"""
+mongomock = pytest.importorskip('mongomock')
+DAY = [TO_TZONE.localize(dt.datetime(2021, 6, 1)),
+       TO_TZONE.localize(dt.datetime(2021, 6, 2))]
+COLUMNS = ['outside_T', 'heat_1_b']
+WIDTH = 3600
+
+
+def _samples():
+    frame = SyntheticBackend().fetch(DAY, COLUMNS).astype(np.float64)
+    # NaN and missing values, as posted when a sensor drops out
+    frame.iloc[5:40, 0] = np.nan
+    frame.iloc[100:400:3, 1] = np.nan
+    frame.iloc[600:900, 0] = np.nan
+    return frame
+
+
+def testMongoAggregate():
+    frame = _samples()
+    mongo_db = mongomock.MongoClient().WEL
+    docs = []
+    for time, row in frame.iterrows():
+        doc = {'dateandtime': time.to_pydatetime().replace(tzinfo=None)}
+        # outside_T stays in the document as NaN, heat_1_b is left out
+        doc.update({col: value for col, value in row.items()
+                    if col == 'outside_T' or not np.isnan(value)})
+        docs.append(doc)
+    mongo_db.data.insert_many(docs)
+    pushed = MongoBackend(mongo_db).aggregate(DAY, WIDTH, COLUMNS)
+    local = bucketStats(frame, WIDTH)
+    for stat in STATS:
+        pd.testing.assert_frame_equal(
+            pushed[stat][COLUMNS].astype(np.float64),
+            local[stat][COLUMNS].astype(np.float64), check_freq=False,
+            check_names=False)
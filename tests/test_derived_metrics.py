@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from derived_metrics import calculate
+
+"""
+Golden outputs of the derived metric kernels on a small fixed frame, so a
+change to a formula or constant shows up as a changed number. Samples are
+half hourly across a local midnight, with heat 1, heat 2 and a COP above the
+cutoff.
+"""
+INDEX = pd.date_range('2021-06-02 02:00', periods=8, freq='30min', tz='UTC')
+FRAME = pd.DataFrame({
+    'heat_1_b': [0, 1, 1, 1, 0, 1, 1, 0],
+    'heat_2_b': [0, 0, 1, 1, 0, 0, 1, 0],
+    'TAH_W': [0, 400, 420, 410, 0, 390, 430, 0],
+    'HP_W': [10, 2100, 3300, 3250, 12, 2050, 3400, 11],
+    'TAH_fpm': [0, 1.1, 1.5, 1.45, 0, 1.05, 1.6, 0],
+    'TAH_in_T': [20, 20.5, 20.4, 20.6, 20.8, 20.2, 20.1, 20.0],
+    'TAH_out_T': [20, 38.0, 44.5, 45.1, 21.0, 37.2, 45.8, 20.1],
+    'loop_in_T': [8.0, 7.5, 6.9, 6.8, 7.9, 7.6, 6.7, 7.9],
+    'loop_out_T': [8.1, 10.2, 10.9, 11.0, 8.0, 10.1, 11.2, 8.0],
+    'weather_station_R': [1.2, 1.2, 1.4, 1.5, 0.0, 0.1, 0.1, 0.3],
+}, index=INDEX).astype(np.float64)
+NAN = np.nan
+GOLDEN = {
+    'COP': [NAN, 3.0408070000, 3.8376334677, 3.8331086749, NAN, 2.8889932377,
+            NAN, NAN],
+    'well_W': [0.3176960000, 8.5777920000, 13.4553600000, 14.1281280000,
+               0.3176960000, 7.9424000000, 15.1372800000, 0.3176960000],
+    'well_COP': [NAN, 3.4311168000, 3.6170322581, 3.8601442623, NAN,
+                 3.2550819672, 3.9522924282, NAN],
+    # Offsets reset at local, not UTC, midnight
+    'rain_accum_R': [-0.0666666667, -0.0666666667, 0.1333333333, 0.2333333333,
+                     -0.0666666667, 0.0333333333, 0.0333333333, 0.2333333333],
+}
+
+
+@pytest.mark.parametrize('name', list(GOLDEN))
+def testGolden(name):
+    calced = calculate(FRAME, [name])[name]
+    np.testing.assert_allclose(calced.to_numpy(), GOLDEN[name], rtol=1e-9,
+                               atol=1e-9)
+
+
+def testUnsorted():
+    # Per sample metrics don't depend on row order
+    names = [name for name in GOLDEN if name != 'rain_accum_R']
+    shuffled = FRAME.sample(frac=1, random_state=0)
+    calced = calculate(shuffled, names).sort_index()
+    for name in names:
+        np.testing.assert_allclose(calced[name].to_numpy(), GOLDEN[name],
+                                   rtol=1e-9, atol=1e-9)
+
+
+def testInputUnchanged():
+    frame = FRAME.copy()
+    calculate(frame)
+    pd.testing.assert_frame_equal(frame, FRAME)
@@ -0,0 +1,58 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+from config import TO_TZONE
+from derived_metrics import calculate
+from synthetic_data import SAMPLE_PERIOD
+from WELData import WELData
+
+"""
+Loads and daily metrics across the 2021 DST changes. Local days are given
+as naive times, as the date selector does, and must come back the day's real
+length, indexed by UTC sample time.
+"""
+# Local days of the spring and fall changes, and their length in hours
+DST_DAYS = {dt.date(2021, 3, 14): 23, dt.date(2021, 11, 7): 25}
+
+
+def _midnights(day):
+    midnight = dt.datetime.combine(day, dt.datetime.min.time())
+    return [midnight, midnight + dt.timedelta(days=1)]
+
+
+@pytest.mark.parametrize('day, hours', list(DST_DAYS.items()))
+def testLoad(day,
+             hours):
+    midnights = _midnights(day)
+    dat = WELData(data_source='Synthetic', timerange=midnights)
+    index = dat.data.index
+    assert ([time.utcoffset() for time in dat.timerange]
+            == [TO_TZONE.localize(time).utcoffset() for time in midnights])
+    assert str(index.tz) == 'UTC'
+    assert index[0] == TO_TZONE.localize(midnights[0])
+    assert len(index) == hours * 3600 // SAMPLE_PERIOD + 1
+    assert (np.diff(index.asi8) == SAMPLE_PERIOD * 1_000_000_000).all()
+    # Spring skips 2 am, fall repeats 1 am
+    local = dat._localTime(index)
+    assert ([(local.hour == hour).sum() * SAMPLE_PERIOD // 3600
+             for hour in (1, 2)]
+            == [2 if hours == 25 else 1, 0 if hours == 23 else 1])
+
+
+@pytest.mark.parametrize('day', list(DST_DAYS))
+def testRainReset(day):
+    # Hourly samples over the local days around the change, with the rain
+    # counter constant within each local day, so its accumulation is zero
+    # only if offsets reset at local midnight
+    start = TO_TZONE.localize(_midnights(day - dt.timedelta(days=1))[0])
+    end = TO_TZONE.localize(_midnights(day + dt.timedelta(days=1))[1])
+    index = pd.date_range(start, end, freq='h', inclusive='left').tz_convert(
+        'UTC')
+    local_days = index.tz_convert(TO_TZONE).date
+    frame = pd.DataFrame({'weather_station_R':
+                          pd.factorize(local_days)[0] + 1.0},
+                         index=index)
+    rain = calculate(frame, ['rain_accum_R'])['rain_accum_R']
+    assert len(set(local_days)) == 3
+    assert (rain == 0).all()
@@ -0,0 +1,56 @@
+import datetime as dt
+from config import TO_TZONE
+import StreamPlot as plots
+from StreamPlot import StreamPlot
+
+"""
+Charts of a render of a synthetic day.
+"""
+DAY = [TO_TZONE.localize(dt.datetime(2021, 6, 1)),
+       TO_TZONE.localize(dt.datetime(2021, 6, 2))]
+
+
+def _plot():
+    plot = StreamPlot(resample_N=200, data_source='Synthetic')
+    plot.makeWEL(DAY)
+    return plot
+
+
+def testMissingName():
+    # A series missing from the data draws an empty chart, as before the
+    # long format data
+    plot = _plot()
+    charts = [plot.plotMainMonitor('no_such_T'),
+              plot.plotPowerStack(['no_such_w']),
+              plot.plotRollMean(['no_such_T'])]
+    for chart in charts:
+        spec = plot.toSpec(chart)
+    lines = [name for name in spec['datasets'] if name.startswith('lines')]
+    assert lines
+    assert all(spec['datasets'][name] == [] for name in lines)
+    assert len(spec['datasets']['daylight']) > 0
+
+
+def _barWidths(spec):
+    mark = spec.get('mark')
+    widths = ([mark['width']] if isinstance(mark, dict)
+              and mark.get('type') == 'bar' else [])
+    for compose in ['layer', 'vconcat', 'hconcat']:
+        for child in spec.get(compose, []):
+            widths += _barWidths(child)
+    return widths
+
+
+def testBarWidth():
+    # Ranges of different spans share the status template, each with its own
+    # bar width
+    templates = len(plots._templates)
+    widths = []
+    for hours in [6, 7]:
+        plot = StreamPlot(resample_N=200, data_source='Synthetic')
+        plot.makeWEL([DAY[0], DAY[0] + dt.timedelta(hours=hours)])
+        spec = plot.toSpec(plot.plotStatus())
+        assert set(_barWidths(spec)) == {plot._bar_width}
+        widths.append(plot._bar_width)
+    assert widths[0] != widths[1]
+    assert len(plots._templates) <= templates + 1
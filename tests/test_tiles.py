@@ -0,0 +1,65 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import StreamPlot
+from config import TO_TZONE
+from derived_metrics import materializedNames
+from TilePyramid import (STATS, TileData, _Tile, _aggregate, bucketWidth,
+                         tileSpan)
+from WELData import WELData
+
+"""
+Views read from tiles aggregated from synthetic data, as TilePyramid builds
+them from raw data.
+"""
+LEVEL = 5
+WEEK = [TO_TZONE.localize(dt.datetime(2021, 6, 1)),
+        TO_TZONE.localize(dt.datetime(2021, 6, 8))]
+
+
+class _Pyramid:
+    # Serves reads from tiles of the synthetic week
+    def read(self,
+             timerange,
+             n_out):
+        return _tileData(timerange)
+
+
+def _tileData(timerange):
+    dat = WELData(data_source='Synthetic', timerange=timerange)
+    frame = dat.getCols(list(dat.data.columns) + materializedNames())
+    span = tileSpan(LEVEL)
+    frames = []
+    for index in range(int(timerange[0].timestamp() // span),
+                       int(timerange[1].timestamp() // span) + 1):
+        rows = frame[frame.index.asi8 // 1_000_000_000 // span == index]
+        frames.append(_Tile(LEVEL, index, *_aggregate(rows, LEVEL, index),
+                            True, None).frames())
+    stats = {}
+    for stat in STATS:
+        stats[stat] = pd.concat([tile[stat] for tile in frames])
+        stats[stat].index.name = 'dateandtime'
+    return TileData(stats, timerange, LEVEL)
+
+
+def testRainAccum():
+    # Daily rain isn't per sample, so it isn't kept in tiles and is
+    # calculated from the bucket means
+    tiles = _tileData(WEEK)
+    assert 'rain_accum_R' in tiles.vars()
+    rain = tiles.getCols(['rain_accum_R'])['rain_accum_R']
+    assert np.isfinite(rain).sum() > 0
+    coarse = tiles.resampled(['rain_accum_R'], 4 * bucketWidth(LEVEL))
+    assert np.isfinite(coarse['rain_accum_R']).sum() > 0
+
+
+def testPlotRainAccum(monkeypatch):
+    monkeypatch.setattr(StreamPlot, 'tilePyramid', lambda: _Pyramid())
+    monkeypatch.setattr(StreamPlot, 'MIN_RANGE', dt.timedelta(days=1))
+    plot = StreamPlot.StreamPlot(resample_N=200)
+    plot.makeWEL(WEEK)
+    assert isinstance(plot.dat, TileData)
+    spec = plot.toSpec(plot.plotMainMonitor('rain_accum_R'))
+    lines = [name for name in spec['datasets'] if name.startswith('lines')]
+    assert lines
+    assert all(len(spec['datasets'][name]) > 0 for name in lines)
@@ -0,0 +1,232 @@
+import os
+import time
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib.pyplot as plt
+import altair as alt
+from altair.utils.html import spec_to_html
+from log_message import message
+from config import TO_TZONE
+from StreamPlot import dataCache
+from pages.Monit import Monit
+from pages.PandW import PandW
+from pages.Wthr import Wthr
+
+"""
+Renders dashboard pages for a list of ranges without a browser, e.g. every
+day of last month for a report. Ranges are rendered in parallel, one per
+worker process, and every page and format of a range is drawn from one data
+fetch. Run from the repository root:
+
+python3 -m utilities.batch_render                   every day of last month,
+                                                    all pages, as html
+python3 -m utilities.batch_render --start 2021-03-01 --end 2021-03-15
+                                  --period week --format html png svg
+
+html files are the interactive Altair pages, png and svg files are static
+matplotlib figures of the page's default sensors and the status channels.
+"""
+PAGES = {'monit': Monit, 'pandw': PandW, 'wthr': Wthr}
+# Sensor groups of the static figures, one axes each below the status axes
+STATIC_GROUPS = {'monit': [Monit.in_default, Monit.out_default],
+                 'pandw': [PandW.work_default, PandW.water_default],
+                 'wthr': [Wthr.wthr_default, Wthr.in_humid_default]}
+FORMATS = ['html', 'png', 'svg']
+PERIODS = {'day': dt.timedelta(days=1), 'week': dt.timedelta(days=7)}
+
+
+def lastMonth(now):
+    """
+    Returns the first days of last month and of this month.
+    """
+    end = now.date().replace(day=1)
+    start = (end - dt.timedelta(days=1)).replace(day=1)
+    return start, end
+
+
+def splitRange(start,
+               end,
+               period):
+    """
+    Split the days from start up to end into local midnight to midnight
+    timeranges of period, 'day', 'week' or 'all' for one range. The last
+    range is cut short at end.
+    """
+    def midnight(day):
+        return TO_TZONE.localize(dt.datetime.combine(day,
+                                                     dt.datetime.min.time()))
+
+    if period == 'all':
+        return [[midnight(start), midnight(end)]]
+    days = []
+    day = start
+    while day < end:
+        days.append(day)
+        day += PERIODS[period]
+    return [[midnight(day), midnight(min(day + PERIODS[period], end))]
+            for day in days]
+
+
+def _fileName(out_dir,
+              page,
+              timerange,
+              ext,
+              part=None):
+    name = F"{page}_{timerange[0]:%Y-%m-%d}"
+    if timerange[1] - timerange[0] != dt.timedelta(days=1):
+        name += F"_{timerange[1]:%Y-%m-%d}"
+    if part is not None:
+        name += F"_{part}"
+    return os.path.join(out_dir, F"{name}.{ext}")
+
+
+def _renderHTML(page,
+                timerange,
+                out_dir,
+                resample_N):
+    stp = PAGES[page](resample_N, timerange, onlyPlots=True)
+    files = []
+    for i, plot in enumerate(stp.plots):
+        path = _fileName(out_dir, page, timerange, 'html',
+                         i if len(stp.plots) > 1 else None)
+        with open(path, 'w') as f:
+            f.write(spec_to_html(plot, mode='vega-lite',
+                                 vega_version=alt.VEGA_VERSION,
+                                 vegaembed_version=alt.VEGAEMBED_VERSION,
+                                 vegalite_version=alt.VEGALITE_VERSION))
+        files.append(path)
+    return files
+
+
+def _renderStatic(page,
+                  dat,
+                  timerange,
+                  out_dir,
+                  formats):
+    groups = STATIC_GROUPS[page]
+    fig, axes = plt.subplots(len(groups) + 1, 1, sharex=True,
+                             figsize=(dat._figsize[0],
+                                      dat._figsize[1] * (len(groups) + 1)
+                                      * 0.75))
+    dat.plotStatus(axes=axes[0])
+    for group, ax in zip(groups, axes[1:]):
+        present = [var for var in group if var in dat.vars()]
+        if present:
+            dat.plotVar(present, axes=ax)
+    fig.suptitle(F"{page} {timerange[0]:%Y-%m-%d %H:%M} to "
+                 F"{timerange[1]:%Y-%m-%d %H:%M}")
+    files = []
+    for ext in formats:
+        path = _fileName(out_dir, page, timerange, ext)
+        fig.savefig(path)
+        files.append(path)
+    plt.close(fig)
+    return files
+
+
+def renderRange(timerange,
+                pages,
+                formats,
+                out_dir,
+                resample_N=720):
+    """
+    Render every page in every format for one timerange. The range's data
+    are fetched once into the process's data cache, which every page and
+    figure then reads.
+
+    returns (list of files written, seconds taken)
+    """
+    tic = time.perf_counter()
+    dat = dataCache().get(timerange)
+    files = []
+    static = [ext for ext in formats if ext != 'html']
+    for page in pages:
+        if 'html' in formats:
+            files += _renderHTML(page, timerange, out_dir, resample_N)
+        if static:
+            files += _renderStatic(page, dat, timerange, out_dir, static)
+    return files, time.perf_counter() - tic
+
+
+def _renderTask(task):
+    # Failures are reported rather than ending the whole batch
+    try:
+        return renderRange(*task)
+    except Exception as e:
+        message([F"{'Render failed:': <20}",
+                 F"{task[0][0]:%Y-%m-%d} {e}"], mssgType='ERROR')
+        return [], 0
+
+
+def _workerInit():
+    plt.switch_backend('Agg')
+
+
+def batchRender(timeranges,
+                pages,
+                formats,
+                out_dir,
+                resample_N=720,
+                workers=None):
+    """
+    Render timeranges in a pool of worker processes and report throughput.
+
+    returns dict of ranges, files, seconds of wall time and busy seconds
+    summed over workers.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [(timerange, pages, formats, out_dir, resample_N)
+             for timerange in timeranges]
+    tic = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_workerInit) as pool:
+        results = list(pool.map(_renderTask, tasks))
+    wall = time.perf_counter() - tic
+    files = sum(len(files) for files, _ in results)
+    busy = sum(seconds for _, seconds in results)
+    message([F"{'Rendered:': <20}",
+             F"{len(tasks)} ranges, {files} files in {wall:.1f} s"],
+            mssgType='TIMING')
+    message([F"{'Throughput:': <20}",
+             F"{len(tasks) / wall * 60:.1f} ranges/min, "
+             F"{files / wall:.2f} files/s, "
+             F"{busy / max(len(tasks), 1):.1f} s per range, "
+             F"{busy / wall:.1f}x parallel"],
+            mssgType='TIMING')
+    return {'ranges': len(tasks), 'files': files, 'seconds': wall,
+            'busy': busy}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start', type=dt.date.fromisoformat,
+                        help='first day, default first day of last month.')
+    parser.add_argument('--end', type=dt.date.fromisoformat,
+                        help='day after the last, default first day of this '
+                             'month.')
+    parser.add_argument('--period', choices=list(PERIODS) + ['all'],
+                        default='day',
+                        help='length of each rendered range.')
+    parser.add_argument('--pages', nargs='+', choices=list(PAGES),
+                        default=list(PAGES))
+    parser.add_argument('--format', nargs='+', choices=FORMATS,
+                        default=['html'], dest='formats')
+    parser.add_argument('--out', default='renders',
+                        help='output directory.')
+    parser.add_argument('--samples', type=int, default=720,
+                        help='number of data samples of html charts.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default one per cpu.')
+    args = parser.parse_args()
+    start, end = lastMonth(dt.datetime.now(TO_TZONE))
+    start = args.start or start
+    end = args.end or end
+    if end <= start:
+        raise Exception("End must be after start")
+    batchRender(splitRange(start, end, args.period), args.pages,
+                args.formats, args.out, args.samples, args.workers)
+
+
+if __name__ == "__main__":
+    main()
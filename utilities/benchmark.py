@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import argparse
+import subprocess
+import datetime as dt
+import numpy as np
+from log_message import message
+from derived_metrics import calculate
+from config import TO_TZONE
+import StreamPlot
+from StreamPlot import vconcat
+
+"""
+Benchmarks for the data pipeline on synthetic data, so they run without the
+Pi. Run from the repository root:
+
+python3 -m utilities.benchmark            time each stage of a page load on
+                                          a day, month and year of 30 s
+                                          samples
+python3 -m utilities.benchmark --save results.json
+                                          also record the results
+python3 -m utilities.benchmark --compare results.json
+                                          compare against recorded results,
+                                          failing on regressions
+
+Stages are timed on the Synthetic data source: load (makeWEL), calced_cols
+(every derived metric), resample (getResampled), data_subset (the long
+format chart data) and chart_build (building a monitor, status and power
+chart into a spec), along with the spec's size.
+"""
+SIZES = {'day': 1, 'month': 30, 'year': 365}
+STAGES = ['load', 'calced_cols', 'resample', 'data_subset', 'chart_build']
+START = dt.date(2021, 1, 1)
+TEMP_VARS = ['T_room_T', 'D_room_T', 'V_room_T', 'fireplace_T', 'outside_T']
+POWER_VARS = ['Emp_Solar_w', 'Emp_Tesla_w', 'base_load_w', 'geo_tot_w',
+              'Emp_Dehumid+Washer_w', 'Emp_Dryer_w']
+PLOT_VARS = TEMP_VARS + StreamPlot.StreamPlot.status_list + POWER_VARS
+TOLERANCE = 0.5             # slowdown flagged as a regression
+NOISE_FLOOR = 0.005         # seconds, smaller differences are ignored
+
+
+def _timeStages(days):
+    # One run of every stage on a fresh load, so no stage is served from
+    # the memos of the previous run
+    timerange = [TO_TZONE.localize(
+                     dt.datetime.combine(START + dt.timedelta(days=offset),
+                                         dt.datetime.min.time()))
+                 for offset in (0, days)]
+    stp = StreamPlot.StreamPlot(720, data_source='Synthetic')
+    times = {}
+    tic = time.perf_counter()
+    stp.makeWEL(timerange, force_refresh=True)
+    times['load'] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    calculate(stp.dat.data)
+    times['calced_cols'] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    stp.getResampled(PLOT_VARS)
+    times['resample'] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    stp.planData([(PLOT_VARS, 'mean')])
+    stp._getDataSubset(PLOT_VARS)
+    times['data_subset'] = time.perf_counter() - tic
+    with StreamPlot._memo_lock:
+        StreamPlot._templates.clear()
+    tic = time.perf_counter()
+    spec = stp.toSpec(vconcat(stp.plotMainMonitor(TEMP_VARS),
+                              stp.plotStatus(),
+                              stp.plotPowerStack(POWER_VARS)))
+    times['chart_build'] = time.perf_counter() - tic
+    times['rows'] = len(stp.dat.data)
+    times['spec_bytes'] = len(json.dumps(spec))
+    return times
+
+
+def bench(repeat=3,
+          sizes=SIZES):
+    """
+    Time every stage on each size of data, keeping the fastest of repeat
+    runs.
+
+    returns dict of stage seconds, rows and spec_bytes by size label.
+    """
+    # Imports, schema loading and first calls aren't part of any stage
+    _timeStages(SIZES['day'])
+    results = {}
+    for label in sizes:
+        runs = [_timeStages(SIZES[label]) for i in range(repeat)]
+        results[label] = {key: min(run[key] for run in runs)
+                          for key in runs[0]}
+        for stage in STAGES:
+            message([F"{stage + ' ' + label + ':': <25}",
+                     F"{results[label][stage] * 1000:.1f} ms"],
+                    mssgType='TIMING')
+        message([F"{'spec ' + label + ':': <25}",
+                 F"{results[label]['spec_bytes'] / 2**10:.0f} kB "
+                 F"({results[label]['rows']} rows)"],
+                mssgType='TIMING')
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return None
+
+
+def save(results,
+         path):
+    with open(path, 'w') as f:
+        json.dump({'date': dt.datetime.now().isoformat(timespec='seconds'),
+                   'commit': _commit(),
+                   'results': results}, f, indent=1)
+    message([F"{'Saved:': <25}", path], mssgType='ADMIN')
+
+
+def compare(results,
+            path,
+            tolerance=TOLERANCE):
+    """
+    Compare results against those recorded in path. Stages more than
+    tolerance slower, and by more than NOISE_FLOOR, and larger specs are
+    regressions.
+
+    returns True when nothing regressed.
+    """
+    with open(path) as f:
+        recorded = json.load(f)
+    message([F"{'Compared to:': <25}",
+             F"{path} ({recorded['commit']}, {recorded['date']})"],
+            mssgType='ADMIN')
+    passed = True
+    for label, stages in results.items():
+        old = recorded['results'].get(label)
+        if old is None:
+            continue
+        for stage in STAGES + ['spec_bytes']:
+            if stage not in old:
+                continue
+            ratio = stages[stage] / old[stage] if old[stage] else np.nan
+            if stage == 'spec_bytes':
+                regressed = stages[stage] > old[stage]
+            else:
+                regressed = (ratio > 1 + tolerance
+                             and stages[stage] - old[stage] > NOISE_FLOOR)
+            passed = passed and not regressed
+            message([F"{stage + ' ' + label + ':': <25}",
+                     F"{ratio:.2f}x"
+                     + (" REGRESSION" if regressed else "")],
+                    mssgType='ERROR' if regressed else 'SUCCESS')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per size, the fastest is reported.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES))
+    parser.add_argument('--save', metavar='PATH',
+                        help='record the results as json.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare against recorded results, exiting '
+                             'with an error on regressions.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='slowdown ratio above 1 counted as a '
+                             'regression.')
+    args = parser.parse_args()
+    results = bench(args.repeat, args.sizes)
+    if args.save:
+        save(results, args.save)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import datetime as dt
+import numpy as np
 import WELData
 from pprint import pprint
 from dateutil.relativedelta import relativedelta
@@ -14,14 +15,11 @@ db = WELData.mongoConnect().data
 
 
 def clean_post(frame):
-    frame = frame.dropna()
-    post = frame.to_dict()
-    post['dateandtime'] = (post['dateandtime'].replace(tzinfo=to_tzone)
-                                              .astimezone(db_tzone)
-                                              .to_pydatetime())
-
-    del post['Date']
-    del post['Time']
+    # Rows are indexed by UTC sample time and hold numpy scalars, which bson
+    # doesn't encode
+    post = {name: value.item() if isinstance(value, np.generic) else value
+            for name, value in frame.dropna().items()}
+    post['dateandtime'] = frame.name.tz_convert(db_tzone).to_pydatetime()
 
     sunrise = sun.sunrise(loc.observer, date=post['dateandtime'].date(),
                           tzinfo=to_tzone).astimezone(db_tzone)
@@ -42,9 +40,12 @@ timerange_list = [[init_date + relativedelta(months=x),
                   for x in range(num_months + 1)]
 
 for timerange in timerange_list:
+    # Posted at the logs' full precision, compact dtypes store sensors as
+    # float32
     dat = WELData.WELData(data_source='WEL',
                           timerange=timerange,
-                          calc_cols=False)
+                          calc_cols=False,
+                          compact=False)
     for i in range(len(dat.data)):
         row = dat.data.iloc[i]
         post = clean_post(row)
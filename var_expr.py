@@ -0,0 +1,200 @@
+import ast
+import operator
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+"""
+Compiles plot expressions such as 'TAH_out_T - TAH_in_T' or
+'abs(loop_out_T - loop_in_T) * 2' against the column schema. Column names are
+matched once at compile time, the expression is checked to only contain
+arithmetic on columns, numbers and a few numpy functions, and the result is
+evaluated on whole arrays. Anything else raises ValueError rather than being
+run.
+"""
+_ident_chars = set('abcdefghijklmnopqrstuvwxyz'
+                   'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+
+_bin_ops = {ast.Add: np.add,
+            ast.Sub: np.subtract,
+            ast.Mult: np.multiply,
+            ast.Div: np.divide,
+            ast.FloorDiv: np.floor_divide,
+            ast.Mod: np.mod,
+            ast.Pow: np.power}
+
+_unary_ops = {ast.USub: np.negative,
+              ast.UAdd: operator.pos}
+
+_compare_ops = {ast.Gt: np.greater,
+                ast.GtE: np.greater_equal,
+                ast.Lt: np.less,
+                ast.LtE: np.less_equal,
+                ast.Eq: np.equal,
+                ast.NotEq: np.not_equal}
+
+_functions = {'abs': np.abs,
+              'sqrt': np.sqrt,
+              'log': np.log,
+              'exp': np.exp,
+              'min': np.fmin,
+              'max': np.fmax}
+# Number of arguments of each function, numpy would take more as out buffers
+_arities = {'abs': 1,
+            'sqrt': 1,
+            'log': 1,
+            'exp': 1,
+            'min': 2,
+            'max': 2}
+
+
+def remOffset(status):
+    """
+    Remove plotting offset from status channel data, leaving 1 where the
+    channel is on and NaN where it is off.
+    """
+    mask = np.mod(status, 2)
+    mask[mask == 0.] = np.nan
+    return mask
+
+
+class CompiledExpr:
+    expr = None
+    columns = None
+    _func = None
+
+    def __init__(self,
+                 expr,
+                 columns,
+                 func):
+        self.expr = expr
+        self.columns = columns
+        self._func = func
+
+    def evaluate(self,
+                 frame):
+        """
+        Evaluate against a dataframe holding at least self.columns.
+
+        returns series with the index of frame.
+        """
+        values = [frame[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                  for col in self.columns]
+        result = self._func(values)
+        if np.ndim(result) == 0:
+            result = np.full(len(frame), result, dtype=np.float64)
+        return pd.Series(result, index=frame.index, name=self.expr)
+
+
+def _substituteColumns(expr,
+                       columns):
+    # Column names may contain operators like '+' and '&', so replace each
+    # one, longest match first, with a placeholder before parsing
+    by_length = sorted(columns, key=len, reverse=True)
+    used = []
+    out = ""
+    i = 0
+    while i < len(expr):
+        if i == 0 or expr[i - 1] not in _ident_chars:
+            found = next((col for col in by_length
+                          if expr.startswith(col, i)
+                          and expr[i + len(col):i + len(col) + 1]
+                          not in _ident_chars), None)
+            if found is not None:
+                if found not in used:
+                    used.append(found)
+                out += F" _col{used.index(found)} "
+                i += len(found)
+                continue
+        out += expr[i]
+        i += 1
+    return out, used
+
+
+def _compileNode(node,
+                 mask,
+                 n_cols):
+    if isinstance(node, ast.Expression):
+        return _compileNode(node.body, mask, n_cols)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        value = float(node.value)
+        return lambda cols: value
+    if (isinstance(node, ast.Name)
+            and node.id in [F"_col{idx}" for idx in range(n_cols)]):
+        idx = int(node.id[4:])
+        if mask:
+            return lambda cols: remOffset(cols[idx])
+        return lambda cols: cols[idx]
+    if isinstance(node, ast.BinOp) and type(node.op) in _bin_ops:
+        op = _bin_ops[type(node.op)]
+        left = _compileNode(node.left, mask, n_cols)
+        right = _compileNode(node.right, mask, n_cols)
+        return lambda cols: op(left(cols), right(cols))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+        op = _unary_ops[type(node.op)]
+        operand = _compileNode(node.operand, mask, n_cols)
+        return lambda cols: op(operand(cols))
+    if (isinstance(node, ast.Compare) and len(node.ops) == 1
+            and type(node.ops[0]) in _compare_ops):
+        op = _compare_ops[type(node.ops[0])]
+        left = _compileNode(node.left, mask, n_cols)
+        right = _compileNode(node.comparators[0], mask, n_cols)
+        return lambda cols: op(left(cols), right(cols)).astype(np.float64)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in _functions and not node.keywords):
+        func = _functions[node.func.id]
+        if len(node.args) != _arities[node.func.id]:
+            raise ValueError(F"{node.func.id} takes "
+                             F"{_arities[node.func.id]} arguments, "
+                             F"got {len(node.args)}")
+        args = [_compileNode(arg, mask, n_cols) for arg in node.args]
+        return lambda cols: func(*[arg(cols) for arg in args])
+    raise ValueError(F"Unsupported expression element: {ast.dump(node)}")
+
+
+@lru_cache(maxsize=256)
+def compileExpr(expr,
+                columns,
+                mask=False):
+    """
+    Parse an expression once against the column schema. Cached on all
+    arguments, so columns must be a tuple.
+
+    expr : expression string of column names, numbers, + - * / // % **,
+           comparisons and abs, sqrt, log, exp, min, max.
+    columns : tuple of available column names.
+    optional mask : wrap every column in remOffset, for status masks.
+
+    returns CompiledExpr.
+    """
+    substituted, used = _substituteColumns(expr, columns)
+    if not used:
+        raise ValueError(F"No known columns in expression '{expr}'")
+    try:
+        tree = ast.parse(substituted.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(F"Invalid expression '{expr}': {e.msg}")
+    return CompiledExpr(expr, used, _compileNode(tree, mask, len(used)))
+
+
+def evaluateExprs(exprs,
+                  columns,
+                  getCols,
+                  mask=False):
+    """
+    Compile and evaluate several expressions, fetching the union of their
+    columns in one call.
+
+    exprs : list of expression strings.
+    columns : tuple of available column names.
+    getCols : function taking a list of names and returning a dataframe.
+    optional mask : see compileExpr.
+
+    returns list of series, one per expression.
+    """
+    compiled = [compileExpr(expr, columns, mask) for expr in exprs]
+    needed = []
+    [needed.append(col) for comp in compiled for col in comp.columns
+     if col not in needed]
+    frame = getCols(needed)
+    return [comp.evaluate(frame) for comp in compiled]